@@ -1,110 +1,483 @@
 import os
 os.environ["STREAMLIT_SERVER_ENABLE_FILE_WATCHER"] = "false"
 
-import torch
-torch.classes.__path__ = []
-
+# torch, torch_geometric, numpy/matplotlib and transformers are imported on
+# first use (loading a case, rendering a result, refining a query), so the UI
+# comes up without them; `python -m benchmarks.profile_imports` checks this.
 import streamlit as st
-import json
-from config.prompts import code_template, summary_template
-from core.model import query_ollama, refine_query_with_llm, load_phi2_electrical_model
-from core.executor import run_pipeline
-from torch_geometric.datasets import OPFDataset
+import time
+import uuid
+from core.model import (
+    load_phi2_electrical_model, PHI2_BASE_MODEL, PHI2_ADAPTER_MODEL, STAGE_MODELS, LOCAL_PHI2, get_router,
+    generate_local,
+)
+from core.registry import get_registry
+from core.telemetry import Trace, metrics, start_metrics_server
+from core.jobs import get_job_queue, JobRejected
+from core.catalog import (
+    get_case_preparer, estimate_case, needs_preparation, is_prepared, load_prepared, DATA_ROOT, NUM_GROUPS,
+    DATASET_SOCKET,
+)
+from config.cases import CASES, case_label
 
 st.set_page_config(page_title="Power Grid LLM Interface", layout="wide")
 st.title("🔌 Power Grid Code Assistant with Ollama")
 
+PHI2_KEY = ("phi2", PHI2_BASE_MODEL, PHI2_ADAPTER_MODEL)
+
+
+def load_case(case_name):
+    import torch
+    torch.classes.__path__ = []
+    from torch_geometric.datasets import OPFDataset
+    from core.feature_store import load_feature_store
+    from core.dataset_server import request_dataset, DatasetServerError, SharedOPFDataset, ensure_exported
+
+    # With OPF_DATASET_SOCKET set, map the copy held by the dataset daemon
+    # (python -m core.dataset_server) instead of loading one per process
+    if DATASET_SOCKET:
+        try:
+            return request_dataset(case_name, num_groups=NUM_GROUPS)
+        except DatasetServerError as e:
+            print(f"[App] {e}; loading {case_name} locally")
+    # Cases prepared in the background are memory-mapped, so only touched samples become resident
+    if is_prepared(case_name):
+        return load_prepared(case_name)
+    dataset = OPFDataset(root=DATA_ROOT, case_name=case_name, num_groups=NUM_GROUPS)
+    store = load_feature_store(dataset)
+    # Keep a mapped export instead of the collated copy, so sandbox workers share its pages
+    return SharedOPFDataset(ensure_exported(dataset, store_path=store.path)), store
+
+
+def case_nbytes(case):
+    from core.registry import estimate_nbytes
+    from core.dataset_server import SharedOPFDataset
+
+    # The feature store and shared or exported datasets are mapped files, not private memory
+    dataset = case[0]
+    return 0 if isinstance(dataset, SharedOPFDataset) else estimate_nbytes(dataset)
+
+
+def get_case(case_name):
+    # Shared across sessions
+    return get_registry().get(
+        ("dataset", case_name),
+        lambda: load_case(case_name),
+        sizer=case_nbytes,
+    )
+
+
+def get_sandbox(case_name):
+    # Worker processes map the case's files, so they share one copy of it;
+    # OPF_SANDBOX_WORKERS=0 runs generated code inline instead.
+    from core.sandbox import SandboxPool, DEFAULT_WORKERS
+
+    if DEFAULT_WORKERS <= 0:
+        return None
+    dataset, store = get_case(case_name)
+    return get_registry().get(
+        ("sandbox", case_name),
+        lambda: SandboxPool(dataset, store),
+        sizer=lambda pool: 0,
+    )
+
+
+def load_refiner():
+    from core.refiner import RefinementService
+
+    return RefinementService(*load_phi2_electrical_model())
+
+
+def refiner_nbytes(service):
+    from core.registry import estimate_nbytes
+
+    return estimate_nbytes(service.model)
+
+
+def get_refiner():
+    # One batching refiner per process so concurrent sessions share generate calls.
+    # It owns Phi-2, which is loaded here on first use, counts as the model's size
+    # and stops its batching thread when the registry evicts it.
+    return get_registry().get(PHI2_KEY, load_refiner, sizer=refiner_nbytes, on_evict=lambda service: service.close())
+
+
+def get_phi2():
+    # The refiner's model, so refinement and local summaries share one copy
+    service = get_refiner()
+    return service.model, service.tokenizer
+
+
+def process_query(job, query, use_refinement, case_name, model_id, candidates, progressive=False, stage_models=None):
+    # Runs on a job worker thread: no Streamlit calls, progress goes through `job`
+    from core.executor import run_pipeline
+    from core.serialize import pack_result
+
+    dataset, store = get_case(case_name)
+    final_query = query
+    refined_instruction = None
+    refinement_error = None
+    trace = Trace("query", model=model_id, refinement=use_refinement, job=job.id)
+
+    if use_refinement:
+        job.update("refine" if PHI2_KEY in get_registry() else "loading Phi-2")
+        try:
+            with trace.span("refine"):
+                refined_instruction = get_refiner().refine(query)
+            # Combine user query + instruction for final query to Ollama
+            final_query = f"{query}\n\nInstruction: {refined_instruction}"
+        except Exception as e:
+            refinement_error = str(e)
+
+    def on_progress(update):
+        # Approximate results are shown while the remaining slices run
+        update = dict(update, result=pack_result(update["result"]))
+        update.setdefault("summary", job.partial.get("approximate", {}).get("summary", ""))
+        job.update("progressive", None)
+        job.partial["approximate"] = update
+
+    job.update("generate")
+    summary, code, result_dict, info = run_pipeline(
+        query=final_query,
+        dataset=dataset,
+        model_id=model_id,
+        store=store,
+        sandbox=get_sandbox(case_name),
+        candidates=candidates,
+        on_stream=job.update,
+        trace=trace,
+        progressive=progressive,
+        on_progress=on_progress,
+        stage_models=stage_models,
+    )
+
+    # Figures become PNG bytes so the result can be persisted; each image is
+    # shown as soon as it is rasterized
+    job.update("render")
+    with trace.span("render"):
+        packed = pack_result(result_dict, on_image=lambda i, png: job.partial.setdefault("plots", {}).update({i: png}))
+    trace.finish()
+    return {
+        "refined_instruction": refined_instruction,
+        "refinement_error": refinement_error,
+        "summary": summary,
+        "code": code,
+        "result": packed,
+        "info": info,
+    }
+
+
+def render_run(last_run):
+    from core.serialize import summarize_value, large_arrays, to_npz_bytes, page_rows
+
+    result_dict = last_run["result"]
+    info = last_run["info"]
+
+    if last_run.get("refinement_error"):
+        st.warning(f"⚠️ Refinement failed, using original query.\n{last_run['refinement_error']}")
+    if last_run.get("refined_instruction"):
+        st.subheader("🧾 Refined Instruction (Phi-2):")
+        st.code(last_run["refined_instruction"])
+
+    for failed in info.get("failed_attempts", []):
+        st.warning(f"❌ Attempt {failed['attempt']} failed: {failed['error']}")
+
+    st.subheader("🧠 Generated Code")
+    st.code(last_run["code"], language="python")
+    cache_status = info.get("code_cache", "off")
+    if cache_status in ("exact", "semantic"):
+        st.caption(f"⚡ Code cache hit ({cache_status}) — skipped code generation")
+    else:
+        st.caption(f"Code cache: {cache_status}")
+    result_status = info.get("result_cache")
+    if result_status == "hit":
+        st.caption("⚡ Result cache hit — skipped execution")
+    elif result_status == "map_hit":
+        st.caption("⚡ Result cache: reused the per-sample loop, re-ran only the final steps")
+    prompt_tokens = info.get("prompt_tokens", {})
+    if prompt_tokens:
+        sections = info.get("schema_sections")
+        st.caption(
+            "Prompt tokens (est.): " + ", ".join(f"{stage} {n}" for stage, n in prompt_tokens.items())
+            + (f" · schema sections: {', '.join(sections)}" if sections else "")
+        )
+    progress = info.get("progressive")
+    if progress and progress["samples"] < progress["total"]:
+        st.warning(
+            f"≈ Approximate result from {progress['samples']:,} of {progress['total']:,} samples"
+            + (f" (stopped: {progress['error']})" if progress.get("error") else " — refining in the background...")
+        )
+        if progress["intervals"]:
+            st.dataframe([
+                {
+                    "value": path,
+                    "estimate": ci["estimate"],
+                    "95% CI": f"[{ci['low']:.4g}, {ci['high']:.4g}]",
+                    "scaled to full dataset": ci["extrapolated"],
+                }
+                for path, ci in progress["intervals"].items()
+            ])
+    if last_run.get("summary"):
+        st.success(f"✅ {last_run['summary']}")
+    stage_models = info.get("stage_models", {})
+    if stage_models:
+        st.caption("🧭 " + " · ".join(
+            f"{stage}: {route['model']} ({route['latency_s']:.1f}s"
+            + (f", fell back from {', '.join(route['fallbacks'])}" if route["fallbacks"] else "") + ")"
+            for stage, route in stage_models.items()
+        ))
+
+    st.subheader("📦 Result Dictionary")
+    # Large arrays are summarized; full values are paged or downloaded
+    st.json(summarize_value({k: v for k, v in result_dict.items() if k not in ("plot", "plots")}))
+    big_arrays = list(large_arrays(result_dict))
+    for path, arr in big_arrays:
+        with st.expander(f"🔢 {path} {list(arr.shape)}"):
+            _, num_pages = page_rows(arr, 0)
+            page = st.number_input("Page", min_value=1, max_value=max(num_pages, 1), value=1, key=f"page-{path}")
+            rows, _ = page_rows(arr, page - 1)
+            st.dataframe(rows)
+    if big_arrays:
+        st.download_button(
+            "⬇️ Download full arrays (.npz)",
+            data=to_npz_bytes(result_dict),
+            file_name="result.npz",
+            mime="application/octet-stream",
+        )
+
+    # 🔹 Handle multiple plots
+    if "plots" in result_dict:
+        all_plots = result_dict["plots"]
+        if all_plots:
+            st.subheader("📊 Plots")
+            if not isinstance(all_plots, list):
+                all_plots = [all_plots]
+            for i, fig in enumerate(all_plots):
+                st.markdown(f"**Plot {i+1}**")
+                # Sandboxed runs return figures already rendered to PNG
+                if isinstance(fig, bytes):
+                    st.image(fig)
+                else:
+                    st.pyplot(fig)
+
+    # 🔸 Handle single plot
+    elif "plot" in result_dict:
+        try:
+            if isinstance(result_dict["plot"], bytes):
+                st.image(result_dict["plot"])
+            else:
+                st.pyplot(result_dict["plot"])
+        except:
+            st.plotly_chart(result_dict["plot"])
+
+
+# Optional warm-up when the server process handles its first script run, e.g.
+# OPF_WARMUP_CASES=pglib_opf_case14_ieee,pglib_opf_case118_ieee OPF_WARMUP_PHI2=1
+warmup_jobs = [
+    (("dataset", case), lambda case=case: load_case(case), case_nbytes)
+    for case in filter(None, os.environ.get("OPF_WARMUP_CASES", "").split(","))
+]
+if os.environ.get("OPF_WARMUP_PHI2") == "1":
+    warmup_jobs.append((PHI2_KEY, load_refiner, refiner_nbytes, lambda service: service.close()))
+get_registry().warm_up(warmup_jobs)
+
+# Summaries can be routed to the Phi-2 model that is already loaded for refinement
+get_router().register_local(LOCAL_PHI2, lambda prompt: generate_local(*get_phi2(), prompt))
+
+# Prometheus-text endpoint at /metrics when OPF_METRICS_PORT is set
+start_metrics_server()
+
 # Session setup
 if "model_loaded" not in st.session_state:
     st.session_state.model_loaded = False
+if "user_id" not in st.session_state:
+    st.session_state.user_id = uuid.uuid4().hex[:12]
+
+def format_bytes(n):
+    return f"{n / 1024 ** 3:.1f} GB" if n >= 1024 ** 3 else f"{n / 1024 ** 2:.0f} MB"
+
+
+def load_session(case_name, model_id):
+    try:
+        # Load OPF dataset and its columnar feature store (shared process-wide)
+        with st.spinner("🗂️ Loading dataset and feature store..."):
+            dataset, store = get_case(case_name)
+        st.session_state.data = dataset
+        st.session_state.store = store
+        st.session_state.case_name = case_name
+        st.session_state.sandbox = get_sandbox(case_name)
+        st.session_state.model_id = model_id
+
+        # Phi-2 is loaded by the first query that asks for refinement (see get_refiner)
+        st.session_state.model_loaded = True
+        st.success(f"✅ Loaded dataset {case_name}!")
+    except Exception as e:
+        st.error(f"❌ Error loading dataset or models: {e}")
+
+
+# Background case preparation is polled with reruns, like jobs below
+poll_preparation = False
 
 # Sidebar for model + data loading
 with st.sidebar:
     st.header("Configuration")
     model_id = st.text_input("Ollama Model ID", value="deepseek-coder:33b-instruct")
+    with st.expander("🧭 Model per stage"):
+        st.caption("Blank uses the model above, which is also the fallback on errors and timeouts.")
+        code_model = st.text_input("Code generation", value=STAGE_MODELS["code"])
+        fix_model = st.text_input("Fixes", value=STAGE_MODELS["fix"], help="e.g. a mid-size coder model")
+        summary_model = st.text_input(
+            "Summary", value=STAGE_MODELS["summary"],
+            help=f"A small Ollama model, or `{LOCAL_PHI2}` for the locally loaded Phi-2."
+        )
+    stage_models = {"code": code_model.strip(), "fix": fix_model.strip(), "summary": summary_model.strip()}
 
-    dataset_options = [
-        "pglib_opf_case14_ieee",
-        "pglib_opf_case118_ieee"
-    ]
-    selected_case = st.selectbox("Select OPF Dataset Case", dataset_options)
+    dataset_options = list(CASES)
+    selected_case = st.selectbox(
+        "Select OPF Dataset Case", dataset_options, index=dataset_options.index("pglib_opf_case14_ieee"),
+        format_func=case_label,
+    )
+    estimate = estimate_case(selected_case)
+    st.caption(
+        f"≈ {estimate['samples']:,} samples · dataset ~{format_bytes(estimate['dataset_bytes'])}"
+        f" · feature store ~{format_bytes(estimate['store_bytes'])} (memory-mapped)"
+    )
+    preparation = get_case_preparer().status(selected_case)
+    if preparation["stage"] == "failed":
+        st.error(f"❌ Preprocessing failed: {preparation.get('error')}")
+    elif preparation["stage"] not in ("ready", "not prepared"):
+        st.progress(preparation["fraction"] or 0.0, text=f"⚙️ Preparing {case_label(selected_case)}: {preparation['stage']}...")
+        poll_preparation = True
+    elif needs_preparation(selected_case) and preparation["stage"] == "not prepared":
+        st.caption("Large case: it is preprocessed in the background on first load.")
+    candidates = st.number_input(
+        "Parallel code candidates", min_value=1, max_value=8, value=1,
+        help="Generate and run several candidates concurrently and keep the first that succeeds "
+             "(set OLLAMA_NUM_PARALLEL on the Ollama server to decode them in parallel)."
+    )
+
+    progressive = st.checkbox(
+        "⚡ Approximate first", value=False,
+        help="Run the code on a stratified subset of samples first and show the result with "
+             "confidence intervals, then refine it on larger slices until the full dataset is done."
+    )
 
     if st.button("Load Model and Data"):
-        try:
-            # Load OPF dataset
-            dataset = OPFDataset(root='data', case_name=selected_case)
-            st.session_state.data = dataset
-            st.session_state.model_id = model_id
-
-            # Load Phi-2 fine-tuned model only once
-            with st.spinner("🔌 Loading Phi-2 Electrical Model..."):
-                phi_model, phi_tokenizer = load_phi2_electrical_model()
-                st.session_state.phi_model = phi_model
-                st.session_state.phi_tokenizer = phi_tokenizer
-
-            st.session_state.model_loaded = True
-            st.success(f"✅ Loaded dataset {selected_case} and models!")
-        except Exception as e:
-            st.error(f"❌ Error loading dataset or models: {e}")
+        # Large cases are processed off the script thread first; loading resumes when they are ready
+        if not DATASET_SOCKET and needs_preparation(selected_case) and not is_prepared(selected_case):
+            get_case_preparer().prepare(selected_case)
+            st.session_state.pending_case = selected_case
+            poll_preparation = True
+            st.info(f"⚙️ Preparing {case_label(selected_case)} in the background; it loads when ready.")
+        else:
+            load_session(selected_case, model_id)
+
+    pending_case = st.session_state.get("pending_case")
+    if pending_case:
+        pending = get_case_preparer().status(pending_case)
+        if pending["stage"] == "ready":
+            st.session_state.pending_case = None
+            load_session(pending_case, model_id)
+        elif pending["stage"] in ("failed", "not prepared"):
+            st.session_state.pending_case = None
+        else:
+            poll_preparation = True
+
+    stats = get_registry().stats()
+    st.caption(
+        f"🧠 Shared cache: {len(stats['entries'])} resources, "
+        f"{stats['used_bytes'] / 1024 ** 3:.2f} / {stats['budget_bytes'] / 1024 ** 3:.0f} GB"
+    )
+
+    # 📋 Earlier jobs of this session can be reopened after reruns
+    recent_jobs = get_job_queue().list_jobs(st.session_state.user_id)
+    if recent_jobs:
+        with st.expander("📋 Recent jobs"):
+            for recent in recent_jobs[:10]:
+                label = f"{recent.status} · {recent.description or recent.id}"
+                if st.button(label, key=f"job-{recent.id}", disabled=recent.status != "done"):
+                    st.session_state.last_run = recent.output
+
+    # ⏱️ Per-stage timings of the last query and averages since server start
+    with st.expander("⏱️ Pipeline timings"):
+        if metrics.last_trace:
+            last = metrics.last_trace
+            st.markdown(f"**Last query:** {last['total_s']:.2f}s, retries: {last['attrs'].get('retries', 0)}")
+            st.dataframe([
+                {
+                    "stage": span["stage"],
+                    "model": span.get("model"),
+                    "wall (s)": round(span["wall_s"], 3),
+                    "cpu (s)": round(span["cpu_s"], 3),
+                    "tokens": span.get("eval_count"),
+                    "tok/s": round(span["tokens_per_s"], 1) if "tokens_per_s" in span else None,
+                }
+                for span in last["spans"]
+            ])
+            snapshot = metrics.snapshot()
+            st.markdown("**Mean per stage (all queries):**")
+            st.dataframe([
+                {"stage": name, "count": s["count"], "mean (s)": round(s["mean_s"], 3), "errors": s["errors"]}
+                for name, s in snapshot["stages"].items()
+            ])
+        else:
+            st.caption("No queries timed yet.")
 
 # Main logic after loading
 if st.session_state.model_loaded:
     st.subheader("💬 Ask a Question")
     query = st.text_area("Enter your prompt", height=150)
-    use_refinement = st.checkbox("🔍 Refine query using Phi-2 Electrical Engineering model")
+    use_refinement = st.checkbox(
+        "🔍 Refine query using Phi-2 Electrical Engineering model",
+        help=None if PHI2_KEY in get_registry() else "The model is loaded on first use, which adds a one-time delay.",
+    )
 
     if st.button("Run Query"):
-        final_query = query
-        refined_instruction = None
-
-        # Apply query refinement if selected
-        if use_refinement:
-            with st.spinner("🧠 Refining query using Phi-2..."):
-                try:
-                    refined_instruction = refine_query_with_llm(
-                        query, 
-                        st.session_state.phi_model, 
-                        st.session_state.phi_tokenizer
-                    )
-                    # Combine user query + instruction for final query to Ollama
-                    final_query = f"{query}\n\nInstruction: {refined_instruction}"
-                    st.subheader("🧾 Refined Instruction (Phi-2):")
-                    st.code(refined_instruction)
-                except Exception as e:
-                    st.warning(f"⚠️ Refinement failed, using original query.\n{e}")
-                    final_query = query
-                   
-        with st.spinner("⚙️ Running query through Ollama..."):
-            summary, code, result_dict = run_pipeline(
-                query=final_query,
-                dataset=st.session_state.data,
-                model_id=st.session_state.model_id
+        try:
+            job = get_job_queue().submit(
+                st.session_state.user_id, process_query,
+                query, use_refinement, st.session_state.case_name,
+                st.session_state.model_id, int(candidates), progressive, stage_models,
+                description=query[:80],
             )
+            st.session_state.job_id = job.id
+        except JobRejected as e:
+            st.warning(f"🚦 {e}")
 
-        st.subheader("🧠 Generated Code")
-        st.code(code, language="python")
-
-        st.subheader("📦 Result Dictionary")
-        st.json(result_dict)
-
-        # 🔹 Handle multiple plots
-        if "plots" in result_dict:
-            all_plots = result_dict["plots"]
-            if all_plots:
-                st.subheader("📊 Plots")
-                if not isinstance(all_plots, list):
-                    all_plots = [all_plots]
-                for i, fig in enumerate(all_plots):
-                    st.markdown(f"**Plot {i+1}**")
-                    st.pyplot(fig)
-
-        # 🔸 Handle single plot
-        elif "plot" in result_dict:
-            try:
-                st.pyplot(result_dict["plot"])
-            except:
-                st.plotly_chart(result_dict["plot"])
+    # Poll the background job; results are persisted, so reruns don't lose them
+    job_id = st.session_state.get("job_id")
+    if job_id:
+        job = get_job_queue().get(job_id)
+        if job is None:
+            st.warning(f"⚠️ Job {job_id} not found.")
+            st.session_state.job_id = None
+        elif job.status in ("queued", "running"):
+            st.info(f"⏳ Job `{job.id}` {job.status}: {job.stage}...")
+            if "approximate" in job.partial:
+                render_run(job.partial["approximate"])
+            else:
+                if "retry" in job.partial:
+                    st.warning(job.partial["retry"])
+                partial_code = job.partial.get("fix") or job.partial.get("code")
+                if partial_code:
+                    st.code(partial_code, language="python")
+                if "summary" in job.partial:
+                    st.info(job.partial["summary"])
+            for i, png in sorted(job.partial.get("plots", {}).items()):
+                st.image(png, caption=f"Plot {i + 1}")
+            time.sleep(1)
+            st.rerun()
+        else:
+            st.session_state.job_id = None
+            if job.status == "done":
+                st.session_state.last_run = job.output
+            else:
+                st.error(f"❌ Job failed: {job.error}")
 
-        st.success(f"✅ {summary}")
+    if "last_run" in st.session_state:
+        render_run(st.session_state.last_run)
 else:
     st.info("📂 Load a model and dataset to begin.")
+
+if poll_preparation:
+    time.sleep(1)
+    st.rerun()
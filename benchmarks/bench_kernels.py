@@ -0,0 +1,109 @@
+"""Compares the vectorized `opf` kernels with the per-sample loops generated code
+usually writes.
+
+    python -m benchmarks.bench_kernels --case pglib_opf_case118_ieee --samples 2000
+"""
+import sys
+import json
+import time
+import argparse
+
+import torch
+from torch_geometric.datasets import OPFDataset
+
+from core import kernels
+from core.feature_store import load_feature_store
+
+
+def naive_line_loading(dataset):
+    out = []
+    for data in dataset:
+        attr = data["bus", "ac_line", "bus"].edge_attr
+        label = data["bus", "ac_line", "bus"].edge_label
+        flow = torch.sqrt(label[:, 2] ** 2 + label[:, 3] ** 2)
+        out.append(torch.where(attr[:, 6] > 0, flow / attr[:, 6].clamp_min(1e-12), torch.full_like(flow, float("nan"))))
+    return torch.stack(out)
+
+
+def naive_total_cost(dataset):
+    out = []
+    for data in dataset:
+        x, pg = data["generator"].x, data["generator"].y[:, 0]
+        out.append((x[:, 8] * pg ** 2 + x[:, 9] * pg + x[:, 10]).sum())
+    return torch.stack(out)
+
+
+def naive_voltage_violations(dataset):
+    under, over = [], []
+    for data in dataset:
+        vm, x = data["bus"].y[:, 1], data["bus"].x
+        under.append(vm < x[:, 2])
+        over.append(vm > x[:, 3])
+    return torch.stack(under), torch.stack(over)
+
+
+def naive_generation_per_bus(dataset):
+    out = []
+    for data in dataset:
+        edge_index = data["generator", "generator_link", "bus"].edge_index
+        per_bus = torch.zeros(data["bus"].num_nodes)
+        per_bus.index_add_(0, edge_index[1], data["generator"].y[edge_index[0], 0])
+        out.append(per_bus)
+    return torch.stack(out)
+
+
+BENCHMARKS = {
+    "line_loading": (naive_line_loading, lambda s: kernels.line_loading(s)),
+    "total_generation_cost": (naive_total_cost, lambda s: kernels.total_generation_cost(s)),
+    "voltage_violations": (naive_voltage_violations, lambda s: kernels.voltage_violations(s)),
+    "generation_per_bus": (naive_generation_per_bus, lambda s: kernels.generation_per_bus(s)),
+}
+
+
+def _timed(fn, arg, repeat):
+    best, value = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = fn(arg)
+        best = min(best, time.perf_counter() - start)
+    return best, value
+
+
+def _max_abs_diff(a, b):
+    if isinstance(a, tuple):
+        return max(_max_abs_diff(x, y) for x, y in zip(a, b))
+    a, b = a.float(), b.float()
+    both_nan = torch.isnan(a) & torch.isnan(b)
+    return float(torch.where(both_nan, torch.zeros_like(a), (a - b).abs()).max())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--case", default="pglib_opf_case14_ieee")
+    parser.add_argument("--root", default="data")
+    parser.add_argument("--samples", type=int, default=1000, help="0 = whole dataset")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    dataset = OPFDataset(root=args.root, case_name=args.case)
+    store = load_feature_store(dataset)
+    if args.samples:
+        dataset = dataset[:args.samples]
+        store = store.subset(range(len(dataset)))
+
+    report = {"case": args.case, "num_samples": len(dataset), "kernels": {}}
+    for name, (naive, vectorized) in BENCHMARKS.items():
+        naive_time, expected = _timed(naive, dataset, args.repeat)
+        kernel_time, actual = _timed(vectorized, store, args.repeat)
+        report["kernels"][name] = {
+            "naive_s": naive_time,
+            "kernel_s": kernel_time,
+            "speedup": naive_time / kernel_time if kernel_time else float("inf"),
+            "max_abs_diff": _max_abs_diff(expected, actual),
+        }
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""Replays the canned query corpus through `run_pipeline` against a mock Ollama.
+
+Reports p50/p95 end-to-end latency, exec time, peak memory and retry rate per
+dataset case as JSON, so runs can be diffed over time:
+
+    python -m benchmarks.bench_pipeline --cases pglib_opf_case14_ieee,pglib_opf_case118_ieee \
+        --repeat 3 --output bench_output.json
+"""
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import subprocess
+
+from benchmarks.mock_ollama import MockOllama, load_corpus, CORPUS_PATH
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * q / 100
+    lo, hi = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def distribution(values):
+    return {
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "mean": sum(values) / len(values) if values else None,
+        "max": max(values) if values else None,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_case(case_name, entries, args, run_pipeline, load_case):
+    dataset, store = load_case(case_name)
+    if args.samples:
+        dataset = dataset[:args.samples]
+        store = store.subset(range(len(dataset)))
+
+    sandbox = None
+    if args.sandbox_workers:
+        from core.sandbox import SandboxPool
+        sandbox = SandboxPool(dataset, store, num_workers=args.sandbox_workers)
+
+    runs = []
+    try:
+        for _ in range(args.repeat):
+            for entry in entries:
+                summary, code, result, info = run_pipeline(
+                    query=entry["query"], dataset=dataset, model_id=args.model,
+                    store=store, use_cache=False, sandbox=sandbox, candidates=args.candidates,
+                )
+                trace = info["trace"]
+                exec_spans = [s for s in trace.spans if s["stage"] in ("exec", "exec_candidate")]
+                runs.append({
+                    "id": entry["id"],
+                    "ok": bool(result),
+                    "total_s": trace.total_s,
+                    "exec_s": sum(s["wall_s"] for s in exec_spans),
+                    "retries": trace.attrs.get("retries", 0),
+                    "sandbox_peak_rss_mb": max((s.get("peak_rss", 0) for s in exec_spans), default=0) / 1024 ** 2,
+                })
+    finally:
+        if sandbox is not None:
+            sandbox.close()
+
+    return {
+        "num_samples": len(dataset),
+        "runs": len(runs),
+        "success_rate": sum(r["ok"] for r in runs) / len(runs),
+        "latency_s": distribution([r["total_s"] for r in runs]),
+        "exec_s": distribution([r["exec_s"] for r in runs]),
+        "retry_rate": sum(r["retries"] > 0 for r in runs) / len(runs),
+        "mean_retries": sum(r["retries"] for r in runs) / len(runs),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "sandbox_peak_rss_mb": max(r["sandbox_peak_rss_mb"] for r in runs),
+        "per_query": {
+            entry["id"]: distribution([r["total_s"] for r in runs if r["id"] == entry["id"]])
+            for entry in entries
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cases", default="pglib_opf_case14_ieee,pglib_opf_case118_ieee")
+    parser.add_argument("--root", default="data")
+    parser.add_argument("--samples", type=int, default=0, help="limit samples per case (0 = all)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--model", default="deepseek-coder:33b-instruct")
+    parser.add_argument("--candidates", type=int, default=1)
+    parser.add_argument("--sandbox-workers", type=int, default=0)
+    parser.add_argument("--ttft", type=float, default=0.2)
+    parser.add_argument("--tokens-per-s", type=float, default=50.0)
+    parser.add_argument("--corpus", default=CORPUS_PATH)
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    args = parser.parse_args(argv)
+
+    mock = MockOllama(ttft=args.ttft, tokens_per_s=args.tokens_per_s, corpus_path=args.corpus).start()
+    # Point the client at the mock before core.model reads OLLAMA_URL
+    os.environ["OLLAMA_URL"] = mock.url
+    os.environ.setdefault("OPF_TRACE_LOG", os.devnull)
+
+    from torch_geometric.datasets import OPFDataset
+    from core.executor import run_pipeline
+    from core.feature_store import load_feature_store
+
+    def load_case(case_name):
+        dataset = OPFDataset(root=args.root, case_name=case_name)
+        return dataset, load_feature_store(dataset)
+
+    entries = load_corpus(args.corpus)
+    report = {
+        "timestamp": time.time(),
+        "git_revision": git_revision(),
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+        "cases": {},
+    }
+    try:
+        for case_name in filter(None, args.cases.split(",")):
+            report["cases"][case_name] = run_case(case_name, entries, args, run_pipeline, load_case)
+    finally:
+        report["mock_requests"] = dict(mock.requests)
+        mock.stop()
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
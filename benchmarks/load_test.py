@@ -0,0 +1,252 @@
+"""Drives N concurrent simulated analyst sessions through the app's query path.
+
+Each session submits queries from the recorded corpus to the shared job
+queue one at a time, like the Streamlit UI does, and waits for them to
+finish. Every query goes through refinement, generation, exec (in the shared
+sandbox pool) and summary against a mock Ollama. Phi-2 refinement is
+replaced by a fixed latency unless `--phi2` is given. The report gives
+throughput, latency percentiles, RSS growth per session of the app process
+and sandbox workers, and leaks left behind after the load (open pyplot
+figures, threads, file descriptors), for each concurrency level:
+
+    python -m benchmarks.load_test --case pglib_opf_case118_ieee --concurrency 1,4,16 \
+        --queries 5 --output load_test.json
+"""
+import os
+import sys
+import gc
+import json
+import time
+import random
+import tempfile
+import argparse
+import threading
+
+from benchmarks.mock_ollama import MockOllama, load_corpus, CORPUS_PATH
+from benchmarks.bench_pipeline import percentile, distribution, git_revision
+
+
+def rss_bytes(pid="self"):
+    with open(f"/proc/{pid}/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def open_fds():
+    return len(os.listdir("/proc/self/fd"))
+
+
+class FixedLatencyRefiner:
+    """Stands in for the batched Phi-2 `RefinementService`."""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def refine(self, query, timeout=None):
+        time.sleep(self.latency)
+        return "Use the dataset schema and store numeric results in `result`."
+
+
+def process_query(job, query, use_refinement, case, refiner, sandbox, model_id, progressive, use_cache):
+    # Mirrors process_query in app.py, without Streamlit
+    from core.executor import run_pipeline
+    from core.serialize import pack_result
+    from core.telemetry import Trace
+
+    dataset, store = case
+    trace = Trace("query", model=model_id, refinement=use_refinement, job=job.id)
+    final_query = query
+    if use_refinement:
+        job.update("refine")
+        with trace.span("refine"):
+            final_query = f"{query}\n\nInstruction: {refiner.refine(query)}"
+
+    def on_progress(update):
+        job.partial["approximate"] = dict(update, result=pack_result(update["result"]))
+
+    job.update("generate")
+    summary, code, result, info = run_pipeline(
+        query=final_query, dataset=dataset, model_id=model_id, store=store, sandbox=sandbox,
+        on_stream=job.update, trace=trace, use_cache=use_cache, progressive=progressive, on_progress=on_progress,
+    )
+    job.update("render")
+    with trace.span("render"):
+        packed = pack_result(result)
+    trace.finish()
+    return {"summary": summary, "code": code, "result": packed, "retries": trace.attrs.get("retries", 0),
+            "spans": {s["stage"]: s["wall_s"] for s in trace.spans}}
+
+
+def run_session(session_id, entries, args, jobs, submit, records, rejections):
+    rng = random.Random(session_id)
+    for n in range(args.queries):
+        entry = entries[(session_id + n) % len(entries)]
+        use_refinement = rng.random() < args.refine_fraction
+        start = time.perf_counter()
+        while True:
+            try:
+                job = submit(f"session-{session_id}", entry, use_refinement)
+                break
+            except jobs.JobRejected:
+                rejections.append(session_id)
+                time.sleep(args.poll_interval)
+        # The UI polls the job on every rerun
+        while job.status in jobs.ACTIVE_STATES:
+            time.sleep(args.poll_interval)
+        records.append({
+            "session": session_id,
+            "id": entry["id"],
+            "ok": job.status == "done" and bool(job.output and job.output["result"]),
+            "error": job.error,
+            "latency_s": time.perf_counter() - start,
+            "queue_wait_s": (job.started or job.finished) - job.created,
+            "retries": job.output["retries"] if job.output else None,
+            "spans": job.output["spans"] if job.output else {},
+        })
+        time.sleep(rng.uniform(0, args.think_time))
+
+
+def run_level(concurrency, entries, args, case, refiner, sandbox, jobs, worker_pids):
+    import matplotlib.pyplot as plt
+
+    queue = jobs.JobQueue(job_dir=args.job_dir, workers=args.job_workers,
+                          max_queued=args.max_queued or 2 * concurrency, max_per_session=2)
+
+    def submit(user_id, entry, use_refinement):
+        return queue.submit(
+            user_id, process_query, entry["query"], use_refinement, case, refiner, sandbox,
+            args.model, args.progressive, args.use_cache, description=entry["id"],
+        )
+
+    gc.collect()
+    before = {
+        "rss": rss_bytes(), "workers_rss": sum(rss_bytes(pid) for pid in worker_pids()),
+        "figures": len(plt.get_fignums()), "threads": threading.active_count(), "fds": open_fds(),
+    }
+    records, rejections = [], []
+    sessions = [
+        threading.Thread(target=run_session, args=(i, entries, args, jobs, submit, records, rejections),
+                         name=f"session-{i}", daemon=True)
+        for i in range(concurrency)
+    ]
+    start = time.perf_counter()
+    for thread in sessions:
+        thread.start()
+    for thread in sessions:
+        thread.join()
+    wall = time.perf_counter() - start
+    queue.close()
+    gc.collect()
+    after = {
+        "rss": rss_bytes(), "workers_rss": sum(rss_bytes(pid) for pid in worker_pids()),
+        "figures": len(plt.get_fignums()), "threads": threading.active_count(), "fds": open_fds(),
+    }
+
+    latencies = [r["latency_s"] for r in records]
+    stages = sorted({stage for r in records for stage in r["spans"]})
+    return {
+        "concurrency": concurrency,
+        "queries": len(records),
+        "wall_s": wall,
+        "throughput_qps": len(records) / wall if wall else None,
+        "success_rate": sum(r["ok"] for r in records) / len(records) if records else None,
+        "errors": sorted({r["error"] for r in records if r["error"]}),
+        "rejections": len(rejections),
+        "latency_s": dict(distribution(latencies), p99=percentile(latencies, 99)),
+        "queue_wait_s": distribution([r["queue_wait_s"] for r in records]),
+        "stage_s": {stage: distribution([r["spans"][stage] for r in records if stage in r["spans"]])
+                    for stage in stages},
+        "rss_growth_mb": (after["rss"] - before["rss"]) / 1024 ** 2,
+        "rss_growth_per_session_mb": (after["rss"] - before["rss"]) / 1024 ** 2 / concurrency,
+        "sandbox_rss_growth_mb": (after["workers_rss"] - before["workers_rss"]) / 1024 ** 2,
+        "leaks": {
+            "open_figures": after["figures"] - before["figures"],
+            "threads": after["threads"] - before["threads"],
+            "fds": after["fds"] - before["fds"],
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--case", default="pglib_opf_case14_ieee")
+    parser.add_argument("--samples", type=int, default=0, help="limit samples (0 = all)")
+    parser.add_argument("--concurrency", default="1,2,4,8", help="comma-separated session counts")
+    parser.add_argument("--queries", type=int, default=5, help="queries per session")
+    parser.add_argument("--think-time", type=float, default=0.5, help="max seconds between a session's queries")
+    parser.add_argument("--poll-interval", type=float, default=0.2)
+    parser.add_argument("--refine-fraction", type=float, default=0.5, help="share of queries with refinement")
+    parser.add_argument("--refine-latency", type=float, default=1.0, help="seconds per refinement without --phi2")
+    parser.add_argument("--phi2", action="store_true", help="refine with the real Phi-2 model")
+    parser.add_argument("--job-workers", type=int, default=4)
+    parser.add_argument("--max-queued", type=int, default=0, help="0 = twice the concurrency")
+    parser.add_argument("--sandbox-workers", type=int, default=2, help="0 = exec inline")
+    parser.add_argument("--progressive", action="store_true")
+    parser.add_argument("--use-cache", action="store_true", help="keep the code and result caches on")
+    parser.add_argument("--model", default="deepseek-coder:33b-instruct")
+    parser.add_argument("--ttft", type=float, default=0.2)
+    parser.add_argument("--tokens-per-s", type=float, default=50.0)
+    parser.add_argument("--corpus", default=CORPUS_PATH)
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    args = parser.parse_args(argv)
+
+    mock = MockOllama(ttft=args.ttft, tokens_per_s=args.tokens_per_s, corpus_path=args.corpus).start()
+    # Point the client at the mock before core.model reads OLLAMA_URL
+    os.environ["OLLAMA_URL"] = mock.url
+    os.environ.setdefault("OPF_TRACE_LOG", os.devnull)
+    args.job_dir = tempfile.mkdtemp(prefix="opf-load-test-jobs-")
+
+    from torch_geometric.datasets import OPFDataset
+    from core import jobs
+    from core.feature_store import load_feature_store
+
+    dataset = OPFDataset(root="data", case_name=args.case)
+    store = load_feature_store(dataset)
+    if args.samples:
+        dataset = dataset[:args.samples]
+        store = store.subset(range(len(dataset)))
+
+    sandbox = None
+    if args.sandbox_workers:
+        from core.sandbox import SandboxPool
+        sandbox = SandboxPool(dataset, store, num_workers=args.sandbox_workers)
+
+    def worker_pids():
+        return [w.process.pid for w in sandbox._workers if w.process.is_alive()] if sandbox else []
+
+    if args.phi2:
+        from core.model import load_phi2_electrical_model
+        from core.refiner import RefinementService
+        refiner = RefinementService(*load_phi2_electrical_model())
+    else:
+        refiner = FixedLatencyRefiner(args.refine_latency)
+
+    entries = load_corpus(args.corpus)
+    report = {
+        "timestamp": time.time(),
+        "git_revision": git_revision(),
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+        "num_samples": len(dataset),
+        "levels": [],
+    }
+    try:
+        for concurrency in [int(c) for c in args.concurrency.split(",") if c]:
+            level = run_level(concurrency, entries, args, (dataset, store), refiner, sandbox, jobs, worker_pids)
+            report["levels"].append(level)
+            print(f"[LoadTest] {concurrency} sessions: {level['throughput_qps']:.2f} q/s, "
+                  f"p95 {level['latency_s']['p95']:.2f}s", file=sys.stderr)
+    finally:
+        report["mock_requests"] = dict(mock.requests)
+        if sandbox is not None:
+            sandbox.close()
+        mock.stop()
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
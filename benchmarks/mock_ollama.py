@@ -0,0 +1,193 @@
+"""Local stand-in for the Ollama HTTP API that replays recorded responses.
+
+Implements `/api/generate` (streaming and non-streaming) and `/api/embeddings`.
+Responses come from `benchmarks/corpus.json`: the code prompt is matched by the
+query it contains, the fix prompt by the broken code it contains, and the
+summary prompt by the query again. Latency is simulated as a time to first
+token plus a fixed decode rate, so pipeline overheads can be measured without a GPU.
+
+    python -m benchmarks.mock_ollama --port 11434 --ttft 0.3 --tokens-per-s 40
+"""
+import os
+import re
+import json
+import math
+import time
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CORPUS_PATH = os.path.join(os.path.dirname(__file__), "corpus.json")
+# Text the model tends to add after the code; the client should stop before it
+TRAILING_TEXT = "\n</code>\n\nThis code computes the requested quantity and stores it in `result`."
+
+
+def load_corpus(path=CORPUS_PATH):
+    with open(path) as f:
+        return json.load(f)["entries"]
+
+
+def _tokens(text):
+    # Roughly word-sized chunks, keeping whitespace so the joined stream is exact
+    return re.findall(r"\s*\S+|\s+", text)
+
+
+class Recordings:
+    def __init__(self, entries):
+        self.entries = entries
+
+    def _by_query(self, prompt):
+        # Longest query first so a query that is a prefix of another cannot shadow it
+        for entry in sorted(self.entries, key=lambda e: -len(e["query"])):
+            if entry["query"] in prompt:
+                return entry
+        return None
+
+    def respond(self, prompt):
+        if "The following code failed" in prompt:
+            broken = prompt.split("<broken-code>")[-1].split("</broken-code>")[0].strip()
+            for entry in self.entries:
+                versions = [entry["code"]] + entry.get("fixes", [])
+                for i, version in enumerate(versions[:-1]):
+                    if version.strip() == broken:
+                        return "fix", versions[i + 1] + TRAILING_TEXT
+            return "fix", broken + TRAILING_TEXT
+        entry = self._by_query(prompt)
+        if "<one-line-summary>" in prompt:
+            return "summary", entry["summary"] if entry else "The result dictionary was summarized."
+        if entry is None:
+            return "code", 'result["answer"] = None\nresult["plots"] = []' + TRAILING_TEXT
+        return "code", entry["code"] + TRAILING_TEXT
+
+
+def embed(text, dim=64):
+    # Deterministic bag-of-words hashing, enough to exercise the semantic cache
+    vec = [0.0] * dim
+    for word in re.findall(r"\w+", text.lower()):
+        vec[int(hashlib.md5(word.encode()).hexdigest(), 16) % dim] += 1.0
+    norm = math.sqrt(sum(v * v for v in vec)) or 1.0
+    return [v / norm for v in vec]
+
+
+class MockOllama:
+    def __init__(self, host="127.0.0.1", port=0, ttft=0.2, tokens_per_s=50.0, corpus_path=CORPUS_PATH):
+        self.recordings = Recordings(load_corpus(corpus_path))
+        self.ttft = ttft
+        self.tokens_per_s = tokens_per_s
+        self.requests = {"code": 0, "fix": 0, "summary": 0, "embeddings": 0}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="mock-ollama", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _count(self, kind):
+        with self._lock:
+            self.requests[kind] += 1
+
+    def _handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, payload):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                if self.path == "/api/embeddings":
+                    mock._count("embeddings")
+                    self._send_json({"embedding": embed(request.get("prompt", ""))})
+                elif self.path == "/api/generate":
+                    self._generate(request)
+                else:
+                    self.send_error(404)
+
+            def _generate(self, request):
+                prompt = request.get("prompt", "")
+                kind, text = mock.recordings.respond(prompt)
+                mock._count(kind)
+                tokens = _tokens(text)
+                step = 1.0 / mock.tokens_per_s if mock.tokens_per_s else 0.0
+                start = time.perf_counter()
+                final = {
+                    "model": request.get("model"), "done": True,
+                    "prompt_eval_count": len(_tokens(prompt)),
+                    "prompt_eval_duration": int(mock.ttft * 1e9),
+                }
+                time.sleep(mock.ttft)
+
+                if not request.get("stream", True):
+                    time.sleep(step * len(tokens))
+                    final.update(response=text, eval_count=len(tokens),
+                                 eval_duration=int(step * len(tokens) * 1e9),
+                                 total_duration=int((time.perf_counter() - start) * 1e9))
+                    self._send_json(final)
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                sent = 0
+                try:
+                    for token in tokens:
+                        self._chunk({"model": request.get("model"), "response": token, "done": False})
+                        sent += 1
+                        time.sleep(step)
+                    final.update(response="", eval_count=sent, eval_duration=int(step * sent * 1e9),
+                                 total_duration=int((time.perf_counter() - start) * 1e9))
+                    self._chunk(final)
+                    self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    # Client stopped reading (early stop or cancellation)
+                    self.close_connection = True
+
+            def _chunk(self, payload):
+                data = (json.dumps(payload) + "\n").encode("utf-8")
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+        return Handler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--ttft", type=float, default=0.2, help="seconds before the first token")
+    parser.add_argument("--tokens-per-s", type=float, default=50.0)
+    parser.add_argument("--corpus", default=CORPUS_PATH)
+    args = parser.parse_args(argv)
+    mock = MockOllama(args.host, args.port, args.ttft, args.tokens_per_s, args.corpus)
+    print(f"Mock Ollama listening on {mock.url}")
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
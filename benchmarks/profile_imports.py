@@ -0,0 +1,101 @@
+"""Import-time profile of app startup, from `python -X importtime`.
+
+Runs the top-level imports of `app.py` (or any modules given with
+`--module`) in a fresh interpreter and reports total and per-package import
+time, the slowest packages, and which heavy packages were pulled in. Heavy
+packages should only load on first use, so a cold start or worker restart
+doesn't pay for them:
+
+    python -m benchmarks.profile_imports --top 15
+    python -m benchmarks.profile_imports --module core.executor --fail-on-heavy
+"""
+import os
+import re
+import ast
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+HEAVY_PACKAGES = ("torch", "torch_geometric", "transformers", "peft", "numpy", "matplotlib", "scipy", "pandas")
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def app_imports(path=APP_PATH):
+    """Source of the module-level import statements of `path`."""
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    return "\n".join(ast.unparse(stmt) for stmt in tree.body if isinstance(stmt, (ast.Import, ast.ImportFrom)))
+
+
+def profile(source, cwd=None):
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", source],
+        cwd=cwd or os.path.dirname(APP_PATH), capture_output=True, text=True,
+    )
+    wall = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "import failed")
+
+    modules = []
+    for line in proc.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            modules.append({"module": name, "self_us": int(self_us), "cumulative_us": int(cumulative_us),
+                            "depth": len(indent) // 2})
+    return wall, modules
+
+
+def summarize(wall, modules, top):
+    # Top-level entries (depth 0) add up to the whole import time
+    roots = [m for m in modules if m["depth"] == 0]
+    packages = {}
+    for m in modules:
+        package = m["module"].split(".")[0]
+        packages[package] = packages.get(package, 0) + m["self_us"]
+    heavy = sorted({m["module"].split(".")[0] for m in modules} & set(HEAVY_PACKAGES))
+    return {
+        "wall_s": wall,
+        "import_s": sum(m["cumulative_us"] for m in roots) / 1e6,
+        "modules": len(modules),
+        "heavy_packages": heavy,
+        "slowest_packages": [
+            {"package": name, "self_s": us / 1e6}
+            for name, us in sorted(packages.items(), key=lambda item: -item[1])[:top]
+        ],
+        "slowest_imports": [
+            {"module": m["module"], "cumulative_s": m["cumulative_us"] / 1e6}
+            for m in sorted(roots, key=lambda m: -m["cumulative_us"])[:top]
+        ],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", action="append", help="profile `import MODULE` instead of app.py's imports")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--fail-on-heavy", action="store_true", help="exit 1 if a heavy package is imported")
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    args = parser.parse_args(argv)
+
+    source = "\n".join(f"import {m}" for m in args.module) if args.module else app_imports()
+    report = {"source": source, **summarize(*profile(source), top=args.top)}
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.fail_on_heavy and report["heavy_packages"]:
+        print(f"Heavy packages imported at startup: {', '.join(report['heavy_packages'])}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,36 @@
+"""PGLib-OPF cases available through `torch_geometric.datasets.OPFDataset`.
+
+Entity counts are per sample (the topology is fixed within a case) and only
+feed the memory estimates shown before a case is loaded; they are
+approximate for the larger cases.
+"""
+
+# buses, generators, loads, shunts, ac_lines, transformers
+CASES = {
+    "pglib_opf_case14_ieee": (14, 5, 11, 1, 17, 3),
+    "pglib_opf_case30_ieee": (30, 6, 21, 2, 34, 7),
+    "pglib_opf_case57_ieee": (57, 7, 42, 1, 63, 17),
+    "pglib_opf_case118_ieee": (118, 54, 99, 14, 175, 11),
+    "pglib_opf_case500_goc": (500, 171, 281, 29, 540, 193),
+    "pglib_opf_case2000_goc": (2000, 384, 1125, 143, 2639, 1000),
+    "pglib_opf_case4661_sdet": (4661, 1176, 3455, 0, 4994, 1002),
+    "pglib_opf_case6470_rte": (6470, 761, 3670, 17, 7710, 1265),
+    "pglib_opf_case10000_goc": (10000, 2016, 4947, 281, 10599, 2594),
+    "pglib_opf_case13659_pegase": (13659, 4092, 5544, 8598, 14507, 6013),
+}
+ENTITIES = ("buses", "generators", "loads", "shunts", "ac_lines", "transformers")
+
+# Feature widths (see the schema in config/prompts.py): x + y for nodes, edge_attr + edge_label for edges
+FEATURES = {"buses": 4 + 2, "generators": 11 + 2, "loads": 2, "shunts": 2, "ac_lines": 9 + 4, "transformers": 11 + 4}
+# int64 edge_index columns per sample: ac lines and transformers once, links in both directions
+EDGE_INDEX_COLUMNS = {"buses": 0, "generators": 2, "loads": 2, "shunts": 2, "ac_lines": 1, "transformers": 1}
+
+SAMPLES_PER_GROUP = 15000
+SPLIT_FRACTIONS = {"train": 0.9, "val": 0.05, "test": 0.05}
+
+
+def case_label(case_name):
+    # "pglib_opf_case118_ieee" -> "case118 (ieee)"
+    _, _, rest = case_name.partition("pglib_opf_")
+    size, _, source = rest.partition("_")
+    return f"{size} ({source})" if source else case_name
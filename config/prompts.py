@@ -147,7 +147,31 @@ These edges do not have:
 - Use link edges to map generators to buses (`data['generator', 'generator_link', 'bus'].edge_index`)
 ---
 
+## STACKED TENSORS (`store`)
+
+A preloaded `store` variable holds every sample of `dataset` as stacked tensors with a leading sample dimension:
+- `store['bus'].x` → [num_samples, num_buses, 4], `store['bus'].y` → [num_samples, num_buses, 2]
+- `store['generator'].x` / `.y`, `store['load'].x`, `store['shunt'].x` → same pattern
+- `store['bus', 'ac_line', 'bus'].edge_attr` / `.edge_label` → [num_samples, num_ac_lines, F]
+- `store['bus', 'transformer', 'bus'].edge_attr` / `.edge_label` → [num_samples, num_transformers, F]
+- `edge_index` of every edge type (including link edges) has no sample dimension: `store['generator', 'generator_link', 'bus'].edge_index` → [2, N]
+- `len(store)` is the number of samples. Feature indices are the same as in the NODE TYPES and EDGE TYPES sections.
+
+## PRECOMPILED OPF KERNELS (`opf`)
+
+A preloaded `opf` module computes standard metrics over `store` for all samples at once. Prefer these over hand-written loops:
+- `opf.line_loading(store, edge_type='ac_line', rating='rate_a', side='from')` → [num_samples, num_branches] loading sqrt(pf²+qf²)/rate_a (`edge_type` can be 'transformer'; `side` 'from', 'to' or 'max')
+- `opf.overloaded_branches(store, edge_type='ac_line', threshold=1.0)` → boolean [num_samples, num_branches]
+- `opf.apparent_power_flow(store, edge_type='ac_line', side='from')` → [num_samples, num_branches]
+- `opf.generator_cost(store)` → [num_samples, num_generators] c2*pg²+c1*pg+c0 using solved pg; `opf.total_generation_cost(store)` → [num_samples]
+- `opf.voltage_violations(store, tol=0.0)` → tuple of boolean [num_samples, num_buses] masks (under_vmin, over_vmax); `opf.voltage_violation_magnitude(store)` → [num_samples, num_buses]
+- `opf.generator_limit_violations(store)` → tuple of boolean [num_samples, num_generators] masks (p_violation, q_violation)
+- `opf.generator_bus_index(store)` → [num_generators] bus index of each generator; `opf.device_bus_index(store, 'load')` for loads/shunts
+- `opf.generation_per_bus(store)` / `opf.load_per_bus(store)` → [num_samples, num_buses] solved pg / pd summed per bus
+- `opf.slack_bus_index(store)` → indices of reference buses
+
 # CODING RULES:
+- Prefer the `opf` kernels and vectorized operations on `store` over Python loops over `dataset` for dataset-wide statistics.
 - Do NOT assume any labels yourself in the data.
 - If a function is given output, run it too.
 - Use `matplotlib.pyplot` with `fig, ax = plt.subplots()` for plots.
@@ -329,6 +353,29 @@ These edges do not have:
 - Use `edge_index` to identify which nodes (e.g., buses) are involved in high-loading conditions
 - Use link edges to map generators to buses (`data['generator', 'generator_link', 'bus'].edge_index`)
 
+## STACKED TENSORS (`store`)
+
+A preloaded `store` variable holds every sample of `dataset` as stacked tensors with a leading sample dimension:
+- `store['bus'].x` → [num_samples, num_buses, 4], `store['bus'].y` → [num_samples, num_buses, 2]
+- `store['generator'].x` / `.y`, `store['load'].x`, `store['shunt'].x` → same pattern
+- `store['bus', 'ac_line', 'bus'].edge_attr` / `.edge_label` → [num_samples, num_ac_lines, F]
+- `store['bus', 'transformer', 'bus'].edge_attr` / `.edge_label` → [num_samples, num_transformers, F]
+- `edge_index` of every edge type (including link edges) has no sample dimension: `store['generator', 'generator_link', 'bus'].edge_index` → [2, N]
+- `len(store)` is the number of samples. Feature indices are the same as in the NODE TYPES and EDGE TYPES sections.
+
+## PRECOMPILED OPF KERNELS (`opf`)
+
+A preloaded `opf` module computes standard metrics over `store` for all samples at once. Prefer these over hand-written loops:
+- `opf.line_loading(store, edge_type='ac_line', rating='rate_a', side='from')` → [num_samples, num_branches] loading sqrt(pf²+qf²)/rate_a (`edge_type` can be 'transformer'; `side` 'from', 'to' or 'max')
+- `opf.overloaded_branches(store, edge_type='ac_line', threshold=1.0)` → boolean [num_samples, num_branches]
+- `opf.apparent_power_flow(store, edge_type='ac_line', side='from')` → [num_samples, num_branches]
+- `opf.generator_cost(store)` → [num_samples, num_generators] c2*pg²+c1*pg+c0 using solved pg; `opf.total_generation_cost(store)` → [num_samples]
+- `opf.voltage_violations(store, tol=0.0)` → tuple of boolean [num_samples, num_buses] masks (under_vmin, over_vmax); `opf.voltage_violation_magnitude(store)` → [num_samples, num_buses]
+- `opf.generator_limit_violations(store)` → tuple of boolean [num_samples, num_generators] masks (p_violation, q_violation)
+- `opf.generator_bus_index(store)` → [num_generators] bus index of each generator; `opf.device_bus_index(store, 'load')` for loads/shunts
+- `opf.generation_per_bus(store)` / `opf.load_per_bus(store)` → [num_samples, num_buses] solved pg / pd summed per bus
+- `opf.slack_bus_index(store)` → indices of reference buses
+
 </user>
 <broken-code>
 {code_block}
@@ -0,0 +1,153 @@
+"""Per-entity sections of the data schema for compact, query-specific prompts.
+
+The full `code_template` in `config/prompts.py` stays the single source of
+truth: it is cut into named sections at import time. A compact prompt keeps
+every query-independent part (instructions, coding rules, schema header,
+`store`/`opf` docs) at the front in a fixed order, so consecutive prompts share
+a long identical prefix that Ollama can serve from its KV cache, and appends
+only the entity sections relevant to the query.
+"""
+import re
+
+from config.prompts import code_template, fix_prompt
+
+_schema_start = code_template.index("# DATA SCHEMA")
+_rules_start = code_template.index("# CODING RULES:")
+_user_start = code_template.index("</instruction>")
+
+CODE_PREAMBLE = code_template[:_schema_start]
+CODING_RULES = code_template[_rules_start:_user_start].rstrip() + "\n"
+CODE_USER_BLOCK = code_template[_user_start:]
+
+FIX_PREAMBLE = fix_prompt[:fix_prompt.index("# DATA SCHEMA")]
+FIX_TAIL = fix_prompt[fix_prompt.index("</user>"):]
+
+
+def _split_schema():
+    pieces = code_template[_schema_start:_rules_start].split("\n---\n")
+    names = ["bus", "generator", "load", "shunt", "edges", "ac_line", "transformer", "links", "store"]
+    if len(pieces) != len(names):
+        raise ValueError("code_template schema layout changed; update config/schema.py")
+    sections = dict(zip(names, (p.strip("\n") for p in pieces)))
+
+    sections["header"], sections["bus"] = sections["bus"].split("## NODE TYPES", 1)
+    sections["links"], notes = sections["links"].split("📌 Note:", 1)
+    sections["notes"] = "📌 Note:" + notes.rstrip()
+    sections["store"], kernels = sections["store"].split("## PRECOMPILED OPF KERNELS", 1)
+    sections["kernels"] = "## PRECOMPILED OPF KERNELS" + kernels.rstrip()
+    return {name: text.strip("\n") for name, text in sections.items()}
+
+
+SCHEMA_SECTIONS = _split_schema()
+
+def _parse_entities():
+    # Machine-readable shapes from the same text: {node_type: {attr: width}},
+    # {edge_type: {attr: width}}; `edge_index` has no fixed width and link edges have nothing else
+    nodes, edges = {}, {}
+    for name in ("bus", "generator", "load", "shunt"):
+        for node_type, attr, width in re.findall(r"data\['(\w+)'\]\.(\w+) → shape \[\w+, (\d+)\]", SCHEMA_SECTIONS[name]):
+            nodes.setdefault(node_type, {})[attr] = int(width)
+    for name in ("ac_line", "transformer"):
+        text = SCHEMA_SECTIONS[name]
+        edge_type = tuple(re.findall(r"'(\w+)'", re.search(r"`\(([^)]*)\)`", text).group(1)))
+        attrs = {attr: int(width) for attr, width in re.findall(r"`(\w+)`: shape \[\w+, (\d+)\]", text)}
+        edges[edge_type] = dict(attrs, edge_index=None)
+    for edge_type in re.findall(r"`\(([^)]*)\)`", SCHEMA_SECTIONS["links"]):
+        edges[tuple(re.findall(r"'(\w+)'", edge_type))] = {"edge_index": None}
+    return nodes, edges
+
+
+# Query-independent sections, always sent first and in this order
+STATIC_SECTIONS = ("header", "store", "kernels", "notes")
+NODE_SCHEMA, EDGE_SCHEMA = _parse_entities()
+
+# Query-dependent sections, in canonical order
+ENTITY_SECTIONS = ("bus", "generator", "load", "shunt", "edges", "ac_line", "transformer", "links")
+NODE_SECTIONS = ("bus", "generator", "load", "shunt")
+
+SECTION_KEYWORDS = {
+    "bus": ("bus", "buses", "voltage", "vm", "va", "angle", "vmin", "vmax", "base_kv", "kv",
+            "slack", "reference", "pq", "pv", "bus_type", "node"),
+    "generator": ("generator", "generators", "gen", "pg", "qg", "pmin", "pmax", "qmin", "qmax",
+                  "cost", "dispatch", "generation", "mbase", "vg", "c2", "c1", "c0"),
+    "load": ("load", "loads", "demand", "pd", "qd", "consumption"),
+    "shunt": ("shunt", "shunts", "susceptance", "conductance", "bs", "gs"),
+    "ac_line": ("line", "lines", "ac_line", "branch", "branches", "flow", "flows", "loading",
+                "rate_a", "rate_b", "rate_c", "thermal", "overload", "overloaded", "congestion",
+                "pf", "qf", "pt", "qt", "reactance", "resistance", "br_r", "br_x", "edge", "edges"),
+    "transformer": ("transformer", "transformers", "tap", "shift", "branch", "branches",
+                    "flow", "flows", "loading", "overload", "overloaded", "rating"),
+    "links": ("link", "links", "connected", "connection", "map", "mapping", "attached",
+              "located", "topology", "generator_link", "load_link", "shunt_link"),
+}
+
+
+def _words(text):
+    return set(re.findall(r"[a-z_0-9]+", text.lower()))
+
+
+def select_sections(text, embed_model=None, threshold=0.35):
+    """Entity sections relevant to `text` (a query, or query + code + error).
+
+    Keyword matching always runs; with `embed_model`, sections whose
+    embedding is similar enough to the text are added. Falls back to every
+    section when nothing matches.
+    """
+    words = _words(text)
+    selected = {name for name, keywords in SECTION_KEYWORDS.items() if words & set(keywords)}
+    if embed_model:
+        selected |= _embedding_matches(text, embed_model, threshold)
+    if not selected:
+        return list(ENTITY_SECTIONS)
+
+    # Edge sections need the shared edge description; device + bus questions need the links
+    if selected & {"ac_line", "transformer", "links"}:
+        selected.add("edges")
+    if "bus" in selected and selected & {"generator", "load", "shunt"}:
+        selected.update({"links", "edges"})
+    return [name for name in ENTITY_SECTIONS if name in selected]
+
+
+_section_embeddings = {}
+
+
+def _embedding_matches(text, embed_model, threshold):
+    from core.model import embed_ollama
+    from core.code_cache import _cosine
+
+    query_vec = embed_ollama(text, embed_model)
+    if query_vec is None:
+        return set()
+    matches = set()
+    for name in ENTITY_SECTIONS:
+        key = (embed_model, name)
+        if key not in _section_embeddings:
+            _section_embeddings[key] = embed_ollama(SCHEMA_SECTIONS[name], embed_model)
+        if _section_embeddings[key] and _cosine(query_vec, _section_embeddings[key]) >= threshold:
+            matches.add(name)
+    return matches
+
+
+def _schema_text(sections):
+    parts = [SCHEMA_SECTIONS[name] for name in STATIC_SECTIONS]
+    nodes = [name for name in NODE_SECTIONS if name in sections]
+    for i, name in enumerate(nodes):
+        parts.append(("## NODE TYPES\n" if i == 0 else "") + SCHEMA_SECTIONS[name])
+    parts += [SCHEMA_SECTIONS[name] for name in ENTITY_SECTIONS if name in sections and name not in NODE_SECTIONS]
+    return "\n\n---\n\n".join(parts) + "\n\n"
+
+
+# Everything up to the first query-dependent section is identical across calls
+CODE_PROMPT_PREFIX = CODE_PREAMBLE + CODING_RULES + "\n" + _schema_text(())
+
+
+def build_code_prompt(query, sections):
+    return CODE_PREAMBLE + CODING_RULES + "\n" + _schema_text(sections) + CODE_USER_BLOCK.format(query=query)
+
+
+def build_fix_prompt(code_block, error_message, sections):
+    return FIX_PREAMBLE + _schema_text(sections) + FIX_TAIL.format(code_block=code_block, error_message=error_message)
+
+
+# Identifies the compact prompt layout, e.g. for code cache keys
+COMPACT_TEMPLATE_ID = "compact-v1\n" + CODE_PROMPT_PREFIX + "".join(SCHEMA_SECTIONS[s] for s in ENTITY_SECTIONS)
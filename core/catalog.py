@@ -0,0 +1,203 @@
+"""Case catalog: memory estimates, background preprocessing and lazy loading.
+
+`OPFDataset` downloads and processes a case in the constructor, which for the
+larger PGLib cases takes minutes and holds every sample in memory at once.
+`CasePreparer` runs that step in a separate (spawned) process, so the peak
+memory goes back to the OS when it exits and the Streamlit script thread
+stays free, and reports progress while it runs. The processed case is
+exported to `OPF_PREPARED_DIR` in the same layout the dataset daemon uses
+(see core/dataset_server.py) together with its feature store; loading it
+afterwards only memory-maps those files, so just the pages of the samples
+that code actually touches become resident.
+"""
+import os
+import json
+import glob
+import time
+import queue
+import threading
+import multiprocessing as mp
+
+from config.cases import CASES, ENTITIES, FEATURES, EDGE_INDEX_COLUMNS, SAMPLES_PER_GROUP, SPLIT_FRACTIONS
+
+DATA_ROOT = os.environ.get("OPF_DATA_ROOT", "data")
+# Unix socket of the dataset daemon (python -m core.dataset_server); empty loads cases in-process
+DATASET_SOCKET = os.environ.get("OPF_DATASET_SOCKET", "")
+PREPARED_DIR = os.environ.get("OPF_PREPARED_DIR", os.path.join(DATA_ROOT, "prepared"))
+NUM_GROUPS = int(os.environ.get("OPF_NUM_GROUPS", "20"))
+# Cases estimated above this are prepared in the background instead of loaded inline
+PREPARE_ABOVE_MB = float(os.environ.get("OPF_PREPARE_ABOVE_MB", "1024"))
+STAGES = ("starting", "downloading", "processing", "building feature store", "exporting", "ready", "failed")
+
+
+def estimate_case(case_name, split="train", num_groups=NUM_GROUPS):
+    """Estimated sample count and sizes in bytes of the dataset and its feature store."""
+    counts = dict(zip(ENTITIES, CASES[case_name]))
+    samples = int(SAMPLES_PER_GROUP * num_groups * SPLIT_FRACTIONS[split])
+    features = sum(4 * FEATURES[e] * n for e, n in counts.items())
+    edge_index = sum(2 * 8 * EDGE_INDEX_COLUMNS[e] * n for e, n in counts.items())
+    return {
+        "samples": samples,
+        # The collated dataset stores every sample's edge_index; the store keeps the topology once
+        "dataset_bytes": samples * (features + edge_index),
+        "store_bytes": samples * features,
+    }
+
+
+def needs_preparation(case_name, split="train"):
+    return case_name in CASES and estimate_case(case_name, split)["dataset_bytes"] > PREPARE_ABOVE_MB * 1024 ** 2
+
+
+def prepared_path(case_name, split="train", num_groups=NUM_GROUPS):
+    # The number of groups decides which samples a split holds
+    return os.path.join(PREPARED_DIR, case_name, f"{num_groups}_groups", split)
+
+
+def _read_marker(path):
+    try:
+        with open(os.path.join(path, "prepared.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_prepared(case_name, split="train", num_groups=NUM_GROUPS):
+    # prepared.json is written after the export; reading the manifest would
+    # unpickle tensors and import torch
+    marker = _read_marker(prepared_path(case_name, split, num_groups))
+    return marker is not None and marker.get("num_groups") == num_groups
+
+
+def load_prepared(case_name, split="train", num_groups=NUM_GROUPS):
+    """`(dataset, store)` memory-mapped from a prepared case."""
+    from core.dataset_server import SharedOPFDataset, DatasetServerError
+    from core.feature_store import load_feature_store
+
+    dataset = SharedOPFDataset(prepared_path(case_name, split, num_groups))
+    if dataset.num_groups != num_groups:
+        raise DatasetServerError(
+            f"Prepared {case_name}/{split} has {dataset.num_groups} groups, expected {num_groups}"
+        )
+    return dataset, load_feature_store(dataset, path=dataset.store_path)
+
+
+def _report(progress, stage, fraction=None, **extra):
+    progress.put({"stage": stage, "fraction": fraction, **extra})
+
+
+def _watch_downloads(root, case_name, num_groups, progress, done):
+    # OPFDataset fetches one archive per group, then processes them all in one go
+    while not done.wait(2.0):
+        archives = glob.glob(os.path.join(root, "**", f"{case_name}*.tar.gz"), recursive=True)
+        fraction = min(len(archives) / max(num_groups, 1), 1.0)
+        if fraction < 1.0:
+            _report(progress, "downloading", 0.5 * fraction)
+        else:
+            _report(progress, "processing", 0.5)
+
+
+def _prepare_main(case_name, split, root, num_groups, path, progress):
+    # Runs in the spawned child
+    from torch_geometric.datasets import OPFDataset
+    from core.dataset_server import export_dataset
+    from core.feature_store import load_feature_store, _store_dir
+
+    try:
+        done = threading.Event()
+        threading.Thread(
+            target=_watch_downloads, args=(root, case_name, num_groups, progress, done), daemon=True
+        ).start()
+        _report(progress, "downloading", 0.0)
+        try:
+            dataset = OPFDataset(root=root, case_name=case_name, split=split, num_groups=num_groups)
+        finally:
+            done.set()
+        _report(progress, "building feature store", 0.8)
+        load_feature_store(dataset)
+        _report(progress, "exporting", 0.9)
+        export_dataset(dataset, path, store_path=os.path.abspath(_store_dir(dataset)))
+        with open(os.path.join(path, "prepared.json"), "w") as f:
+            json.dump({"num_groups": num_groups, "num_samples": len(dataset)}, f)
+        _report(progress, "ready", 1.0, num_samples=len(dataset))
+    except Exception as e:
+        _report(progress, "failed", None, error=str(e))
+
+
+class CasePreparer:
+    """Prepares cases in child processes, one at a time per case, and tracks their progress."""
+
+    def __init__(self, root=DATA_ROOT, num_groups=NUM_GROUPS):
+        self.root = root
+        self.num_groups = num_groups
+        self._status = {}
+        self._lock = threading.Lock()
+        self._ctx = mp.get_context("spawn")
+
+    def status(self, case_name, split="train"):
+        """`{"stage", "fraction", "error"?, ...}`; stage is "ready", "not prepared" or a running stage."""
+        with self._lock:
+            status = self._status.get((case_name, split))
+        if status is not None and status["stage"] != "ready":
+            return dict(status)
+        if is_prepared(case_name, split, self.num_groups):
+            return {"stage": "ready", "fraction": 1.0}
+        return dict(status) if status else {"stage": "not prepared", "fraction": None}
+
+    def is_running(self, case_name, split="train"):
+        return self.status(case_name, split)["stage"] not in ("ready", "not prepared", "failed")
+
+    def prepare(self, case_name, split="train"):
+        """Starts preparing `case_name` unless it is ready or already in progress."""
+        key = (case_name, split)
+        with self._lock:
+            current = self._status.get(key)
+            if current is not None and current["stage"] not in ("ready", "failed"):
+                return
+            if is_prepared(case_name, split, self.num_groups):
+                return
+            self._status[key] = {"stage": "starting", "fraction": 0.0, "started": time.time()}
+
+        progress = self._ctx.Queue()
+        process = self._ctx.Process(
+            target=_prepare_main,
+            args=(case_name, split, self.root, self.num_groups,
+                  prepared_path(case_name, split, self.num_groups), progress),
+            name=f"prepare-{case_name}", daemon=True,
+        )
+        process.start()
+        threading.Thread(target=self._monitor, args=(key, process, progress), daemon=True).start()
+
+    def _monitor(self, key, process, progress):
+        while True:
+            try:
+                update = progress.get(timeout=1.0)
+            except queue.Empty:
+                if not process.is_alive():
+                    break
+                continue
+            with self._lock:
+                status = self._status[key]
+                # The download watcher keeps reporting until the dataset is constructed
+                if STAGES.index(update["stage"]) < STAGES.index(status["stage"]):
+                    continue
+                status.update(update)
+            if update["stage"] in ("ready", "failed"):
+                break
+        process.join(timeout=5)
+        with self._lock:
+            status = self._status[key]
+            if status["stage"] not in ("ready", "failed"):
+                status.update(stage="failed", error=f"preprocessing exited with code {process.exitcode}")
+            status["finished"] = time.time()
+
+
+_preparer = None
+_preparer_lock = threading.Lock()
+
+
+def get_case_preparer():
+    global _preparer
+    with _preparer_lock:
+        if _preparer is None:
+            _preparer = CasePreparer()
+        return _preparer
@@ -0,0 +1,142 @@
+import os
+import re
+import json
+import math
+import time
+import sqlite3
+import hashlib
+import threading
+
+from core.model import embed_ollama
+
+CACHE_PATH = os.environ.get("OPF_CODE_CACHE_PATH", os.path.join(".cache", "code_cache.sqlite"))
+MAX_ENTRIES = int(os.environ.get("OPF_CODE_CACHE_MAX_ENTRIES", "500"))
+TTL_SECONDS = float(os.environ.get("OPF_CODE_CACHE_TTL_HOURS", "168")) * 3600
+# Embedding lookup for near-duplicate phrasings is off unless a model is set
+EMBED_MODEL = os.environ.get("OPF_CODE_CACHE_EMBED_MODEL", "")
+SIMILARITY_THRESHOLD = float(os.environ.get("OPF_CODE_CACHE_SIMILARITY", "0.92"))
+
+
+def normalize_query(query):
+    text = query.lower()
+    text = re.sub(r"[^\w\s.<>=/%-]", " ", text)
+    text = re.sub(r"\s+", " ", text)
+    return text.strip(" .")
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _cosine(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+class CodeCache:
+    """On-disk cache of generated code that executed without an exception.
+
+    Entries are keyed by (normalized query, dataset case, model ID, prompt
+    template hash). When `embed_model` is set, a miss on the exact key falls
+    back to the most similar cached query for the same case/model/template.
+    """
+
+    def __init__(self, path=CACHE_PATH, max_entries=MAX_ENTRIES, ttl_seconds=TTL_SECONDS,
+                 embed_model=EMBED_MODEL, similarity_threshold=SIMILARITY_THRESHOLD):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.embed_model = embed_model
+        self.similarity_threshold = similarity_threshold
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS code_cache (
+                    key TEXT PRIMARY KEY,
+                    query TEXT, case_name TEXT, model_id TEXT, template_hash TEXT,
+                    code TEXT, embedding TEXT,
+                    created REAL, last_used REAL, hits INTEGER DEFAULT 0
+                )
+            """)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def _key(self, norm_query, case_name, model_id, template_hash):
+        return text_hash("\x1f".join([norm_query, case_name, model_id, template_hash]))
+
+    def _embed(self, norm_query):
+        if not self.embed_model:
+            return None
+        return embed_ollama(norm_query, self.embed_model)
+
+    def get(self, query, case_name, model_id, template):
+        """Returns `(code, kind)` with kind "exact"/"semantic", or `(None, "miss")`."""
+        norm = normalize_query(query)
+        template_hash = text_hash(template)
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("DELETE FROM code_cache WHERE created < ?", (now - self.ttl_seconds,))
+            key = self._key(norm, case_name, model_id, template_hash)
+            row = conn.execute("SELECT code FROM code_cache WHERE key = ?", (key,)).fetchone()
+            if row:
+                conn.execute("UPDATE code_cache SET last_used = ?, hits = hits + 1 WHERE key = ?", (now, key))
+                return row[0], "exact"
+
+            embedding = self._embed(norm)
+            if embedding is None:
+                return None, "miss"
+            best_key, best_code, best_score = None, None, self.similarity_threshold
+            rows = conn.execute(
+                "SELECT key, code, embedding FROM code_cache "
+                "WHERE case_name = ? AND model_id = ? AND template_hash = ? AND embedding IS NOT NULL",
+                (case_name, model_id, template_hash),
+            )
+            for other_key, code, other in rows:
+                score = _cosine(embedding, json.loads(other))
+                if score >= best_score:
+                    best_key, best_code, best_score = other_key, code, score
+            if best_key is None:
+                return None, "miss"
+            conn.execute("UPDATE code_cache SET last_used = ?, hits = hits + 1 WHERE key = ?", (now, best_key))
+            return best_code, "semantic"
+
+    def put(self, query, case_name, model_id, template, code):
+        norm = normalize_query(query)
+        template_hash = text_hash(template)
+        embedding = self._embed(norm)
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO code_cache "
+                "(key, query, case_name, model_id, template_hash, code, embedding, created, last_used, hits) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0)",
+                (self._key(norm, case_name, model_id, template_hash), norm, case_name, model_id,
+                 template_hash, code, json.dumps(embedding) if embedding else None, now, now),
+            )
+            # LRU eviction beyond the configured size
+            conn.execute(
+                "DELETE FROM code_cache WHERE key NOT IN "
+                "(SELECT key FROM code_cache ORDER BY last_used DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+
+    def discard_code(self, case_name, model_id, code):
+        # Used when a cached block (possibly a semantic match) stops executing
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM code_cache WHERE case_name = ? AND model_id = ? AND code = ?",
+                (case_name, model_id, code),
+            )
+
+
+_code_cache = None
+_code_cache_lock = threading.Lock()
+
+def get_code_cache():
+    global _code_cache
+    with _code_cache_lock:
+        if _code_cache is None:
+            _code_cache = CodeCache()
+        return _code_cache
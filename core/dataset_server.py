@@ -0,0 +1,255 @@
+"""Dataset daemon: loads each OPF case once and shares it with every app process.
+
+The daemon exports the collated tensors of an `OPFDataset` as `.npy` files in a
+shared-memory directory (`/dev/shm` by default) and builds the case's feature
+store. Clients ask for a case over a local Unix socket and map those files
+instead of loading the dataset themselves, so N Streamlit workers (and their
+sandbox processes) share one physical copy of the data.
+
+    python -m core.dataset_server --root data --socket /tmp/opf-datasets.sock
+
+Protocol: one JSON object per line in each direction, e.g.
+`{"op": "open", "case_name": "pglib_opf_case14_ieee", "split": "train", "num_groups": 20}`
+is answered with `{"ok": true, "path": ..., "store_path": ..., "num_samples": ...}`.
+
+Clients map the files copy-on-write, so a snippet that writes into a tensor
+in place only changes its own process's pages.
+"""
+import os
+import json
+import fcntl
+import pickle
+import socket
+import argparse
+import threading
+import socketserver
+
+import numpy as np
+import torch
+from torch_geometric.data import HeteroData, InMemoryDataset
+
+from core.catalog import DATASET_SOCKET, NUM_GROUPS
+
+SHM_DIR = os.environ.get(
+    "OPF_SHM_DIR", "/dev/shm/opf-datasets" if os.path.isdir("/dev/shm") else os.path.join("data", "shared")
+)
+EXPORT_VERSION = 1
+
+
+class DatasetServerError(Exception):
+    pass
+
+
+def _export_dir(shm_dir, case_name, split, num_groups):
+    # The number of downloaded groups decides which samples a split holds
+    return os.path.join(shm_dir, case_name, f"{num_groups}_groups", split)
+
+
+def _read_manifest(path):
+    try:
+        with open(os.path.join(path, "manifest.pkl"), "rb") as f:
+            manifest = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+    return manifest if manifest.get("version") == EXPORT_VERSION else None
+
+
+def export_dataset(dataset, path, store_path=None):
+    """Writes the collated tensors and slices of an InMemoryDataset to `path`."""
+    os.makedirs(path, exist_ok=True)
+    data = dataset._data
+    tensors, values = [], {}
+    for store in data.stores:
+        key = store._key if store._key is not None else "_global"
+        for attr, value in store.items():
+            if isinstance(value, torch.Tensor):
+                file_name = f"{len(tensors)}.npy"
+                np.save(os.path.join(path, file_name), value.numpy())
+                tensors.append({"key": key, "attr": attr, "file": file_name})
+            else:
+                values.setdefault(key, {})[attr] = value
+
+    manifest = {
+        "version": EXPORT_VERSION,
+        "num_samples": len(dataset),
+        "case_name": getattr(dataset, "case_name", None),
+        "split": getattr(dataset, "split", "train"),
+        "num_groups": getattr(dataset, "num_groups", None),
+        "indices": None if dataset._indices is None else list(dataset._indices),
+        "tensors": tensors,
+        "values": values,
+        "slices": dataset.slices,
+        "store_path": store_path,
+    }
+    # Written last: a manifest means the export is complete
+    tmp = os.path.join(path, "manifest.pkl.tmp")
+    with open(tmp, "wb") as f:
+        pickle.dump(manifest, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, os.path.join(path, "manifest.pkl"))
+    return manifest
+
+
+def local_export_dir(dataset):
+    # On disk next to the processed files (which are keyed on num_groups), one per selection of samples
+    from core.feature_store import _selection_key
+
+    base = getattr(dataset, "processed_dir", None) or os.path.join("data", "shared")
+    split = getattr(dataset, "split", "train")
+    return os.path.join(base, f"export_{split}_{len(dataset)}_{_selection_key(dataset)}")
+
+
+def ensure_exported(dataset, store_path=None):
+    """Path of an on-disk export of `dataset` for `SharedOPFDataset`, written on first use.
+
+    Unlike the daemon's exports this lives on disk rather than in shared
+    memory, so the mapped pages are page cache the kernel can reclaim.
+    """
+    path = local_export_dir(dataset)
+    if _read_manifest(path) is None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(f"{path}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if _read_manifest(path) is None:
+                export_dataset(dataset, path, store_path=store_path)
+    return path
+
+
+class SharedOPFDataset(InMemoryDataset):
+    """`OPFDataset` look-alike backed by files exported by the daemon.
+
+    Behaves like the original for generated code (`len(dataset)`,
+    `dataset[i]['bus'].x`, slicing, iteration); tensors are zero-copy views of
+    the shared files.
+    """
+
+    def __init__(self, path):
+        manifest = _read_manifest(path)
+        if manifest is None:
+            raise DatasetServerError(f"No exported dataset at {path}")
+        self.shared_path = path
+        self.store_path = manifest["store_path"]
+        self.case_name = manifest["case_name"]
+        self.split = manifest["split"]
+        self.num_groups = manifest.get("num_groups")
+        super().__init__(root=None)
+
+        data = HeteroData()
+        for entry in manifest["tensors"]:
+            arr = np.load(os.path.join(path, entry["file"]), mmap_mode="c")
+            _store(data, entry["key"])[entry["attr"]] = torch.from_numpy(arr)
+        for key, attrs in manifest["values"].items():
+            for attr, value in attrs.items():
+                _store(data, key)[attr] = value
+        self._data, self.slices = data, manifest["slices"]
+        if manifest["indices"] is not None:
+            self._indices = manifest["indices"]
+
+    @property
+    def processed_dir(self):
+        return self.shared_path
+
+    def __repr__(self):
+        return f"SharedOPFDataset({self.case_name}, split={self.split}, {len(self)})"
+
+
+def _store(data, key):
+    return data if key == "_global" else data[key]
+
+
+class DatasetServer:
+    def __init__(self, root="data", shm_dir=SHM_DIR):
+        self.root = root
+        self.shm_dir = shm_dir
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _case_lock(self, case_name, split, num_groups):
+        with self._lock:
+            return self._locks.setdefault((case_name, split, num_groups), threading.Lock())
+
+    def open(self, case_name, split="train", num_groups=NUM_GROUPS):
+        from torch_geometric.datasets import OPFDataset
+        from core.feature_store import load_feature_store, _store_dir
+
+        path = _export_dir(self.shm_dir, case_name, split, num_groups)
+        with self._case_lock(case_name, split, num_groups):
+            manifest = _read_manifest(path)
+            if manifest is None:
+                print(f"[DatasetServer] Exporting {case_name}/{split} ({num_groups} groups) to {path}")
+                dataset = OPFDataset(root=self.root, case_name=case_name, split=split, num_groups=num_groups)
+                # The feature store is memory-mapped from disk already, so clients map it in place
+                load_feature_store(dataset)
+                manifest = export_dataset(dataset, path, store_path=os.path.abspath(_store_dir(dataset)))
+                # The shared files are now the only copy this process needs
+                del dataset
+        return {"path": path, "store_path": manifest["store_path"], "num_samples": manifest["num_samples"]}
+
+    def handle(self, request):
+        op = request.get("op")
+        if op == "ping":
+            return {"ok": True}
+        if op == "open":
+            return {"ok": True, **self.open(
+                request["case_name"], request.get("split", "train"), int(request.get("num_groups", NUM_GROUPS))
+            )}
+        raise DatasetServerError(f"Unknown op {op!r}")
+
+    def serve(self, socket_path):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        reply = server.handle(json.loads(line))
+                    except Exception as e:
+                        reply = {"ok": False, "error": str(e)}
+                    self.wfile.write((json.dumps(reply) + "\n").encode("utf-8"))
+
+        with socketserver.ThreadingUnixStreamServer(socket_path, Handler) as unix_server:
+            unix_server.daemon_threads = True
+            print(f"[DatasetServer] Serving {self.shm_dir} on {socket_path}")
+            unix_server.serve_forever()
+
+
+def request_dataset(case_name, split="train", num_groups=NUM_GROUPS, socket_path=None, timeout=600):
+    """Asks the daemon for a case and returns `(dataset, store)` mapped from shared files."""
+    from core.feature_store import load_feature_store
+
+    socket_path = socket_path or DATASET_SOCKET
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            # The first request for a case waits for the daemon to load and export it
+            sock.settimeout(timeout)
+            sock.connect(socket_path)
+            request = {"op": "open", "case_name": case_name, "split": split, "num_groups": num_groups}
+            sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+            reply = json.loads(sock.makefile("rb").readline() or b"{}")
+    except (OSError, ValueError) as e:
+        raise DatasetServerError(f"Dataset server at {socket_path} unavailable: {e}")
+    if not reply.get("ok"):
+        raise DatasetServerError(reply.get("error", "Empty reply from dataset server"))
+
+    dataset = SharedOPFDataset(reply["path"])
+    return dataset, load_feature_store(dataset, path=reply["store_path"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--root", default="data")
+    parser.add_argument("--socket", default=DATASET_SOCKET or "/tmp/opf-datasets.sock")
+    parser.add_argument("--shm-dir", default=SHM_DIR)
+    parser.add_argument("--preload", default="", help="comma-separated cases to export at startup")
+    parser.add_argument("--num-groups", type=int, default=NUM_GROUPS, help="groups of the preloaded cases")
+    args = parser.parse_args(argv)
+
+    server = DatasetServer(args.root, args.shm_dir)
+    for case_name in filter(None, args.preload.split(",")):
+        server.open(case_name, num_groups=args.num_groups)
+    server.serve(args.socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,82 +1,398 @@
+import os
 import re
 import streamlit as st
-import json
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import torch
 from torch_geometric.data import HeteroData
-from core.model import query_ollama
+from core.model import get_router
+from core.code_cache import get_code_cache
+from core.result_cache import get_result_cache, execute_memoized
+from core.vectorize import compile_snippet
+from core import kernels
+from core.figures import open_figures, close_new_figures, find_figures
+from core.validator import validate_code, selects_samples, format_issues
+from core.progressive import load_strata, sample_order, stage_sizes, confidence_intervals, to_dataset_indices
+from core.serialize import to_prompt_json, estimate_tokens
+from core.telemetry import Trace, ollama_token_attrs
 from config.prompts import code_template, summary_template, fix_prompt as fix_prompt_template
+from config import schema
+
+# Send only the schema sections relevant to the query (see config/schema.py)
+COMPACT_PROMPTS = os.environ.get("OPF_COMPACT_PROMPTS", "1") != "0"
+SCHEMA_EMBED_MODEL = os.environ.get("OPF_SCHEMA_EMBED_MODEL", "")
+# Run new code on a single sample before the full dataset (see precheck_code)
+DRY_RUN = os.environ.get("OPF_DRY_RUN", "1") != "0"
+# Reuse results of code that already ran on the same case and samples (see core/result_cache.py)
+RESULT_CACHE = os.environ.get("OPF_RESULT_CACHE", "1") != "0"
 
 # ✅ Utility: extract <code>...</code> or ```...``` block
 def extract_code_block(text: str) -> str:
     match = re.search(r"<code>(.*?)</code>", text, re.DOTALL) or \
             re.search(r"```(?:python)?\n?(.*?)\n?```", text, re.DOTALL)
-    return match.group(1).strip() if match else text.strip()
-
-# ✅ Utility: convert PyTorch objects to JSON-safe format
-def make_serializable(v):
-    if isinstance(v, torch.Tensor):
-        return v.tolist()
-    if isinstance(v, dict):
-        return {k: make_serializable(vv) for k, vv in v.items()}
-    if isinstance(v, list):
-        return [make_serializable(vv) for vv in v]
-    return v
+    if match:
+        return match.group(1).strip()
+    # The prompt already opens <code>, so the model may only emit the closing tag
+    return text.split("</code>")[0].strip()
+
+# ✅ Utility: globals available to generated code (inline and in sandbox workers)
+def build_exec_scope(dataset, store=None):
+    return {
+        "dataset": dataset,
+        "store": store,
+        "opf": kernels,
+        "result": {},
+        "torch": torch,
+        "st": st,
+    }
+
+# ✅ Utility: dataset and store restricted to some samples (None keeps everything)
+def subset_case(dataset, store, indices):
+    if indices is None:
+        return dataset, store
+    indices = torch.as_tensor(indices, dtype=torch.long)
+    return dataset[indices], (store.subset(indices) if store is not None else None)
+
+# ✅ Utility: run generated code in the sandbox pool if one is given, else inline
+def execute_code(code_block, dataset, store=None, sandbox=None, stats=None, indices=None, scope=None, cancel=None):
+    if sandbox is not None:
+        result, run_stats = sandbox.run(code_block, indices=indices, scope=scope, cancel=cancel)
+        if stats is not None:
+            stats.update(run_stats)
+        return result
+    exec_scope = build_exec_scope(*subset_case(dataset, store, indices))
+    exec_scope.update(scope or {})
+    figures_before = open_figures()
+    try:
+        # Per-sample loops run vectorized over the store where possible (see core/vectorize.py)
+        exec(compile_snippet(code_block), exec_scope)
+    finally:
+        # Figures not returned in `result` (or from a failed attempt) would leak
+        close_new_figures(figures_before, keep=find_figures(exec_scope.get("result", {})))
+    return exec_scope.get("result", {})
+
+# ✅ Utility: execute_code through the result cache when one is given
+def execute_cached(code_block, dataset, store=None, sandbox=None, stats=None, indices=None, result_cache=None):
+    if result_cache is None:
+        return execute_code(code_block, dataset, store, sandbox, stats=stats, indices=indices)
+    cache_stats = {}
+    result = execute_memoized(
+        lambda code, scope: execute_code(code, dataset, store, sandbox, stats=stats, indices=indices, scope=scope),
+        code_block, getattr(dataset, "case_name", "unknown"), len(dataset), indices, result_cache, cache_stats,
+    )
+    if stats is not None:
+        stats["result_cache"] = cache_stats["result_cache"]
+    return result
+
+# ✅ Utility: static schema check, then a dry run on one sample, before the real execution
+def precheck_code(code_block, dataset, store=None, sandbox=None, trace=None, dry_run=DRY_RUN):
+    """Returns an error message for the fix prompt, or None if the code looks runnable."""
+    trace = trace or Trace("precheck")
+    with trace.span("validate") as span:
+        issues = validate_code(code_block)
+        span["issues"] = len(issues)
+    if issues:
+        return format_issues(issues)
+    if dry_run and len(dataset) > 1 and not selects_samples(code_block):
+        try:
+            with trace.span("dry_run", sandboxed=sandbox is not None) as span:
+                execute_code(code_block, dataset, store, sandbox, stats=span, indices=[0])
+        except Exception as e:
+            return f"Dry run on a single sample failed: {e}"
+    return None
+
+# ✅ Utility: code and fix prompts, full or with only the relevant schema sections
+def build_code_prompt(query, compact=COMPACT_PROMPTS):
+    if not compact:
+        return code_template.format(query=query), None
+    sections = schema.select_sections(query, SCHEMA_EMBED_MODEL or None)
+    return schema.build_code_prompt(query, sections), sections
+
+def build_fix_prompt(code_block, error_message, query, compact=COMPACT_PROMPTS):
+    if not compact:
+        return fix_prompt_template.format(error_message=error_message, code_block=code_block), None
+    # The broken code and error usually name the entities that matter
+    sections = schema.select_sections(f"{query}\n{code_block}\n{error_message}", SCHEMA_EMBED_MODEL or None)
+    return schema.build_fix_prompt(code_block, error_message, sections), sections
+
+# ✅ Utility: cheap sanity checks before accepting a speculative candidate
+def check_result(result):
+    if not isinstance(result, dict):
+        return "`result` must be a dictionary"
+    if not result:
+        return "`result` dictionary is empty"
+    plots = result.get("plots", [])
+    if not isinstance(plots, (list, tuple)):
+        return "`result['plots']` must be a list"
+    if any(v is None for k, v in result.items() if k != "plots"):
+        return "`result` contains None values"
+    return None
+
+# Decoding settings for diverse speculative candidates (cycled if more are requested)
+CANDIDATE_OPTIONS = [
+    {"temperature": 0.0},
+    {"temperature": 0.4},
+    {"temperature": 0.7},
+    {"temperature": 1.0},
+]
+
+# ✅ Utility: per-stage model, latency and fallbacks on the span and in `info`
+def record_route(span, stats, info=None, stage=None):
+    span.update(ollama_token_attrs(stats))
+    span["model"] = stats.get("model")
+    if stats.get("fallbacks"):
+        span["fallbacks"] = [f["model"] for f in stats["fallbacks"]]
+    if info is not None:
+        info["stage_models"][stage] = {
+            "model": stats.get("model"),
+            "latency_s": stats.get("latency_s"),
+            "fallbacks": [f["model"] for f in stats.get("fallbacks", [])],
+        }
+
+# ✅ Speculative generation: N candidates generated and executed concurrently
+def run_speculative(prompt, dataset, model_id, num_candidates, store=None, sandbox=None, trace=None, indices=None, stage_models=None):
+    """Returns `(code, result, None)` for the first candidate that runs and
+    passes `check_result`, or `(code, None, error)` for a failed one."""
+    cancel = threading.Event()
+    trace = trace or Trace("speculative")
+
+    def attempt(i):
+        options = dict(CANDIDATE_OPTIONS[i % len(CANDIDATE_OPTIONS)], seed=i)
+        ollama_stats = {}
+        with trace.span("generate_candidate", candidate=i) as span:
+            output = get_router().query(
+                "code", prompt, model_id, stage_models,
+                stop_at_code_end=True, options=options, cancel=cancel, stats=ollama_stats
+            )
+            record_route(span, ollama_stats)
+        code = extract_code_block(output)
+        if cancel.is_set():
+            return code, None, "cancelled"
+        if not code or output.startswith("ERROR:"):
+            return code, None, output or "Code not found"
+        issues = validate_code(code)
+        if issues:
+            return code, None, format_issues(issues)
+        if cancel.is_set():
+            return code, None, "cancelled"
+        try:
+            with trace.span("exec_candidate", candidate=i) as span:
+                result = execute_code(code, dataset, store, sandbox, stats=span, indices=indices, cancel=cancel)
+        except Exception as e:
+            return code, None, "cancelled" if cancel.is_set() else str(e)
+        return code, result, check_result(result)
+
+    pool = ThreadPoolExecutor(max_workers=num_candidates, thread_name_prefix="candidate")
+    futures = [pool.submit(attempt, i) for i in range(num_candidates)]
+    first_failure = None
+    try:
+        for future in as_completed(futures):
+            code, result, error = future.result()
+            if error is None:
+                return code, result, None
+            if first_failure is None and code:
+                first_failure = (code, None, error)
+    finally:
+        # Stop the other streams and kill their sandbox executions (an inline
+        # execution can't be interrupted and finishes in the background)
+        cancel.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+    return first_failure or ("", None, "Code not found")
 
 # ✅ Main pipeline
-def run_pipeline(query: str, dataset: HeteroData, model_id: str):
+def run_pipeline(query: str, dataset: HeteroData, model_id: str, store=None, on_stream=None, use_cache=True, sandbox=None, candidates=1, trace=None, compact_prompts=COMPACT_PROMPTS, progressive=False, on_progress=None, stage_models=None):
+    """`model_id` is the default model; `stage_models` can route "code", "fix"
+    and "summary" to other tiers (see `LLMRouter` in core/model.py).
+
+    With `progressive`, the code first runs on a stratified subset of the
+    samples and then on growing slices until the full dataset is covered;
+    `on_progress(update)` receives each approximate result with its
+    confidence intervals (see core/progressive.py)."""
+    # A trace passed in by the caller (e.g. to include refinement) is finished by the caller
+    owns_trace = trace is None
+    trace = trace or Trace("query", model=model_id)
+    try:
+        return _run_pipeline(query, dataset, model_id, store, on_stream, use_cache, sandbox, candidates, trace,
+                             compact_prompts, progressive, on_progress, stage_models)
+    finally:
+        if owns_trace:
+            trace.finish()
+
+def _summarize(query, result, llm, trace, info, on_token=None, stage="summary"):
+    # ✅ Size-aware serialization (large arrays become summaries within a token budget)
+    with trace.span("serialize"):
+        prompt_result = to_prompt_json(result)
+
+    summary_prompt = summary_template.format(query=query, result=prompt_result)
+    info["prompt_tokens"][stage] = estimate_tokens(summary_prompt)
+    ollama_stats = {}
+    with trace.span(stage, prompt_tokens_est=info["prompt_tokens"][stage]) as span:
+        summary_raw = llm(
+            "summary", summary_prompt,
+            on_token=on_token, stats=ollama_stats
+        )
+        record_route(span, ollama_stats, info, stage)
+    # summary_match = re.search(r"<one-line-summary>(.*?)</one-line-summary>", summary_raw, re.DOTALL)
+    # summary = summary_match.group(1).strip() if summary_match else "Summary not found."
+    return summary_raw
+
+def _run_progressive(query, code_block, result, dataset, store, sandbox, order, sizes, llm, trace, info, on_progress,
+                     result_cache=None):
+    # Grows the slice until every sample is covered; a failing stage keeps the last estimate
+    num_total = len(order)
+    run = lambda indices: execute_code(code_block, dataset, store, sandbox, indices=indices)
+    for stage, size in enumerate(sizes):
+        indices = order[:size] if size < num_total else None
+        if stage > 0:
+            try:
+                with trace.span("progressive_exec", samples=size) as span:
+                    result = execute_cached(code_block, dataset, store, sandbox, span, indices, result_cache)
+            except Exception as e:
+                info["progressive"]["error"] = str(e)
+                break
+        if indices is None:
+            info["progressive"] = {"samples": num_total, "total": num_total, "intervals": {}}
+            break
+
+        try:
+            with trace.span("confidence_intervals", samples=size):
+                intervals = confidence_intervals(run, indices, result, num_total)
+        except Exception:
+            intervals = {}
+        # The code saw positions in the slice; show dataset indices
+        result = to_dataset_indices(result, indices)
+        info["progressive"] = {"samples": size, "total": num_total, "intervals": intervals}
+        if on_progress:
+            update = {"code": code_block, "result": result, "info": {"progressive": info["progressive"]}}
+            if stage == 0:
+                # One early summary; later stages only refine the numbers
+                update["summary"] = _summarize(
+                    f"{query}\n\n(Approximate: computed on {size} of {num_total} samples.)",
+                    result, llm, trace, info, stage="approximate_summary",
+                )
+            on_progress(update)
+    return result
+
+def _run_pipeline(query, dataset, model_id, store, on_stream, use_cache, sandbox, candidates, trace, compact_prompts,
+                  progressive, on_progress, stage_models):
     result = {}
     torch.cuda.empty_cache()
     max_attempts = 3
+    case_name = getattr(dataset, "case_name", "unknown")
+    code_cache = get_code_cache() if use_cache else None
+    result_cache = get_result_cache() if use_cache and RESULT_CACHE else None
+    info = {"code_cache": "off" if code_cache is None else "miss", "trace": trace, "prompt_tokens": {}, "stage_models": {}}
+    llm = functools.partial(get_router().query, default_model=model_id, overrides=stage_models)
+    # Cached code belongs to the model that wrote it
+    code_model = get_router().model_for("code", model_id, stage_models)
+    trace.attrs.update(case=case_name, candidates=candidates, compact_prompts=compact_prompts, progressive=progressive)
+    # Compact prompts can produce different code, so they get their own cache entries
+    cache_template = schema.COMPACT_TEMPLATE_ID if compact_prompts else code_template
+
+    # on_stream(stage, text_so_far) lets the UI render tokens as they arrive
+    def streamer(stage):
+        return (lambda text: on_stream(stage, text)) if on_stream else None
+
+    # ✅ Step 1: Reuse code that already ran for this question, otherwise ask the LLM
+    cached_code = None
+    if code_cache is not None:
+        with trace.span("code_cache_lookup") as span:
+            cached_code, info["code_cache"] = code_cache.get(query, case_name, code_model, cache_template)
+            span["status"] = info["code_cache"]
+
+    # Progressive mode runs (and fixes) the code on the first, smallest slice
+    exec_indices = None
+    if progressive:
+        order = sample_order(len(dataset), load_strata(store))
+        sizes = stage_sizes(len(dataset))
+        if len(sizes) > 1:
+            exec_indices = order[:sizes[0]]
 
-    # ✅ Step 1: Get code from LLM
-    llm_code_output = query_ollama(code_template.format(query=query), model_id)
-    code_block = extract_code_block(llm_code_output)
+    error_message = None
+    if not cached_code:
+        code_prompt, sections = build_code_prompt(query, compact_prompts)
+        info["prompt_tokens"]["code"] = estimate_tokens(code_prompt)
+        info["schema_sections"] = sections
+    if cached_code:
+        code_block = cached_code
+    elif candidates > 1:
+        with trace.span("speculative", candidates=candidates, prompt_tokens_est=info["prompt_tokens"]["code"]):
+            code_block, result, error_message = run_speculative(
+                code_prompt, dataset, model_id, candidates, store, sandbox, trace, exec_indices, stage_models
+            )
+        info["candidates"] = candidates
+    else:
+        ollama_stats = {}
+        with trace.span("generate", prompt_tokens_est=info["prompt_tokens"]["code"]) as span:
+            llm_code_output = llm(
+                "code", code_prompt,
+                stop_at_code_end=True, on_token=streamer("code"), stats=ollama_stats
+            )
+            record_route(span, ollama_stats, info, "code")
+        code_block = extract_code_block(llm_code_output)
 
     if not code_block:
-        return "Code not found", "", {}
+        return "Code not found", "", {}, info
 
+    # A speculative winner has already run; otherwise execute, fixing on failure
     attempt = 0
-    error_message = ""
+    executed = candidates > 1 and not cached_code
     while attempt < max_attempts:
-        try:
-            exec_scope = {
-                "dataset": dataset,
-                "result": result,
-                "torch": torch,
-                "st": st,
-            }
-            exec(code_block, exec_scope)
-            result = exec_scope.get("result", {})
+        if not executed:
+            # Predictable failures are caught cheaply; a progressive first slice is already small
+            error_message = precheck_code(code_block, dataset, store, sandbox, trace, dry_run=DRY_RUN and exec_indices is None)
+            if error_message is not None:
+                info["precheck_failures"] = info.get("precheck_failures", 0) + 1
+            else:
+                try:
+                    with trace.span("exec", attempt=attempt + 1, sandboxed=sandbox is not None) as span:
+                        if exec_indices is not None:
+                            span["samples"] = len(exec_indices)
+                        result = execute_cached(code_block, dataset, store, sandbox, span, exec_indices, result_cache)
+                    info["result_cache"] = span.get("result_cache", "off")
+                except Exception as e:
+                    error_message = str(e)
+        executed = False
+
+        if error_message is None:
+            if code_cache is not None and code_block != cached_code:
+                code_cache.put(query, case_name, code_model, cache_template, code_block)
             break
-        except Exception as e:
-            error_message = str(e)
-            attempt += 1
-            if attempt >= max_attempts:
-                return f"Execution error after {max_attempts} attempts: {error_message}", code_block, {}
-
-            # ✅ Step 2: Fix code via LLM
-            st.warning(f"❌ Attempt {attempt} failed: {error_message}")
-            st.info("🛠️ LLM is attempting to fix the code...")
-            retry_prompt = fix_prompt_template.format(error_message=error_message, code_block=code_block)
-            fixed_output = query_ollama(retry_prompt, model_id)
-            code_block = extract_code_block(fixed_output)
-
-    # ✅ Step 3: Convert result to serializable
-    serializable_result = {
-        k: make_serializable(v)
-        for k, v in result.items()
-        if k not in ["plot", "plots"]
-    }
+
+        attempt += 1
+        trace.attrs["retries"] = attempt
+        info.setdefault("failed_attempts", []).append({"attempt": attempt, "error": error_message})
+        if code_cache is not None and code_block == cached_code:
+            code_cache.discard_code(case_name, code_model, cached_code)
+        if attempt >= max_attempts:
+            return f"Execution error after {max_attempts} attempts: {error_message}", code_block, {}, info
+
+        # ✅ Step 2: Fix code via LLM
+        # This runs on a job worker thread: the UI shows progress from on_stream, not st.* calls
+        if on_stream:
+            on_stream("retry", f"❌ Attempt {attempt} failed: {error_message}\n\n🛠️ LLM is attempting to fix the code...")
+        retry_prompt, _ = build_fix_prompt(code_block, error_message, query, compact_prompts)
+        prompt_tokens = estimate_tokens(retry_prompt)
+        info["prompt_tokens"]["fix"] = info["prompt_tokens"].get("fix", 0) + prompt_tokens
+        ollama_stats = {}
+        with trace.span("fix", attempt=attempt, prompt_tokens_est=prompt_tokens) as span:
+            fixed_output = llm(
+                "fix", retry_prompt,
+                stop_at_code_end=True, on_token=streamer("fix"), stats=ollama_stats
+            )
+            record_route(span, ollama_stats, info, "fix")
+        code_block = extract_code_block(fixed_output)
+
+    # ✅ Step 3: Approximate result first, then progressively larger slices
+    if exec_indices is not None:
+        result = _run_progressive(query, code_block, result, dataset, store, sandbox, order, sizes,
+                                  llm, trace, info, on_progress, result_cache)
+        progress = info["progressive"]
+        if progress["samples"] < progress["total"]:
+            query = f"{query}\n\n(Approximate: computed on {progress['samples']} of {progress['total']} samples.)"
 
     # ✅ Step 4: Ask for summary
-    summary_raw = query_ollama(
-        summary_template.format(
-            query=query,
-            result=json.dumps(serializable_result, indent=2)
-        ),
-        model_id
-    )
-    # summary_match = re.search(r"<one-line-summary>(.*?)</one-line-summary>", summary_raw, re.DOTALL)
-    # summary = summary_match.group(1).strip() if summary_match else "Summary not found."
+    summary_raw = _summarize(query, result, llm, trace, info, on_token=streamer("summary"))
 
-    return summary_raw, code_block, result
+    return summary_raw, code_block, result, info
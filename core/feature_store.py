@@ -0,0 +1,328 @@
+import os
+import json
+import fcntl
+import hashlib
+import shutil
+import tempfile
+import numpy as np
+import torch
+
+# Per-sample tensors that get stacked into [num_samples, num_entities, F]
+NODE_FIELDS = {
+    "bus": ("x", "y"),
+    "generator": ("x", "y"),
+    "load": ("x",),
+    "shunt": ("x",),
+}
+EDGE_FIELDS = {
+    ("bus", "ac_line", "bus"): ("edge_attr", "edge_label"),
+    ("bus", "transformer", "bus"): ("edge_attr", "edge_label"),
+}
+# Topology is identical for every sample of a case, so edge_index is stored once
+TOPOLOGY_TYPES = list(EDGE_FIELDS) + [
+    ("generator", "generator_link", "bus"),
+    ("bus", "generator_link", "generator"),
+    ("load", "load_link", "bus"),
+    ("bus", "load_link", "load"),
+    ("shunt", "shunt_link", "bus"),
+    ("bus", "shunt_link", "shunt"),
+]
+
+STORE_VERSION = 1
+# Samples compared at a time when checking that the topology is fixed
+TOPOLOGY_CHECK_CHUNK = 1024
+
+
+class StoreView:
+    """Attribute access to the stacked tensors of one node or edge type."""
+
+    def __init__(self, tensors):
+        self.__dict__.update(tensors)
+
+    def keys(self):
+        return list(self.__dict__)
+
+    def __repr__(self):
+        shapes = ", ".join(f"{k}={list(v.shape)}" for k, v in self.__dict__.items())
+        return f"StoreView({shapes})"
+
+
+class FeatureStore:
+    """Columnar, memory-mapped view over every sample of an OPF dataset.
+
+    Indexed like a single `HeteroData` object, but every feature/label tensor
+    has a leading sample dimension, e.g. `store['bus'].y` is
+    `[num_samples, num_buses, 2]` and `store['ac_line'].edge_label` is
+    `[num_samples, num_ac_lines, 4]`. `edge_index` has no sample dimension.
+    """
+
+    def __init__(self, views, num_samples, case_name=None, path=None):
+        self._views = views
+        self.num_samples = num_samples
+        self.case_name = case_name
+        # Directory the arrays are mapped from; None for in-memory subsets
+        self.path = path
+
+    def _resolve(self, key):
+        if key in self._views:
+            return key
+        if isinstance(key, str):
+            matches = [k for k in self._views if isinstance(k, tuple) and k[1] == key]
+            if len(matches) == 1:
+                return matches[0]
+        raise KeyError(f"Unknown node/edge type {key!r} in feature store")
+
+    def __getitem__(self, key):
+        return self._views[self._resolve(key)]
+
+    def __contains__(self, key):
+        try:
+            self._resolve(key)
+            return True
+        except KeyError:
+            return False
+
+    def __len__(self):
+        return self.num_samples
+
+    @property
+    def node_types(self):
+        return [k for k in self._views if isinstance(k, str)]
+
+    @property
+    def edge_types(self):
+        return [k for k in self._views if isinstance(k, tuple)]
+
+    def subset(self, index):
+        """Returns a store restricted to the given sample indices (copies)."""
+        index = torch.as_tensor(index, dtype=torch.long)
+        views = {}
+        for key, view in self._views.items():
+            views[key] = StoreView({
+                attr: t if attr == "edge_index" else t.index_select(0, index)
+                for attr, t in view.__dict__.items()
+            })
+        return FeatureStore(views, len(index), self.case_name)
+
+    def __repr__(self):
+        return f"FeatureStore(case={self.case_name}, num_samples={self.num_samples})"
+
+
+def _file_name(key, attr):
+    name = key if isinstance(key, str) else "__".join(key)
+    return f"{name}.{attr}.npy"
+
+
+def _selection_key(dataset):
+    # "all" for a whole dataset, else a hash of the sample indices of the slice
+    indices = getattr(dataset, "_indices", None)
+    if indices is None:
+        return "all"
+    return hashlib.sha256(",".join(str(int(i)) for i in indices).encode()).hexdigest()[:16]
+
+
+def _store_dir(dataset):
+    # Each slice of a split (e.g. `dataset[:1000]`, `dataset[[3, 5, 7]]`) gets its own store
+    base = getattr(dataset, "processed_dir", None) or os.path.join("data", "feature_store")
+    split = getattr(dataset, "split", "train")
+    return os.path.join(base, f"feature_store_{split}_{len(dataset)}_{_selection_key(dataset)}")
+
+
+def _stacked_from_collated(dataset, key, attr, num_samples):
+    # Fast path for InMemoryDataset: the collated tensor is already contiguous,
+    # so a fixed entity count per sample lets us reshape without separating samples.
+    data = getattr(dataset, "_data", None)
+    slices = getattr(dataset, "slices", None)
+    if data is None or slices is None:
+        return None
+    try:
+        full = data[key][attr]
+        bounds = slices[key][attr]
+    except (KeyError, AttributeError, TypeError):
+        return None
+    counts = bounds[1:] - bounds[:-1]
+    if counts.numel() == 0 or not bool((counts == counts[0]).all()):
+        return None
+    stacked = full.view(counts.numel(), int(counts[0]), *full.shape[1:])
+    indices = getattr(dataset, "_indices", None)
+    if indices is not None:
+        stacked = stacked[torch.as_tensor(list(indices), dtype=torch.long)]
+    return stacked if stacked.size(0) == num_samples else None
+
+
+def _collated_topology_matches(dataset, key, edge_index, num_samples):
+    # True/False if every sample's edge_index equals `edge_index`, None if the
+    # collated tensors can't tell (InMemoryDataset collates without increments)
+    data = getattr(dataset, "_data", None)
+    slices = getattr(dataset, "slices", None)
+    if data is None or slices is None:
+        return None
+    try:
+        full = data[key]["edge_index"]
+        bounds = slices[key]["edge_index"]
+    except (KeyError, AttributeError, TypeError):
+        return None
+    counts = bounds[1:] - bounds[:-1]
+    if counts.numel() == 0 or not bool((counts == edge_index.size(1)).all()):
+        return False
+    blocks = full.view(2, counts.numel(), edge_index.size(1))
+    indices = getattr(dataset, "_indices", None)
+    indices = torch.arange(counts.numel()) if indices is None else torch.as_tensor(list(indices), dtype=torch.long)
+    if indices.numel() != num_samples:
+        return None
+    for chunk in indices.split(TOPOLOGY_CHECK_CHUNK):
+        if not bool((blocks.index_select(1, chunk) == edge_index.unsqueeze(1)).all()):
+            return False
+    return True
+
+
+def _write_store(dataset, path):
+    """Builds the store in a temporary directory next to `path`, then swaps it in.
+
+    `meta.json` is written last and the directory is renamed into place, so a
+    reader (or a crashed build) never leaves a partial store at `path`.
+    """
+    num_samples = len(dataset)
+    if num_samples == 0:
+        raise ValueError("Cannot build a feature store from an empty dataset")
+
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix=f".{os.path.basename(path)}.", dir=parent)
+    try:
+        meta = _build_store(dataset, tmp)
+        _publish(tmp, path)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return meta
+
+
+def _publish(tmp, path):
+    try:
+        # Succeeds unless a previous store is in the way
+        os.replace(tmp, path)
+        return
+    except OSError:
+        pass
+    stale = f"{tmp}.stale"
+    os.replace(path, stale)
+    os.replace(tmp, path)
+    # Open memory maps of the old files stay valid after they are unlinked
+    shutil.rmtree(stale, ignore_errors=True)
+
+
+def _build_store(dataset, path):
+    num_samples = len(dataset)
+    first = dataset[0]
+    fields = [(k, a) for k, attrs in NODE_FIELDS.items() for a in attrs]
+    fields += [(k, a) for k, attrs in EDGE_FIELDS.items() for a in attrs]
+    fields = [(k, a) for k, a in fields if k in first.node_types + first.edge_types and a in first[k]]
+
+    meta = {"version": STORE_VERSION, "num_samples": num_samples, "selection": _selection_key(dataset),
+            "case_name": getattr(dataset, "case_name", None), "fields": [], "topology": []}
+    pending = []
+    for key, attr in fields:
+        sample = first[key][attr]
+        target = os.path.join(path, _file_name(key, attr))
+        stacked = _stacked_from_collated(dataset, key, attr, num_samples)
+        if stacked is not None:
+            np.save(target, stacked.numpy())
+        else:
+            arr = np.lib.format.open_memmap(
+                target, mode="w+", dtype=sample.numpy().dtype,
+                shape=(num_samples,) + tuple(sample.shape),
+            )
+            pending.append((key, attr, arr))
+        meta["fields"].append({"key": key, "attr": attr})
+
+    # edge_index is stored once, so every sample has to share sample 0's
+    topology = {key: first[key].edge_index for key in TOPOLOGY_TYPES if key in first.edge_types}
+    unchecked = []
+    for key, edge_index in topology.items():
+        matches = _collated_topology_matches(dataset, key, edge_index, num_samples)
+        if matches is False:
+            raise ValueError(f"Samples have different {key} edge_index; the feature store needs a fixed topology")
+        if matches is None:
+            unchecked.append(key)
+
+    # Slow path: separate each sample once and write it into its row
+    if pending or unchecked:
+        for i in range(num_samples):
+            data = dataset[i]
+            for key, attr, arr in pending:
+                value = data[key][attr]
+                if tuple(value.shape) != arr.shape[1:]:
+                    raise ValueError(
+                        f"Sample {i} has {key}.{attr} of shape {list(value.shape)}, "
+                        f"expected {list(arr.shape[1:])}; the feature store needs a fixed topology"
+                    )
+                arr[i] = value.numpy()
+            for key in unchecked:
+                if not torch.equal(data[key].edge_index, topology[key]):
+                    raise ValueError(
+                        f"Sample {i} has a different {key} edge_index than sample 0; "
+                        "the feature store needs a fixed topology"
+                    )
+        for _, _, arr in pending:
+            arr.flush()
+
+    for key, edge_index in topology.items():
+        np.save(os.path.join(path, _file_name(key, "edge_index")), edge_index.numpy())
+        meta["topology"].append({"key": key})
+
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    return meta
+
+
+def _read_meta(path):
+    try:
+        with open(os.path.join(path, "meta.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _is_current(meta, dataset):
+    return (
+        bool(meta) and meta.get("version") == STORE_VERSION and meta.get("num_samples") == len(dataset)
+        and meta.get("selection") == _selection_key(dataset)
+    )
+
+
+def _as_key(key):
+    return key if isinstance(key, str) else tuple(key)
+
+
+def load_feature_store(dataset, path=None, rebuild=False):
+    """Packs `dataset` into memory-mapped arrays (once) and opens them.
+
+    Arrays are cached under the dataset's processed directory, in a directory
+    per split and selection of samples, and reused as long as they were built
+    from the same samples, so later loads only map the files.
+    """
+    path = path or _store_dir(dataset)
+    meta = None if rebuild else _read_meta(path)
+    if not _is_current(meta, dataset):
+        # Concurrent loads of the same store build it once; the others wait and reuse it
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(f"{path}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            meta = None if rebuild else _read_meta(path)
+            if not _is_current(meta, dataset):
+                meta = _write_store(dataset, path)
+
+    tensors = {}
+    for field in meta["fields"]:
+        key = _as_key(field["key"])
+        # Copy-on-write mapping: pages are shared with the page cache and any
+        # accidental in-place write from generated code stays private.
+        arr = np.load(os.path.join(path, _file_name(key, field["attr"])), mmap_mode="c")
+        tensors.setdefault(key, {})[field["attr"]] = torch.from_numpy(arr)
+    for field in meta["topology"]:
+        key = _as_key(field["key"])
+        arr = np.load(os.path.join(path, _file_name(key, "edge_index")))
+        tensors.setdefault(key, {})["edge_index"] = torch.from_numpy(arr)
+
+    views = {key: StoreView(attrs) for key, attrs in tensors.items()}
+    return FeatureStore(views, meta["num_samples"], meta.get("case_name"), path=os.path.abspath(path))
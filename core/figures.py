@@ -0,0 +1,213 @@
+"""Rasterizes matplotlib figures from `result` off the Streamlit script thread.
+
+Figures are rendered to PNG with the Agg backend in a small thread pool,
+closed right after, and cached by a hash of their pickled content, so a
+result that reappears (e.g. a code cache hit) skips rasterization. Scatter
+plots with more points than `OPF_PLOT_MAX_POINTS` are randomly downsampled
+first.
+"""
+import io
+import os
+import pickle
+import hashlib
+import weakref
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+from matplotlib.collections import PathCollection
+from matplotlib._pylab_helpers import Gcf
+
+RENDER_WORKERS = int(os.environ.get("OPF_RENDER_WORKERS", "2"))
+PNG_CACHE_MB = int(os.environ.get("OPF_PNG_CACHE_MB", "128"))
+MAX_PLOT_POINTS = int(os.environ.get("OPF_PLOT_MAX_POINTS", "20000"))
+
+
+def is_figure(value):
+    return hasattr(value, "savefig")
+
+
+def figure_to_png(fig, dpi=100):
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", dpi=dpi, bbox_inches="tight")
+    return buf.getvalue()
+
+
+def figure_hash(fig):
+    try:
+        return hashlib.sha1(pickle.dumps(fig, protocol=pickle.HIGHEST_PROTOCOL)).hexdigest()
+    except Exception:
+        # Some artists (e.g. with lambdas attached) cannot be pickled
+        return None
+
+
+def _subsample(n, max_points, seed=0):
+    return np.sort(np.random.default_rng(seed).choice(n, max_points, replace=False))
+
+
+def downsample_figure(fig, max_points=MAX_PLOT_POINTS):
+    """Randomly thins scatter collections and marker-only lines in place."""
+    for ax in fig.axes:
+        total, shown = 0, 0
+        for coll in ax.collections:
+            if not isinstance(coll, PathCollection):
+                continue
+            offsets = coll.get_offsets()
+            n = len(offsets)
+            if n <= max_points:
+                continue
+            idx = _subsample(n, max_points)
+            coll.set_offsets(np.asarray(offsets)[idx])
+            # Per-point sizes, colors and colormapped values follow the points
+            if len(coll.get_sizes()) == n:
+                coll.set_sizes(coll.get_sizes()[idx])
+            if len(coll.get_facecolors()) == n:
+                coll.set_facecolor(coll.get_facecolors()[idx])
+            if len(coll.get_edgecolors()) == n:
+                coll.set_edgecolor(coll.get_edgecolors()[idx])
+            values = coll.get_array()
+            if values is not None and len(values) == n:
+                coll.set_array(np.asarray(values)[idx])
+            total, shown = total + n, shown + max_points
+        for line in ax.lines:
+            x, y = line.get_xdata(), line.get_ydata()
+            n = len(x)
+            if n <= max_points or line.get_linestyle() not in ("None", "", " ") or line.get_marker() in (None, "None", ""):
+                continue
+            idx = _subsample(n, max_points)
+            line.set_data(np.asarray(x)[idx], np.asarray(y)[idx])
+            total, shown = total + n, shown + max_points
+        if total:
+            ax.text(0.99, 0.01, f"showing {shown:,} of {total:,} points", transform=ax.transAxes,
+                    ha="right", va="bottom", fontsize=7, alpha=0.6)
+    return fig
+
+
+class PNGCache:
+    """LRU of rendered PNG bytes keyed by figure content hash, bounded in bytes."""
+
+    def __init__(self, max_bytes=PNG_CACHE_MB * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        return None
+
+    def put(self, key, png):
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = png
+            self._size += len(png)
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                _, old = self._entries.popitem(last=False)
+                self._size -= len(old)
+
+
+png_cache = PNGCache()
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=max(1, RENDER_WORKERS), thread_name_prefix="render")
+        return _pool
+
+
+def _reset_after_fork():
+    # A forked child doesn't have the parent's pool threads
+    global _pool, _pool_lock
+    _pool, _pool_lock = None, threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def render_figure(fig, dpi=100):
+    """PNG bytes for `fig`, cached by content."""
+    key = figure_hash(fig)
+    png = png_cache.get(key) if key else None
+    if png is None:
+        png = figure_to_png(downsample_figure(fig), dpi=dpi)
+        if key:
+            png_cache.put(key, png)
+    return png
+
+
+def find_figures(value, found=None):
+    found = found if found is not None else []
+    if is_figure(value):
+        found.append(value)
+    elif isinstance(value, dict):
+        for v in value.values():
+            find_figures(v, found)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            find_figures(v, found)
+    return found
+
+
+def render_figures(figures, on_image=None):
+    """Renders figures concurrently and closes them; returns `{id(fig): png}`.
+
+    `on_image(i, png)` is called as each one finishes, in completion order.
+    """
+    futures = {_get_pool().submit(render_figure, fig): (i, fig) for i, fig in enumerate(figures)}
+    rendered = {}
+    try:
+        for future in as_completed(futures):
+            i, fig = futures[future]
+            rendered[id(fig)] = future.result()
+            if on_image:
+                on_image(i, rendered[id(fig)])
+    finally:
+        # pyplot's figure registry is not thread-safe, so close from this thread
+        for i, fig in futures.values():
+            plt.close(fig)
+    return rendered
+
+
+# pyplot's figure registry is global, but snippets run concurrently on job and
+# candidate threads: remember which thread opened each figure, so cleanup only
+# touches the calling thread's own (`plt.subplots` goes through `plt.figure` too)
+_figure_owners = weakref.WeakKeyDictionary()
+_figure_lock = threading.Lock()
+_pyplot_figure = plt.figure
+
+
+def _owned_figure(*args, **kwargs):
+    # Serialized so that concurrent calls don't pick the same figure number
+    with _figure_lock:
+        fig = _pyplot_figure(*args, **kwargs)
+        _figure_owners.setdefault(fig, threading.get_ident())
+    return fig
+
+
+plt.figure = _owned_figure
+
+
+def open_figures():
+    return set(plt.get_fignums())
+
+
+def close_new_figures(before, keep=()):
+    """Closes pyplot figures this thread opened since `before` (a set of fignums) unless kept."""
+    keep_ids = {id(fig) for fig in keep}
+    me = threading.get_ident()
+    for manager in Gcf.get_all_fig_managers():
+        fig = manager.canvas.figure
+        if manager.num not in before and _figure_owners.get(fig) == me and id(fig) not in keep_ids:
+            plt.close(fig)
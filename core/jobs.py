@@ -0,0 +1,197 @@
+"""Background job queue for long-running queries.
+
+Queries are submitted as jobs and processed by a bounded thread pool, so a
+Streamlit rerun or a closed tab does not lose the work and the number of
+concurrent Ollama calls stays bounded. Admission control rejects new jobs when
+the queue is full or a browser session already has too many jobs in flight
+(there are no user accounts: `user_id` is the session's random ID). Finished
+jobs are persisted to disk and can be fetched later by ID; they are deleted
+after `OPF_JOB_TTL_HOURS`, and only the newest `OPF_MAX_STORED_JOBS` are kept.
+"""
+import os
+import json
+import time
+import uuid
+import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+JOB_DIR = os.environ.get("OPF_JOB_DIR", "jobs")
+JOB_WORKERS = int(os.environ.get("OPF_JOB_WORKERS", "4"))
+MAX_QUEUED_JOBS = int(os.environ.get("OPF_MAX_QUEUED_JOBS", "32"))
+MAX_JOBS_PER_SESSION = int(os.environ.get("OPF_MAX_JOBS_PER_SESSION", "2"))
+JOB_TTL_HOURS = float(os.environ.get("OPF_JOB_TTL_HOURS", "168"))
+MAX_STORED_JOBS = int(os.environ.get("OPF_MAX_STORED_JOBS", "1000"))
+
+ACTIVE_STATES = ("queued", "running")
+
+
+class JobRejected(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, user_id, description=""):
+        self.id = uuid.uuid4().hex[:12]
+        self.user_id = user_id
+        self.description = description
+        self.status = "queued"
+        self.stage = "queued"
+        self.partial = {}
+        self.error = None
+        self.output = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    def update(self, stage, text=None):
+        # Called from the worker thread; the UI polls these fields
+        self.stage = stage
+        if text is not None:
+            self.partial[stage] = text
+
+    def meta(self):
+        return {
+            "id": self.id, "user_id": self.user_id, "description": self.description,
+            "status": self.status, "stage": self.stage, "error": self.error,
+            "created": self.created, "started": self.started, "finished": self.finished,
+        }
+
+
+class JobQueue:
+    def __init__(self, job_dir=JOB_DIR, workers=JOB_WORKERS,
+                 max_queued=MAX_QUEUED_JOBS, max_per_session=MAX_JOBS_PER_SESSION,
+                 ttl_hours=JOB_TTL_HOURS, max_stored=MAX_STORED_JOBS):
+        self.job_dir = job_dir
+        self.max_queued = max_queued
+        self.max_per_session = max_per_session
+        self.ttl_seconds = ttl_hours * 3600
+        self.max_stored = max_stored
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        # Finishing a job and pruning don't interleave, so prune sees final meta files
+        self._prune_lock = threading.Lock()
+        os.makedirs(job_dir, exist_ok=True)
+        self.prune()
+
+    def submit(self, user_id, fn, *args, description="", **kwargs):
+        """Queues `fn(job, *args, **kwargs)`; its return value becomes `job.output`."""
+        with self._lock:
+            # Finished jobs stay retrievable from disk; keep memory bounded
+            cutoff = time.time() - 3600
+            for old_id in [i for i, j in self._jobs.items() if j.finished and j.finished < cutoff]:
+                del self._jobs[old_id]
+            active = [j for j in self._jobs.values() if j.status in ACTIVE_STATES]
+            if len(active) >= self.max_queued:
+                raise JobRejected("The server is busy, please try again shortly.")
+            if sum(j.user_id == user_id for j in active) >= self.max_per_session:
+                raise JobRejected(f"This session already has {self.max_per_session} queries running.")
+            job = Job(user_id, description)
+            self._jobs[job.id] = job
+        self._write_meta(job)
+        self._pool.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def _run(self, job, fn, args, kwargs):
+        job.status, job.started = "running", time.time()
+        self._write_meta(job)
+        try:
+            job.output = fn(job, *args, **kwargs)
+            job.status = "done"
+            with open(self._path(job.id, "pkl"), "wb") as f:
+                pickle.dump(job.output, f, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            job.status, job.error = "failed", str(e)
+        finally:
+            with self._prune_lock:
+                job.finished = time.time()
+                job.stage = job.status
+                self._write_meta(job)
+        self.prune()
+
+    def _path(self, job_id, ext):
+        return os.path.join(self.job_dir, f"{job_id}.{ext}")
+
+    def _write_meta(self, job):
+        try:
+            with open(self._path(job.id, "json"), "w") as f:
+                json.dump(job.meta(), f)
+        except OSError as e:
+            print(f"[Jobs] Could not persist job {job.id}: {e}")
+
+    def prune(self):
+        """Deletes persisted jobs older than the TTL, then the oldest beyond `max_stored`."""
+        with self._prune_lock:
+            self._prune()
+
+    def _prune(self):
+        with self._lock:
+            active = {j.id for j in self._jobs.values() if j.finished is None}
+        stored = []
+        for name in os.listdir(self.job_dir):
+            job_id, ext = os.path.splitext(name)
+            if ext != ".json" or job_id in active:
+                continue
+            try:
+                # The meta file is rewritten last when a job finishes
+                stored.append((os.path.getmtime(os.path.join(self.job_dir, name)), job_id))
+            except OSError:
+                continue
+        stored.sort(reverse=True)
+        cutoff = time.time() - self.ttl_seconds
+        for rank, (mtime, job_id) in enumerate(stored):
+            if mtime < cutoff or rank >= self.max_stored:
+                for ext in ("pkl", "json"):
+                    try:
+                        os.remove(self._path(job_id, ext))
+                    except OSError:
+                        pass
+
+    def get(self, job_id):
+        """Returns the live job, or one reloaded from disk (e.g. after a restart)."""
+        with self._lock:
+            if job_id in self._jobs:
+                return self._jobs[job_id]
+        try:
+            with open(self._path(job_id, "json")) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        job = Job(meta["user_id"], meta.get("description", ""))
+        job.__dict__.update({k: v for k, v in meta.items() if k in job.__dict__})
+        if job.status in ACTIVE_STATES:
+            # The process that ran it is gone
+            job.status, job.error = "failed", "Job was interrupted by a server restart."
+        elif job.status == "done":
+            try:
+                with open(self._path(job_id, "pkl"), "rb") as f:
+                    job.output = pickle.load(f)
+            except (OSError, pickle.UnpicklingError) as e:
+                job.status, job.error = "failed", f"Result could not be loaded: {e}"
+        return job
+
+    def list_jobs(self, user_id):
+        with self._lock:
+            jobs = [j for j in self._jobs.values() if j.user_id == user_id]
+        return sorted(jobs, key=lambda j: j.created, reverse=True)
+
+    def close(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+    def stats(self):
+        with self._lock:
+            statuses = [j.status for j in self._jobs.values()]
+        return {status: statuses.count(status) for status in ("queued", "running", "done", "failed")}
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue()
+        return _job_queue
@@ -0,0 +1,132 @@
+"""Vectorized OPF metrics over a whole `FeatureStore`.
+
+Every kernel works on the stacked `[num_samples, num_entities, F]` tensors, so
+a dataset-wide metric is a handful of tensor ops instead of a Python loop over
+`HeteroData` samples. Column indices follow the schema in `config/prompts.py`.
+"""
+import torch
+
+# bus.x / bus.y
+BUS_VMIN, BUS_VMAX = 2, 3
+BUS_VA, BUS_VM = 0, 1
+# generator.x / generator.y
+GEN_PMIN, GEN_PMAX, GEN_QMIN, GEN_QMAX = 2, 3, 5, 6
+GEN_C2, GEN_C1, GEN_C0 = 8, 9, 10
+GEN_PG, GEN_QG = 0, 1
+# load.x
+LOAD_PD, LOAD_QD = 0, 1
+# edge_label of ac_line and transformer: [pt, qt, pf, qf]
+FLOW_PT, FLOW_QT, FLOW_PF, FLOW_QF = 0, 1, 2, 3
+# rate_a/rate_b/rate_c column per branch type
+RATE_COLUMNS = {
+    "ac_line": {"rate_a": 6, "rate_b": 7, "rate_c": 8},
+    "transformer": {"rate_a": 4, "rate_b": 5, "rate_c": 6},
+}
+
+
+def _branch(store, edge_type):
+    return store["bus", edge_type, "bus"]
+
+
+def apparent_power_flow(store, edge_type="ac_line", side="from"):
+    """|S| = sqrt(p² + q²) per sample and branch, `[S, E]`.
+
+    `side` is "from" (pf, qf), "to" (pt, qt) or "max" of both ends.
+    """
+    label = _branch(store, edge_type).edge_label
+    s_from = torch.sqrt(label[..., FLOW_PF] ** 2 + label[..., FLOW_QF] ** 2)
+    if side == "from":
+        return s_from
+    s_to = torch.sqrt(label[..., FLOW_PT] ** 2 + label[..., FLOW_QT] ** 2)
+    if side == "to":
+        return s_to
+    if side == "max":
+        return torch.maximum(s_from, s_to)
+    raise ValueError(f"side must be 'from', 'to' or 'max', got {side!r}")
+
+
+def line_loading(store, edge_type="ac_line", rating="rate_a", side="from"):
+    """Branch loading sqrt(pf² + qf²) / rate_a, `[S, E]`; NaN where the rating is 0."""
+    rate = _branch(store, edge_type).edge_attr[..., RATE_COLUMNS[edge_type][rating]]
+    flow = apparent_power_flow(store, edge_type, side)
+    return torch.where(rate > 0, flow / rate.clamp_min(1e-12), torch.full_like(flow, float("nan")))
+
+
+def overloaded_branches(store, edge_type="ac_line", threshold=1.0, rating="rate_a", side="from"):
+    """Boolean `[S, E]` mask of branches loaded above `threshold` × rating."""
+    return line_loading(store, edge_type, rating, side) > threshold
+
+
+def generator_cost(store, use_solution=True):
+    """c2·pg² + c1·pg + c0 per sample and generator, `[S, G]`.
+
+    Uses the OPF solution pg (`generator.y[..., 0]`) by default, or the
+    scheduled pg (`generator.x[..., 1]`) with `use_solution=False`.
+    """
+    x = store["generator"].x
+    pg = store["generator"].y[..., GEN_PG] if use_solution else x[..., 1]
+    return x[..., GEN_C2] * pg ** 2 + x[..., GEN_C1] * pg + x[..., GEN_C0]
+
+
+def total_generation_cost(store, use_solution=True):
+    """Total generation cost per sample, `[S]`."""
+    return generator_cost(store, use_solution).sum(dim=-1)
+
+
+def voltage_violations(store, tol=0.0):
+    """Boolean `[S, B]` masks `(under, over)` of vm outside [vmin, vmax] ± tol."""
+    vm = store["bus"].y[..., BUS_VM]
+    x = store["bus"].x
+    under = vm < x[..., BUS_VMIN] - tol
+    over = vm > x[..., BUS_VMAX] + tol
+    return under, over
+
+
+def voltage_violation_magnitude(store):
+    """Per-unit distance outside [vmin, vmax] (0 inside the band), `[S, B]`."""
+    vm = store["bus"].y[..., BUS_VM]
+    x = store["bus"].x
+    return (x[..., BUS_VMIN] - vm).clamp_min(0) + (vm - x[..., BUS_VMAX]).clamp_min(0)
+
+
+def generator_limit_violations(store, tol=0.0):
+    """Boolean `[S, G]` masks `(p_violation, q_violation)` of solved pg/qg outside limits."""
+    x, y = store["generator"].x, store["generator"].y
+    p = (y[..., GEN_PG] < x[..., GEN_PMIN] - tol) | (y[..., GEN_PG] > x[..., GEN_PMAX] + tol)
+    q = (y[..., GEN_QG] < x[..., GEN_QMIN] - tol) | (y[..., GEN_QG] > x[..., GEN_QMAX] + tol)
+    return p, q
+
+
+def device_bus_index(store, device="generator"):
+    """Bus index of every generator/load/shunt, `[N]`, from the `<device>_link` edges."""
+    edge_index = store[device, f"{device}_link", "bus"].edge_index
+    bus = torch.empty(edge_index.size(1), dtype=torch.long)
+    bus[edge_index[0]] = edge_index[1]
+    return bus
+
+
+def generator_bus_index(store):
+    """Bus index of every generator, `[G]`."""
+    return device_bus_index(store, "generator")
+
+
+def aggregate_to_bus(store, values, device="generator"):
+    """Sums per-device values `[S, N]` onto their buses, `[S, num_buses]`."""
+    num_buses = store["bus"].x.size(-2)
+    out = torch.zeros(values.shape[:-1] + (num_buses,), dtype=values.dtype)
+    return out.index_add_(-1, device_bus_index(store, device), values)
+
+
+def generation_per_bus(store, column=GEN_PG):
+    """Solved generation (pg by default, qg with column=1) summed per bus, `[S, B]`."""
+    return aggregate_to_bus(store, store["generator"].y[..., column], "generator")
+
+
+def load_per_bus(store, column=LOAD_PD):
+    """Load demand (pd by default, qd with column=1) summed per bus, `[S, B]`."""
+    return aggregate_to_bus(store, store["load"].x[..., column], "load")
+
+
+def slack_bus_index(store):
+    """Indices of reference/slack buses (bus_type == 3), taken from the first sample."""
+    return (store["bus"].x[0, :, 1] == 3).nonzero(as_tuple=True)[0]
@@ -1,37 +1,188 @@
+import os
+import json
+import time
+import threading
 import requests
-from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
-from peft import PeftModel
+from requests.adapters import HTTPAdapter
 
-def query_ollama(prompt, model="deepseek-coder:33b-instruct"):
+PHI2_BASE_MODEL = "microsoft/phi-2"
+PHI2_ADAPTER_MODEL = "STEM-AI-mtl/phi-2-electrical-engineering"
+
+OLLAMA_URL = os.environ.get("OLLAMA_URL", "http://localhost:11434")
+OLLAMA_TIMEOUT = (10, 180)  # (connect, read between streamed chunks)
+# Keeps the model (and its cached prompt prefix) loaded between queries
+OLLAMA_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m")
+
+_session = None
+
+def get_ollama_session():
+    # One keep-alive connection pool shared by every session/thread in the process
+    global _session
+    if _session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _session = session
+    return _session
+
+def find_code_end(text):
+    # Index just past the closing </code> tag or closing ``` fence, if present
+    end = text.find("</code>")
+    if end != -1:
+        return end + len("</code>")
+    opening = text.find("```")
+    if opening != -1:
+        closing = text.find("```", opening + 3)
+        if closing != -1:
+            return closing + 3
+    return None
+
+def stream_ollama(prompt, model="deepseek-coder:33b-instruct", stop_at_code_end=False, options=None, stats=None, cancel=None, timeout=OLLAMA_TIMEOUT):
+    """Yields response tokens from Ollama as they are generated.
+
+    With `stop_at_code_end`, the stream is closed as soon as the generated code
+    block is complete; dropping the connection makes Ollama stop decoding.
+    Final Ollama counters (eval_count, eval_duration, ...) are written to `stats`.
+    Setting the `cancel` event aborts the stream the same way.
+    """
+    payload = {"model": model, "prompt": prompt, "stream": True, "keep_alive": OLLAMA_KEEP_ALIVE}
+    if options:
+        payload["options"] = options
+
+    text = ""
+    with get_ollama_session().post(
+        f"{OLLAMA_URL}/api/generate", json=payload, stream=True, timeout=timeout
+    ) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if cancel is not None and cancel.is_set():
+                return
+            if not line:
+                continue
+            chunk = json.loads(line)
+            token = chunk.get("response", "")
+            if token:
+                previous = len(text)
+                text += token
+                end = find_code_end(text) if stop_at_code_end else None
+                if end is not None:
+                    if end > previous:
+                        yield token[:end - previous]
+                    if stats is not None:
+                        stats["stopped_early"] = True
+                    return
+                yield token
+            if chunk.get("done"):
+                if stats is not None:
+                    stats.update({
+                        k: chunk[k] for k in
+                        ("eval_count", "eval_duration", "prompt_eval_count", "prompt_eval_duration", "total_duration")
+                        if k in chunk
+                    })
+                return
+
+def query_ollama(prompt, model="deepseek-coder:33b-instruct", stop_at_code_end=False, on_token=None, options=None, stats=None, cancel=None, timeout=OLLAMA_TIMEOUT):
+    text = ""
+    try:
+        for token in stream_ollama(prompt, model, stop_at_code_end=stop_at_code_end, options=options, stats=stats, cancel=cancel, timeout=timeout):
+            text += token
+            if on_token is not None:
+                on_token(text)
+        return text.strip()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"[Ollama Error] {e}")
+        return f"ERROR: {str(e)}"
+
+def embed_ollama(text, model):
     try:
-        response = requests.post(
-            "http://localhost:11434/api/generate",
-            json={
-                "model": model,
-                "prompt": prompt,
-                "stream": False
-            },
-            timeout=180
+        response = get_ollama_session().post(
+            f"{OLLAMA_URL}/api/embeddings",
+            json={"model": model, "prompt": text},
+            timeout=OLLAMA_TIMEOUT
         )
         response.raise_for_status()
-        data = response.json()
-        return data.get("response", "").strip()  
-    except requests.exceptions.RequestException as e:
+        return response.json().get("embedding") or None
+    except (requests.exceptions.RequestException, ValueError) as e:
         print(f"[Ollama Error] {e}")
-        return f"ERROR: {str(e)}"
+        return None
 
-def load_phi2_electrical_model():
-    base_model = "microsoft/phi-2"
-    adapter_model = "STEM-AI-mtl/phi-2-electrical-engineering"
+# ✅ Model tier per pipeline stage; blank means the model chosen in the UI
+STAGE_MODELS = {
+    "code": os.environ.get("OPF_CODE_MODEL", ""),
+    "fix": os.environ.get("OPF_FIX_MODEL", ""),
+    "summary": os.environ.get("OPF_SUMMARY_MODEL", ""),
+}
+# Seconds to wait for the next streamed chunk (including the first) before falling back
+STAGE_TIMEOUTS = {
+    "code": float(os.environ.get("OPF_CODE_TIMEOUT", "180")),
+    "fix": float(os.environ.get("OPF_FIX_TIMEOUT", "120")),
+    "summary": float(os.environ.get("OPF_SUMMARY_TIMEOUT", "30")),
+}
+# Stage model name that routes to the in-process Phi-2 instead of Ollama
+LOCAL_PHI2 = "phi2"
 
-    tokenizer = AutoTokenizer.from_pretrained(base_model, trust_remote_code=True)
-    base = AutoModelForCausalLM.from_pretrained(base_model, device_map="auto", trust_remote_code=True)
-    model = PeftModel.from_pretrained(base, adapter_model)
-    model.eval()
-    return model, tokenizer
+class LLMRouter:
+    """Sends each pipeline stage to its model tier.
+
+    When the tier model errors or times out, the stage is retried on the
+    default model (the one chosen in the UI). Besides Ollama models, local
+    generators such as the already loaded Phi-2 can be registered by name.
+    """
 
-def refine_query_with_llm(user_query, model, tokenizer):
-    prompt = f"""
+    def __init__(self, stage_models=None, timeouts=None):
+        self.stage_models = dict(STAGE_MODELS, **(stage_models or {}))
+        self.timeouts = dict(STAGE_TIMEOUTS, **(timeouts or {}))
+        self._local = {}
+
+    def register_local(self, name, generate):
+        # generate(prompt) -> text
+        self._local[name] = generate
+
+    def model_for(self, stage, default_model, overrides=None):
+        return (overrides or {}).get(stage) or self.stage_models.get(stage) or default_model
+
+    def query(self, stage, prompt, default_model, overrides=None, stop_at_code_end=False, on_token=None,
+              options=None, stats=None, cancel=None):
+        """Like `query_ollama`; `stats` also gets the `model` that answered, its
+        `latency_s` and any `fallbacks`."""
+        stats = stats if stats is not None else {}
+        chain = [self.model_for(stage, default_model, overrides)]
+        if default_model not in chain:
+            chain.append(default_model)
+        timeout = (OLLAMA_TIMEOUT[0], self.timeouts.get(stage, OLLAMA_TIMEOUT[1]))
+
+        text = ""
+        for model in chain:
+            start = time.perf_counter()
+            if model in self._local:
+                try:
+                    text = self._local[model](prompt).strip()
+                    if on_token is not None:
+                        on_token(text)
+                except Exception as e:
+                    text = f"ERROR: {e}"
+            else:
+                text = query_ollama(prompt, model, stop_at_code_end, on_token, options, stats, cancel, timeout=timeout)
+            stats.update(model=model, latency_s=time.perf_counter() - start)
+            if not text.startswith("ERROR:") or (cancel is not None and cancel.is_set()):
+                break
+            print(f"[Router] {stage} on {model} failed, falling back: {text}")
+            stats.setdefault("fallbacks", []).append({"model": model, "error": text[len("ERROR:"):].strip()[:200]})
+        return text
+
+_router = None
+_router_lock = threading.Lock()
+
+def get_router():
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = LLMRouter()
+        return _router
+
+# Phi-2 refinement prompt, split so the constant instruction prefix can be KV-cached
+REFINE_PROMPT_PREFIX = """
 ### Instruction:
 You are an Electrical and Power System expert.
 You are given a user query for a particular `dataset` that is a power system simulation with each `data` object in the dataset representing a different loading system, 
@@ -41,14 +192,48 @@ NOTE:-
 - Do not mention accessing the dataset.
 - Do not instruct to print anything and instead just store it in 'result' dictionary.
 - Always give the last instruction to execute the function.
-User Query: {user_query}
+"""
+REFINE_PROMPT_SUFFIX = """User Query: {user_query}
 
 ### Response:
 """
-    inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
-    outputs = model.generate(**inputs, max_new_tokens=300, temperature=1)
-    decoded_output = tokenizer.decode(outputs[0], skip_special_tokens=True)
-    # Clean the response
-    response_part = decoded_output.split("### Response:")[-1].split("```")[0].strip()
-    return response_part
 
+# Dynamic int8 quantization of Linear layers for CPU-only refinement
+PHI2_QUANTIZE = os.environ.get("OPF_PHI2_QUANTIZE") == "1"
+
+def quantize_for_cpu(model):
+    import torch
+    from peft import PeftModel
+    if isinstance(model, PeftModel):
+        model = model.merge_and_unload()
+    model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    model.eval()
+    return model
+
+def load_phi2_electrical_model(base_model=PHI2_BASE_MODEL, adapter_model=PHI2_ADAPTER_MODEL, quantize=PHI2_QUANTIZE):
+    # transformers and peft take seconds to import; only refinement (or a local summary model) needs them
+    from transformers import AutoTokenizer, AutoModelForCausalLM
+    from peft import PeftModel
+    tokenizer = AutoTokenizer.from_pretrained(base_model, trust_remote_code=True)
+    base = AutoModelForCausalLM.from_pretrained(base_model, device_map="auto", trust_remote_code=True)
+    model = PeftModel.from_pretrained(base, adapter_model)
+    model.eval()
+    if quantize and model.device.type == "cpu":
+        model = quantize_for_cpu(model)
+    return model, tokenizer
+
+_local_generate_lock = threading.Lock()
+
+def generate_local(model, tokenizer, prompt, max_new_tokens=80, stop="</one-line-summary>"):
+    # Greedy decoding on a local HF model, e.g. Phi-2 for one-line summaries
+    input_ids = tokenizer(prompt, return_tensors="pt").input_ids
+    # Keep the end of the prompt (where the answer is cued) if it exceeds the context
+    limit = getattr(model.config, "max_position_embeddings", 2048) - max_new_tokens
+    input_ids = input_ids[:, -limit:].to(model.device)
+    with _local_generate_lock:
+        outputs = model.generate(
+            input_ids=input_ids, attention_mask=input_ids.new_ones(input_ids.shape),
+            max_new_tokens=max_new_tokens, do_sample=False, pad_token_id=tokenizer.eos_token_id,
+        )
+    text = tokenizer.decode(outputs[0, input_ids.shape[1]:], skip_special_tokens=True)
+    return text.split(stop)[0].strip()
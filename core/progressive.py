@@ -0,0 +1,177 @@
+"""Approximate-first execution on growing, stratified slices of a dataset.
+
+Samples are put in a random order that is stratified by total system load, so
+every prefix of the order covers light and heavy loading conditions in
+proportion. Generated code runs on the first prefix for a quick answer, then on
+progressively longer prefixes until the whole dataset has been processed.
+
+Confidence intervals for float scalars in `result` come from re-running the
+code on a few disjoint, equally stratified groups of the slice (batch means);
+integer and index-like values (argmax, ids) get none. While a slice runs,
+sample indices in `result` are positions in the slice; `to_dataset_indices`
+maps them back.
+Values that scale with the number of samples (sums, counts) are detected by
+comparing the group results with the slice result and are extrapolated to the
+full dataset; for other statistics (min/max, quantiles) the interval only
+reflects sampling noise.
+"""
+import os
+import re
+import math
+import numbers
+
+import numpy as np
+import torch
+
+FIRST_STAGE_SAMPLES = int(os.environ.get("OPF_PROGRESSIVE_MIN_SAMPLES", "64"))
+FIRST_STAGE_FRACTION = float(os.environ.get("OPF_PROGRESSIVE_FRACTION", "0.02"))
+STAGE_GROWTH = int(os.environ.get("OPF_PROGRESSIVE_GROWTH", "4"))
+CI_GROUPS = 5
+NUM_STRATA = 5
+# Two-sided 95% Student-t quantiles by degrees of freedom
+T_95 = {1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365, 8: 2.306, 9: 2.262}
+# Result keys whose values are indices rather than aggregates
+INDEX_KEY = re.compile(r"(^|_)(idx|index|indices|id|ids|argmax|argmin|arg)($|_)", re.IGNORECASE)
+# Result keys holding sample indices, e.g. "worst_sample" or "sample_idx" (but not "num_samples")
+SAMPLE_KEY = re.compile(r"sample", re.IGNORECASE)
+COUNT_KEY = re.compile(r"(^|_)(num|n|count|counts|total|size|len)($|_)", re.IGNORECASE)
+
+
+def load_strata(store, num_strata=NUM_STRATA):
+    # Quantile bins of total active demand per sample
+    if store is None or "load" not in store:
+        return None
+    total_load = np.asarray(store["load"].x[..., 0].sum(-1), dtype=np.float64)
+    edges = np.quantile(total_load, np.linspace(0, 1, num_strata + 1)[1:-1])
+    return np.searchsorted(edges, total_load, side="right")
+
+
+def sample_order(num_samples, strata=None, seed=0):
+    """Random permutation of the samples whose prefixes are stratified."""
+    rng = np.random.default_rng(seed)
+    if strata is None:
+        return rng.permutation(num_samples)
+    # Shuffle within each stratum, then interleave strata by relative rank
+    position = np.empty(num_samples, dtype=np.float64)
+    for label in np.unique(strata):
+        members = np.flatnonzero(strata == label)
+        position[rng.permutation(members)] = (np.arange(len(members)) + rng.random()) / len(members)
+    return np.argsort(position, kind="stable")
+
+
+def stage_sizes(num_samples, first=None, growth=STAGE_GROWTH):
+    first = first or max(FIRST_STAGE_SAMPLES, int(num_samples * FIRST_STAGE_FRACTION))
+    sizes = []
+    size = min(first, num_samples)
+    while size < num_samples:
+        sizes.append(size)
+        size *= max(growth, 2)
+    return sizes + [num_samples]
+
+
+def _scalar(value):
+    # Float-valued scalars only: integers are counts or indices, not estimates
+    if isinstance(value, float):
+        return value
+    if isinstance(value, np.floating):
+        return float(value)
+    if isinstance(value, torch.Tensor) and value.numel() == 1 and value.is_floating_point():
+        return float(value.item())
+    if isinstance(value, np.ndarray) and value.size == 1 and np.issubdtype(value.dtype, np.floating):
+        return float(value.reshape(-1)[0])
+    return None
+
+
+def scalar_leaves(result, prefix=""):
+    """`{path: float}` for every float aggregate in a (nested) result dict, skipping index-like keys."""
+    leaves = {}
+    if not isinstance(result, dict):
+        return leaves
+    for key, value in result.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            leaves.update(scalar_leaves(value, path + "."))
+            continue
+        if INDEX_KEY.search(str(key)):
+            continue
+        scalar = _scalar(value)
+        if scalar is not None and math.isfinite(scalar):
+            leaves[path] = scalar
+    return leaves
+
+
+def confidence_intervals(run, indices, slice_result, num_total, groups=CI_GROUPS):
+    """95% intervals for the scalars of `slice_result`, computed on `indices`.
+
+    `run(indices)` executes the generated code on those samples and returns its
+    `result`. Returns `{path: {"estimate", "low", "high", "extrapolated"}}`.
+    """
+    if len(indices) < 2 * groups:
+        return {}
+    point = scalar_leaves(slice_result)
+    if not point:
+        return {}
+    replicates = [scalar_leaves(run(indices[g::groups])) for g in range(groups)]
+
+    intervals = {}
+    for path, value in point.items():
+        values = [r[path] for r in replicates if path in r]
+        if len(values) < 2:
+            continue
+        group_mean = sum(values) / len(values)
+        # A sum or count over samples is ~groups times larger on the full slice
+        extrapolated = value != 0 and abs(group_mean * groups - value) < abs(group_mean - value)
+        scale = num_total / len(indices) if extrapolated else 1.0
+        if extrapolated:
+            values = [v * groups for v in values]
+        sd = float(np.std(values, ddof=1))
+        half_width = T_95.get(len(values) - 1, 1.96) * sd / math.sqrt(len(values))
+        intervals[path] = {
+            "estimate": value * scale,
+            "low": (value - half_width) * scale,
+            "high": (value + half_width) * scale,
+            "extrapolated": extrapolated,
+        }
+    return intervals
+
+
+def _is_sample_key(key):
+    key = str(key)
+    return bool(SAMPLE_KEY.search(key)) and not COUNT_KEY.search(key)
+
+
+def _map_positions(value, lookup):
+    # Integer positions in the slice -> dataset indices; anything else is left alone
+    n = len(lookup)
+    if isinstance(value, (bool, np.bool_)):
+        return value
+    if isinstance(value, (numbers.Integral, np.integer)):
+        return int(lookup[int(value)]) if 0 <= value < n else value
+    if isinstance(value, torch.Tensor) and not value.is_floating_point() and value.dtype != torch.bool:
+        if value.numel() and (value.min() < 0 or value.max() >= n):
+            return value
+        return lookup.to(value.device)[value.long()].to(value.dtype)
+    if isinstance(value, np.ndarray) and np.issubdtype(value.dtype, np.integer):
+        if value.size and (value.min() < 0 or value.max() >= n):
+            return value
+        return lookup.numpy()[value].astype(value.dtype)
+    if isinstance(value, (list, tuple)) and value and all(isinstance(v, (numbers.Integral, np.integer)) for v in value):
+        return type(value)(_map_positions(v, lookup) for v in value)
+    return value
+
+
+def to_dataset_indices(result, indices):
+    """Copy of `result` with sample indices (under keys like "worst_sample") mapped
+    from positions in the slice `indices` back to dataset indices."""
+    if not isinstance(result, dict):
+        return result
+    lookup = torch.as_tensor(np.asarray(indices), dtype=torch.long)
+    mapped = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            mapped[key] = to_dataset_indices(value, indices)
+        elif _is_sample_key(key):
+            mapped[key] = _map_positions(value, lookup)
+        else:
+            mapped[key] = value
+    return mapped
@@ -0,0 +1,147 @@
+import copy
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+from core.model import REFINE_PROMPT_PREFIX, REFINE_PROMPT_SUFFIX
+
+# Text that ends the useful part of a refinement: a code fence or the next section header
+RESPONSE_DELIMITERS = ("```", "###")
+
+
+class _DelimiterStop(StoppingCriteria):
+    # Per-row stop once a delimiter appears in the newly generated text
+    def __init__(self, tokenizer, prompt_length):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids, scores, **kwargs):
+        texts = self.tokenizer.batch_decode(input_ids[:, self.prompt_length:], skip_special_tokens=True)
+        return torch.tensor(
+            [any(d in text for d in RESPONSE_DELIMITERS) for text in texts],
+            dtype=torch.bool, device=input_ids.device,
+        )
+
+
+def clean_response(text):
+    for delimiter in RESPONSE_DELIMITERS:
+        text = text.split(delimiter)[0]
+    return text.strip()
+
+
+class RefinementService:
+    """Batched Phi-2 query refinement with a precomputed instruction prefix.
+
+    The constant instruction preamble is run through the model once and its
+    past-key-values are reused for every request. Queries that arrive within
+    `max_wait` seconds of each other are decoded together in one greedy
+    `generate` call, and decoding stops as soon as each response hits a
+    delimiter.
+    """
+
+    def __init__(self, model, tokenizer, max_batch=8, max_wait=0.05, max_new_tokens=300):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_new_tokens = max_new_tokens
+        if tokenizer.pad_token_id is None:
+            tokenizer.pad_token = tokenizer.eos_token
+
+        self._prefix_ids = tokenizer(REFINE_PROMPT_PREFIX, return_tensors="pt").input_ids.to(model.device)
+        with torch.no_grad():
+            self._prefix_cache = model(self._prefix_ids, use_cache=True).past_key_values
+
+        self._queue = queue.Queue()
+        self._closed = False
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._loop, name="phi2-refiner", daemon=True)
+        self._thread.start()
+
+    def refine(self, user_query, timeout=None):
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Refinement service is closed")
+            self._queue.put((user_query, future))
+        return future.result(timeout=timeout)
+
+    def close(self):
+        """Stops the batching thread once the queued requests are answered.
+
+        The thread holds the model, so an evicted service is only freed after this.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            # Nothing is queued after the sentinel (see refine)
+            self._queue.put(None)
+
+    def _loop(self):
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            try:
+                responses = self._generate([query for query, _ in batch])
+                for (_, future), response in zip(batch, responses):
+                    future.set_result(response)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+
+    def _generate(self, queries):
+        device = self.model.device
+        suffixes = [
+            self.tokenizer(REFINE_PROMPT_SUFFIX.format(user_query=q), add_special_tokens=False).input_ids
+            for q in queries
+        ]
+        # Layout per row: [cached prefix][padding][suffix]; the attention mask hides
+        # the padding and position ids follow the mask, so the prefix KV stays valid.
+        width = max(len(ids) for ids in suffixes)
+        prefix_len = self._prefix_ids.size(1)
+        input_ids = torch.full((len(queries), prefix_len + width), self.tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros_like(input_ids)
+        input_ids[:, :prefix_len] = self._prefix_ids[0].cpu()
+        attention_mask[:, :prefix_len] = 1
+        for row, ids in enumerate(suffixes):
+            input_ids[row, prefix_len + width - len(ids):] = torch.tensor(ids)
+            attention_mask[row, prefix_len + width - len(ids):] = 1
+        input_ids, attention_mask = input_ids.to(device), attention_mask.to(device)
+
+        cache = copy.deepcopy(self._prefix_cache)
+        if len(queries) > 1:
+            cache.batch_repeat_interleave(len(queries))
+
+        with torch.no_grad():
+            outputs = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                past_key_values=cache,
+                max_new_tokens=self.max_new_tokens,
+                do_sample=False,
+                pad_token_id=self.tokenizer.pad_token_id,
+                stopping_criteria=StoppingCriteriaList([_DelimiterStop(self.tokenizer, input_ids.size(1))]),
+            )
+        texts = self.tokenizer.batch_decode(outputs[:, input_ids.size(1):], skip_special_tokens=True)
+        return [clean_response(text) for text in texts]
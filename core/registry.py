@@ -0,0 +1,155 @@
+import os
+import threading
+from collections import OrderedDict
+
+# Process-wide budget for cached datasets/models, shared by every Streamlit session
+DEFAULT_BUDGET_GB = float(os.environ.get("OPF_RESOURCE_BUDGET_GB", "16"))
+
+
+def estimate_nbytes(obj, _seen=None):
+    """Rough resident size of tensors reachable from `obj` (datasets, models, tuples)."""
+    # Only called on loaded resources, which have imported torch already
+    import torch
+
+    seen = _seen if _seen is not None else set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    if isinstance(obj, torch.Tensor):
+        return obj.numel() * obj.element_size()
+    if isinstance(obj, torch.nn.Module):
+        return sum(estimate_nbytes(t, seen) for t in list(obj.parameters()) + list(obj.buffers()))
+    if isinstance(obj, (list, tuple, set)):
+        return sum(estimate_nbytes(v, seen) for v in obj)
+    if isinstance(obj, dict):
+        return sum(estimate_nbytes(v, seen) for v in obj.values())
+
+    # InMemoryDataset keeps everything in one collated HeteroData
+    data = getattr(obj, "_data", None)
+    if data is not None and hasattr(data, "stores"):
+        return sum(estimate_nbytes(dict(store), seen) for store in data.stores)
+    return 0
+
+
+class ResourceRegistry:
+    """Thread-safe, process-wide LRU cache of expensive resources.
+
+    Entries are keyed by tuples such as `("dataset", case_name)` or
+    `("phi2", base_model, adapter_model)`. Concurrent requests for the same key
+    wait on a single load. When the total estimated size exceeds the budget,
+    least recently used entries are dropped (sessions still holding a
+    reference keep theirs alive until they let go).
+    """
+
+    def __init__(self, budget_bytes=None):
+        self.budget_bytes = int(budget_bytes if budget_bytes is not None else DEFAULT_BUDGET_GB * 1024 ** 3)
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._on_evict = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._warmup_started = False
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def get(self, key, loader, sizer=estimate_nbytes, on_evict=None):
+        """The cached value of `key`, loading it with `loader()` on first use.
+
+        `sizer(value)` gives its size for the budget; `on_evict(value)` is
+        called when the entry is dropped, e.g. to stop a worker thread.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        with self._key_lock(key):
+            # Another thread may have finished loading while we waited
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    return self._entries[key]
+
+            value = loader()
+            size = sizer(value)
+            with self._lock:
+                self._entries[key] = value
+                self._sizes[key] = size
+                if on_evict is not None:
+                    self._on_evict[key] = on_evict
+                evicted = self._evict_over_budget(keep=key)
+            _run_evict_callbacks(evicted)
+            return value
+
+    def _pop(self, key):
+        # Caller holds the lock; returns (value, on_evict) for _run_evict_callbacks
+        self._sizes.pop(key, None)
+        return self._entries.pop(key, None), self._on_evict.pop(key, None)
+
+    def _evict_over_budget(self, keep):
+        evicted = []
+        while sum(self._sizes.values()) > self.budget_bytes:
+            victim = next((k for k in self._entries if k != keep), None)
+            if victim is None:
+                break
+            print(f"[Registry] Evicting {victim} ({self._sizes[victim] / 1024 ** 2:.0f} MB)")
+            evicted.append(self._pop(victim))
+        return evicted
+
+    def evict(self, key):
+        with self._lock:
+            evicted = [self._pop(key)] if key in self._entries else []
+        _run_evict_callbacks(evicted)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": {str(k): self._sizes[k] for k in self._entries},
+                "used_bytes": sum(self._sizes.values()),
+                "budget_bytes": self.budget_bytes,
+            }
+
+    def warm_up(self, jobs):
+        """Loads `(key, loader[, sizer[, on_evict]])` entries once per process in a background thread."""
+        with self._lock:
+            if self._warmup_started or not jobs:
+                return
+            self._warmup_started = True
+
+        def _run():
+            for key, loader, *options in jobs:
+                try:
+                    self.get(key, loader, *options)
+                except Exception as e:
+                    print(f"[Registry] Warm-up of {key} failed: {e}")
+
+        threading.Thread(target=_run, name="registry-warmup", daemon=True).start()
+
+
+def _run_evict_callbacks(evicted):
+    # Outside the registry lock: a callback may block or use the registry
+    for value, on_evict in evicted:
+        if on_evict is not None:
+            try:
+                on_evict(value)
+            except Exception as e:
+                print(f"[Registry] Cleanup of an evicted entry failed: {e}")
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ResourceRegistry()
+        return _registry
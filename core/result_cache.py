@@ -0,0 +1,299 @@
+"""Disk cache of execution results keyed by normalized code, case and sample slice.
+
+Code is normalized through its AST (formatting and comments don't matter)
+before hashing. Results are stored packed (figures as PNG bytes) in pickle
+files indexed by SQLite, with LRU eviction once `OPF_RESULT_CACHE_MB` is
+exceeded.
+
+Code whose body is a loop over `dataset` followed by more statements is split
+into a map stage (everything up to the end of the last such loop) and a reduce
+stage. Whether the split is safe is decided from the AST before anything runs:
+the map stage must not draw figures, and the variables the reduce stage reads
+from it must be plain data. On a miss the code still runs once, as a whole;
+a snapshot of those variables taken where the reduce stage starts is cached
+on its own, so a fix that only touches the reduce/plotting lines reruns just
+those lines.
+"""
+import os
+import ast
+import time
+import pickle
+import sqlite3
+import hashlib
+import numbers
+import builtins
+import threading
+
+import numpy as np
+import torch
+
+from core.serialize import pack_result
+
+CACHE_DIR = os.environ.get("OPF_RESULT_CACHE_DIR", os.path.join(".cache", "results"))
+MAX_MB = float(os.environ.get("OPF_RESULT_CACHE_MB", "512"))
+# Globals the snippet gets from build_exec_scope, never captured from the map stage
+SCOPE_NAMES = {"dataset", "store", "opf", "torch", "st"}
+# A map stage that touches any of these may create figures, which can't be cached as values
+PLOT_NAMES = {"plt", "pyplot", "matplotlib", "sns", "seaborn", "figure", "subplots", "add_subplot", "gca", "gcf"}
+NAMESPACE_KEY = "__opf_map_namespace__"
+# Prepended to the first reduce statement, so the map stage's variables are
+# snapshotted where the reduce stage starts without shifting line numbers
+CAPTURE_PREFIX = (
+    'result["%s"] = __import__("core.result_cache", fromlist=["capture_namespace"])'
+    '.capture_namespace(globals(), %%r); ' % NAMESPACE_KEY
+)
+
+
+def normalize_code(code):
+    try:
+        return ast.dump(ast.parse(code), annotate_fields=False, include_attributes=False)
+    except SyntaxError:
+        return code.strip()
+
+
+def code_hash(code):
+    return hashlib.sha256(normalize_code(code).encode("utf-8")).hexdigest()
+
+
+def slice_key(num_samples, indices=None):
+    # The full dataset, or a hash of the exact sample indices
+    if indices is None:
+        return f"all:{num_samples}"
+    digest = hashlib.sha256(",".join(str(int(i)) for i in indices).encode()).hexdigest()[:16]
+    return f"{len(indices)}:{digest}"
+
+
+def _iterates_dataset(stmt):
+    return isinstance(stmt, ast.For) and any(
+        isinstance(n, ast.Name) and n.id == "dataset" for n in ast.walk(stmt.iter)
+    )
+
+
+def _snapshot(value):
+    # A detached copy of plain data: tensors, arrays, numbers, strings and builtin containers of them
+    if isinstance(value, torch.Tensor):
+        return value.detach().clone()
+    if isinstance(value, np.ndarray):
+        return np.array(value, copy=True)
+    if value is None or isinstance(value, (numbers.Number, str, bytes, np.generic)):
+        return value
+    if type(value) in (list, tuple, set, frozenset):
+        return type(value)(_snapshot(v) for v in value)
+    if type(value) is dict:
+        return {k: _snapshot(v) for k, v in value.items()}
+    raise TypeError(f"{type(value).__name__} is not plain data")
+
+
+def capture_namespace(scope, names):
+    """Copies of the globals `names`, or None if one is missing or not plain data."""
+    try:
+        return {name: _snapshot(scope[name]) for name in names}
+    except (KeyError, TypeError):
+        return None
+
+
+def _names(nodes, ctx):
+    return {
+        n.id for node in nodes for n in ast.walk(node)
+        if isinstance(n, ast.Name) and isinstance(n.ctx, ctx)
+    }
+
+
+def _defined_names(stmt):
+    # Names bound by an import or a function/class definition
+    if isinstance(stmt, (ast.Import, ast.ImportFrom)):
+        return {(alias.asname or alias.name).split(".")[0] for alias in stmt.names}
+    return {stmt.name}
+
+
+def _draws_figures(stmts):
+    # Importing pyplot is fine (imports are repeated in the reduce stage), using it is not
+    for stmt in stmts:
+        if isinstance(stmt, (ast.Import, ast.ImportFrom)):
+            continue
+        for node in ast.walk(stmt):
+            if isinstance(node, ast.Name) and node.id in PLOT_NAMES:
+                return True
+            if isinstance(node, ast.Attribute) and node.attr in PLOT_NAMES:
+                return True
+    return False
+
+
+def split_map_reduce(code):
+    """`(map_code, reduce_code, names)` or None when the code can't be split safely.
+
+    `names` are the map-stage variables the reduce stage reads (its free
+    variables that the map stage binds). The split is refused when the map
+    stage draws figures, rebinds `result` or ends right before a compound
+    statement (where the capture can't be prepended). Both stages keep the
+    original line numbers (other lines are blanked), so errors point at the
+    same lines as in the full code. Imports and function/class definitions
+    from the map stage are repeated in the reduce stage since they are not
+    captured as variables.
+    """
+    try:
+        body = ast.parse(code).body
+    except SyntaxError:
+        return None
+    loops = [i for i, stmt in enumerate(body) if _iterates_dataset(stmt)]
+    if not loops or loops[-1] == len(body) - 1:
+        return None
+    map_stmts, reduce_stmts = body[:loops[-1] + 1], body[loops[-1] + 1:]
+    if _draws_figures(map_stmts) or "result" in _names(map_stmts, (ast.Store, ast.Del)):
+        return None
+    if not isinstance(reduce_stmts[0], (ast.Expr, ast.Assign, ast.AugAssign, ast.AnnAssign, ast.Delete,
+                                        ast.Pass, ast.Assert, ast.Import, ast.ImportFrom)):
+        return None
+
+    lines = code.splitlines()
+    split_line = body[loops[-1]].end_lineno
+    keep, copied = set(range(split_line, len(lines))), set()
+    for stmt in map_stmts:
+        if isinstance(stmt, (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.ClassDef)):
+            start = min([stmt.lineno] + [d.lineno for d in getattr(stmt, "decorator_list", [])])
+            keep.update(range(start - 1, stmt.end_lineno))
+            copied |= _defined_names(stmt)
+    map_code = "\n".join(lines[:split_line])
+    reduce_code = "\n".join(line if i in keep else "" for i, line in enumerate(lines))
+
+    # Free variables of the reduce stage (copied definitions included) bound by the map stage
+    bound = _names(map_stmts, ast.Store) - copied - SCOPE_NAMES - set(dir(builtins))
+    names = _names(ast.parse(reduce_code).body, ast.Load) & bound
+    if "result" in _names(map_stmts, ast.Load):
+        names.add("result")
+    return map_code, reduce_code, sorted(names)
+
+
+def _with_capture(code, names):
+    # The code as a whole, snapshotting `names` right before the first reduce statement
+    body = ast.parse(code).body
+    loop = max(i for i, stmt in enumerate(body) if _iterates_dataset(stmt))
+    lines = code.splitlines()
+    first = body[loop + 1].lineno - 1
+    lines[first] = CAPTURE_PREFIX % (names,) + lines[first]
+    return "\n".join(lines)
+
+
+class ResultCache:
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=MAX_MB * 1024 ** 2):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS results (
+                    key TEXT PRIMARY KEY, kind TEXT, case_name TEXT,
+                    size INTEGER, created REAL, last_used REAL, hits INTEGER DEFAULT 0
+                )
+            """)
+
+    def _connect(self):
+        return sqlite3.connect(os.path.join(self.cache_dir, "index.sqlite"), timeout=10)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pkl")
+
+    def key(self, code, case_name, num_samples, indices=None, kind="result"):
+        parts = [kind, code_hash(code), case_name, slice_key(num_samples, indices)]
+        return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                value = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        with self._connect() as conn:
+            conn.execute("UPDATE results SET last_used = ?, hits = hits + 1 WHERE key = ?", (time.time(), key))
+        return value
+
+    def put(self, key, value, kind="result", case_name=None):
+        try:
+            data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return False
+        # A single entry may not take over the whole cache
+        if len(data) > self.max_bytes / 4:
+            return False
+        tmp = self._path(key) + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self._path(key))
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO results (key, kind, case_name, size, created, last_used, hits) "
+                "VALUES (?, ?, ?, ?, ?, ?, 0)",
+                (key, kind, case_name, len(data), now, now),
+            )
+            self._evict(conn)
+        return True
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in conn.execute("SELECT key, size FROM results ORDER BY last_used ASC").fetchall():
+            conn.execute("DELETE FROM results WHERE key = ?", (key,))
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def stats(self):
+        with self._connect() as conn:
+            rows = conn.execute("SELECT kind, COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(hits), 0) FROM results GROUP BY kind")
+            return {kind: {"entries": n, "bytes": size, "hits": hits} for kind, n, size, hits in rows}
+
+
+def execute_memoized(execute, code, case_name, num_samples, indices=None, cache=None, stats=None):
+    """Runs `code` through `execute(code, scope)` unless its result is cached.
+
+    Returns the packed result (figures as PNG bytes). `stats["result_cache"]`
+    is "hit", "map_hit" (only the reduce stage ran) or "miss". The code runs
+    at most once per call, and only the final `result` is packed.
+    """
+    cache = cache or get_result_cache()
+    stats = stats if stats is not None else {}
+    key = cache.key(code, case_name, num_samples, indices)
+    cached = cache.get(key)
+    if cached is not None:
+        stats["result_cache"] = "hit"
+        return cached
+
+    stats["result_cache"] = "miss"
+    split = split_map_reduce(code)
+    if split:
+        map_code, reduce_code, names = split
+        map_key = cache.key(map_code, case_name, num_samples, indices, kind="map")
+        namespace = cache.get(map_key)
+        # An entry captured for a different reduce stage may lack some variables
+        if namespace is not None and set(names) <= set(namespace):
+            stats["result_cache"] = "map_hit"
+            result = execute(reduce_code, {name: namespace[name] for name in names})
+        else:
+            result = execute(_with_capture(code, names), None)
+            if isinstance(result, dict):
+                captured = result.pop(NAMESPACE_KEY, None)
+                if captured is not None:
+                    cache.put(map_key, captured, kind="map", case_name=case_name)
+    else:
+        result = execute(code, None)
+
+    packed = pack_result(result)
+    cache.put(key, packed, kind="result", case_name=case_name)
+    return packed
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    global _result_cache
+    with _result_cache_lock:
+        if _result_cache is None:
+            _result_cache = ResultCache()
+        return _result_cache
@@ -0,0 +1,202 @@
+import os
+import time
+import queue
+import pickle
+import weakref
+import threading
+import multiprocessing as mp
+
+import torch
+
+from core.executor import build_exec_scope, subset_case
+from core.serialize import pack_result
+from core.vectorize import compile_snippet
+from core.dataset_server import SharedOPFDataset, ensure_exported
+from core.feature_store import load_feature_store
+
+DEFAULT_WORKERS = int(os.environ.get("OPF_SANDBOX_WORKERS", str(min(4, os.cpu_count() or 1))))
+DEFAULT_TIMEOUT = float(os.environ.get("OPF_SANDBOX_TIMEOUT", "120"))
+DEFAULT_MAX_RSS_MB = int(os.environ.get("OPF_SANDBOX_MAX_RSS_MB", "4096"))
+
+
+class SandboxError(Exception):
+    pass
+
+
+def _private_rss_bytes(pid):
+    # Private resident memory: pages of the mapped dataset and store files stay
+    # clean, and are not counted, until the snippet writes to them.
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            return sum(int(line.split()[1]) * 1024 for line in f if line.startswith("Private_Dirty:"))
+    except OSError:
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            return 0
+
+
+def _worker_main(conn, cpu, dataset_path, indices, store_path):
+    if cpu is not None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, {cpu})
+        torch.set_num_threads(1)
+
+    # Map the case instead of inheriting it: every worker shares the same file pages
+    dataset = SharedOPFDataset(dataset_path)
+    if indices is not None:
+        # The pool's dataset may be a slice of the exported one
+        dataset._indices = indices
+    store = load_feature_store(dataset, path=store_path) if store_path else None
+
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    while True:
+        try:
+            code, indices, scope = pickle.loads(conn.recv_bytes())
+        except (EOFError, OSError):
+            break
+        exec_scope = build_exec_scope(*subset_case(dataset, store, indices))
+        exec_scope.update(scope or {})
+        start_cpu = time.process_time()
+        try:
+            exec(compile_snippet(code), exec_scope)
+            payload = ("ok", pack_result(exec_scope.get("result", {})))
+        except Exception as e:
+            payload = ("error", str(e))
+        finally:
+            plt.close("all")
+        try:
+            data = pickle.dumps(payload + (time.process_time() - start_cpu,), protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            data = pickle.dumps(("error", f"Result could not be serialized: {e}", 0.0))
+        conn.send_bytes(data)
+
+
+class _Worker:
+    def __init__(self, ctx, cpu, source):
+        self.conn, child_conn = ctx.Pipe()
+        self.cpu = cpu
+        self.process = ctx.Process(target=_worker_main, args=(child_conn, cpu) + source, daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join(timeout=5)
+        self.conn.close()
+
+
+def _shutdown(workers):
+    for worker in workers:
+        try:
+            worker.kill()
+        except Exception:
+            pass
+
+
+def _shared_source(dataset, store):
+    """`(dataset_path, indices, store_path)` of files the workers map.
+
+    Datasets from the daemon, a prepared case or app.load_case are mapped
+    from their files already; anything else is exported once to disk next to
+    its processed files (see `ensure_exported`).
+    """
+    dataset_path = dataset.shared_path if isinstance(dataset, SharedOPFDataset) else ensure_exported(dataset)
+    indices = getattr(dataset, "_indices", None)
+    indices = None if indices is None else [int(i) for i in indices]
+    store_path = None
+    if store is not None:
+        # A subset held in memory is built on disk for the same samples as the dataset
+        store_path = store.path or load_feature_store(dataset).path
+    return dataset_path, indices, store_path
+
+
+class SandboxPool:
+    """Pre-started worker processes that execute generated code.
+
+    Workers come from a forkserver rather than forking the app, which runs job
+    and Streamlit threads (a fork could inherit a lock one of them holds), so
+    they can also be replaced safely from job threads. They memory-map the
+    dataset and feature store files (see `_shared_source`), so all workers
+    share one copy of the case. Each snippet runs with a wall-clock timeout
+    and a cap on the worker's private resident memory; a worker that exceeds
+    either is killed and replaced. Results come back pickled, with figures as
+    PNG bytes.
+    """
+
+    def __init__(self, dataset, store=None, num_workers=DEFAULT_WORKERS,
+                 timeout=DEFAULT_TIMEOUT, max_rss_mb=DEFAULT_MAX_RSS_MB):
+        # Only file paths are kept, so the pool doesn't pin the case in memory
+        self.timeout = timeout
+        self.max_rss_bytes = max_rss_mb * 1024 ** 2
+        self._ctx = mp.get_context("forkserver")
+        # Workers fork from a server that has torch and the executor imported already
+        self._ctx.set_forkserver_preload(["core.sandbox"])
+        self._source = _shared_source(dataset, store)
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else [None]
+        self._workers = []
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._finalizer = weakref.finalize(self, _shutdown, self._workers)
+        for i in range(max(1, num_workers)):
+            worker = _Worker(self._ctx, cpus[i % len(cpus)], self._source)
+            self._workers.append(worker)
+            self._idle.put(worker)
+
+    @property
+    def num_workers(self):
+        return len(self._workers)
+
+    def _replace(self, worker):
+        worker.kill()
+        fresh = _Worker(self._ctx, worker.cpu, self._source)
+        with self._lock:
+            self._workers[self._workers.index(worker)] = fresh
+        return fresh
+
+    def run(self, code, timeout=None, indices=None, scope=None, cancel=None):
+        """Executes `code` in an idle worker and returns `(result, stats)`.
+
+        With `indices`, `dataset` and `store` are restricted to those samples;
+        `scope` holds extra (picklable) globals for the snippet. Setting the
+        `cancel` event kills the worker (it is replaced) and raises SandboxError.
+        """
+        timeout = timeout or self.timeout
+        worker = self._idle.get()
+        start = time.perf_counter()
+        peak_rss = 0
+        try:
+            indices = None if indices is None else [int(i) for i in indices]
+            worker.conn.send_bytes(pickle.dumps((code, indices, scope), protocol=pickle.HIGHEST_PROTOCOL))
+            while not worker.conn.poll(0.05):
+                peak_rss = max(peak_rss, _private_rss_bytes(worker.process.pid))
+                if peak_rss > self.max_rss_bytes:
+                    worker = self._replace(worker)
+                    raise SandboxError(f"Memory limit exceeded ({self.max_rss_bytes // 1024 ** 2} MB)")
+                if cancel is not None and cancel.is_set():
+                    worker = self._replace(worker)
+                    raise SandboxError("Execution cancelled")
+                if time.perf_counter() - start > timeout:
+                    worker = self._replace(worker)
+                    raise SandboxError(f"Execution timed out after {timeout:.0f}s")
+                if not worker.process.is_alive():
+                    worker = self._replace(worker)
+                    raise SandboxError("Execution worker crashed")
+            status, value, cpu_time = pickle.loads(worker.conn.recv_bytes())
+        except (EOFError, OSError) as e:
+            worker = self._replace(worker)
+            raise SandboxError(f"Execution worker failed: {e}")
+        finally:
+            self._idle.put(worker)
+
+        if status == "error":
+            raise SandboxError(value)
+        stats = {"wall_time": time.perf_counter() - start, "cpu_time": cpu_time, "peak_rss": peak_rss}
+        return value, stats
+
+    def close(self):
+        self._finalizer()
@@ -0,0 +1,155 @@
+"""Size-aware conversion of `result` dictionaries for prompts, the UI and downloads.
+
+Small values are kept as plain JSON; large tensors/lists are replaced by a
+summary (shape, dtype, min/max/mean, head) so neither the summary prompt nor
+the browser has to materialize every element.
+"""
+import io
+import json
+import pickle
+import numbers
+
+import numpy as np
+import torch
+
+from core.figures import find_figures, render_figures, is_figure
+
+MAX_INLINE_ELEMENTS = 64
+HEAD_ELEMENTS = 8
+SUMMARY_TOKEN_BUDGET = 1500
+CHARS_PER_TOKEN = 4
+
+
+def _as_array(value):
+    # Tensors, ndarrays and homogeneous numeric/tensor lists as one ndarray, else None
+    if isinstance(value, torch.Tensor):
+        return value.detach().cpu().numpy()
+    if isinstance(value, np.ndarray):
+        return value
+    if isinstance(value, (list, tuple)) and value:
+        if all(isinstance(v, (numbers.Number, np.generic)) and not isinstance(v, bool) for v in value):
+            return np.asarray(value)
+        if all(isinstance(v, torch.Tensor) for v in value):
+            try:
+                return torch.stack([v.detach().cpu() for v in value]).numpy()
+            except RuntimeError:
+                return None
+    return None
+
+
+def array_summary(arr, head=HEAD_ELEMENTS):
+    flat = arr.reshape(-1)
+    summary = {"shape": list(arr.shape), "dtype": str(arr.dtype), "size": int(arr.size)}
+    if arr.size and (np.issubdtype(arr.dtype, np.number) or arr.dtype == np.bool_):
+        numeric = flat.astype(np.float64)
+        finite = numeric[np.isfinite(numeric)]
+        if finite.size:
+            summary.update(min=float(finite.min()), max=float(finite.max()), mean=float(finite.mean()))
+        if finite.size != numeric.size:
+            summary["non_finite"] = int(numeric.size - finite.size)
+    summary["head"] = flat[:head].tolist()
+    return summary
+
+
+def summarize_value(value, max_elements=MAX_INLINE_ELEMENTS, head=HEAD_ELEMENTS):
+    """JSON-safe version of `value` where anything larger than `max_elements` is summarized."""
+    if is_figure(value):
+        return "<figure>"
+    if isinstance(value, (bytes, bytearray)):
+        return f"<{len(value)} bytes>"
+    if isinstance(value, dict):
+        return {str(k): summarize_value(v, max_elements, head) for k, v in value.items()}
+
+    arr = _as_array(value)
+    if arr is not None:
+        if arr.size <= max_elements:
+            return arr.tolist()
+        return array_summary(arr, head)
+    if isinstance(value, (list, tuple)):
+        items = [summarize_value(v, max_elements, head) for v in value[:max_elements]]
+        if len(value) > max_elements:
+            return {"type": "list", "length": len(value), "head": items[:head]}
+        return items
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (str, numbers.Number, bool)) or value is None:
+        return value
+    return repr(value)
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def to_prompt_json(result, token_budget=SUMMARY_TOKEN_BUDGET):
+    """Serializes `result` (minus plots) for the summary prompt within `token_budget`."""
+    result = {k: v for k, v in result.items() if k not in ("plot", "plots")}
+    max_elements, head = MAX_INLINE_ELEMENTS, HEAD_ELEMENTS
+    while True:
+        text = json.dumps(summarize_value(result, max_elements, head), indent=2, default=str)
+        if estimate_tokens(text) <= token_budget or max_elements <= 1:
+            break
+        max_elements, head = max_elements // 4, max(1, head // 2)
+    limit = token_budget * CHARS_PER_TOKEN
+    if len(text) > limit:
+        text = text[:limit] + "\n... (truncated)"
+    return text
+
+
+def large_arrays(result, max_elements=MAX_INLINE_ELEMENTS):
+    """Yields `(path, ndarray)` for every array leaf too large to show inline."""
+    for path, arr in array_leaves(result):
+        if arr.size > max_elements:
+            yield path, arr
+
+
+def array_leaves(value, path=""):
+    if is_figure(value) or isinstance(value, (bytes, bytearray)):
+        return
+    if isinstance(value, dict):
+        for k, v in value.items():
+            if k in ("plot", "plots") and not path:
+                continue
+            yield from array_leaves(v, f"{path}/{k}" if path else str(k))
+        return
+    arr = _as_array(value)
+    if arr is not None:
+        yield path, arr
+    elif isinstance(value, (list, tuple)):
+        for i, v in enumerate(value):
+            yield from array_leaves(v, f"{path}/{i}")
+
+
+def to_npz_bytes(result):
+    """Every array-like leaf of `result`, compressed into an .npz archive."""
+    buf = io.BytesIO()
+    np.savez_compressed(buf, **{path.replace("/", "."): arr for path, arr in array_leaves(result)})
+    return buf.getvalue()
+
+
+def page_rows(arr, page, page_size=100):
+    """Rows `[page * page_size, (page + 1) * page_size)` of `arr` viewed as a 2D table."""
+    table = arr.reshape(arr.shape[0], -1) if arr.ndim > 1 else arr.reshape(-1, 1)
+    start = page * page_size
+    return table[start:start + page_size], (table.shape[0] + page_size - 1) // page_size
+
+
+def pack_result(value, on_image=None):
+    # Figures travel as PNG bytes (rendered concurrently, then closed), tensors as detached CPU copies
+    return _pack(value, render_figures(find_figures(value), on_image))
+
+
+def _pack(value, rendered):
+    if is_figure(value):
+        return rendered[id(value)]
+    if isinstance(value, torch.Tensor):
+        return value.detach().cpu().clone()
+    if isinstance(value, dict):
+        return {k: _pack(v, rendered) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_pack(v, rendered) for v in value)
+    try:
+        pickle.dumps(value)
+        return value
+    except Exception:
+        return repr(value)
@@ -0,0 +1,198 @@
+"""Per-stage timing spans for a query, exported as JSONL and Prometheus text.
+
+A `Trace` collects one span per pipeline stage (refinement, generation, each
+exec attempt, fixes, serialization, summary) with wall/CPU time, RSS and any
+extra attributes such as Ollama token counts. Finished traces are appended to
+`OPF_TRACE_LOG` and folded into process-wide per-stage metrics, which can be
+served at `/metrics` on `OPF_METRICS_PORT`.
+"""
+import os
+import json
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TRACE_LOG = os.environ.get("OPF_TRACE_LOG", os.path.join("logs", "traces.jsonl"))
+METRICS_PORT = int(os.environ.get("OPF_METRICS_PORT", "0"))
+LATENCY_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def current_rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return 0
+
+
+def ollama_token_attrs(stats):
+    # Ollama reports durations in nanoseconds
+    attrs = {k: stats[k] for k in ("eval_count", "prompt_eval_count") if k in stats}
+    if stats.get("eval_duration"):
+        attrs["eval_s"] = stats["eval_duration"] / 1e9
+        attrs["tokens_per_s"] = stats.get("eval_count", 0) / attrs["eval_s"]
+    if stats.get("prompt_eval_duration"):
+        attrs["prompt_eval_s"] = stats["prompt_eval_duration"] / 1e9
+    if stats.get("stopped_early"):
+        attrs["stopped_early"] = True
+    return attrs
+
+
+class Trace:
+    def __init__(self, name="query", **attrs):
+        self.trace_id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.attrs = dict(attrs)
+        self.spans = []
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self.total_s = None
+
+    @contextmanager
+    def span(self, stage, **attrs):
+        """Times the enclosed block; the yielded dict takes extra attributes."""
+        record = {"stage": stage, **attrs}
+        start, cpu_start, rss_start = time.perf_counter(), time.thread_time(), current_rss_bytes()
+        try:
+            yield record
+        except Exception as e:
+            record["error"] = str(e)[:200]
+            raise
+        finally:
+            record.update(
+                offset_s=start - self._start,
+                wall_s=time.perf_counter() - start,
+                cpu_s=time.thread_time() - cpu_start,
+                rss_delta_bytes=current_rss_bytes() - rss_start,
+            )
+            self.spans.append(record)
+
+    def stage_totals(self):
+        totals = {}
+        for span in self.spans:
+            totals[span["stage"]] = totals.get(span["stage"], 0.0) + span["wall_s"]
+        return totals
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "started": self.started,
+            "total_s": self.total_s,
+            "attrs": self.attrs,
+            "spans": self.spans,
+        }
+
+    def finish(self):
+        if self.total_s is None:
+            self.total_s = time.perf_counter() - self._start
+            metrics.observe(self)
+            export_jsonl(self)
+        return self
+
+
+def export_jsonl(trace, path=None):
+    path = path or TRACE_LOG
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "a") as f:
+            f.write(json.dumps(trace.to_dict(), default=str) + "\n")
+    except OSError as e:
+        print(f"[Telemetry] Could not write trace: {e}")
+
+
+class StageMetrics:
+    """Process-wide per-stage latency histograms and counters."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._counters = {}
+        self.last_trace = None
+
+    def observe(self, trace):
+        with self._lock:
+            for span in trace.spans + [{"stage": "total", "wall_s": trace.total_s}]:
+                stage = self._stages.setdefault(span["stage"], {
+                    "count": 0, "sum": 0.0, "buckets": [0] * len(LATENCY_BUCKETS), "errors": 0,
+                })
+                stage["count"] += 1
+                stage["sum"] += span["wall_s"]
+                stage["errors"] += 1 if span.get("error") else 0
+                for i, bound in enumerate(LATENCY_BUCKETS):
+                    if span["wall_s"] <= bound:
+                        stage["buckets"][i] += 1
+                for key in ("eval_count", "prompt_eval_count", "prompt_tokens_est"):
+                    if key in span:
+                        name = f"{key}_total"
+                        self._counters[name] = self._counters.get(name, 0) + span[key]
+            self._counters["retries_total"] = self._counters.get("retries_total", 0) + trace.attrs.get("retries", 0)
+            self._counters["queries_total"] = self._counters.get("queries_total", 0) + 1
+            self.last_trace = trace.to_dict()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "stages": {
+                    name: {"count": s["count"], "mean_s": s["sum"] / s["count"], "errors": s["errors"]}
+                    for name, s in self._stages.items()
+                },
+                "counters": dict(self._counters),
+            }
+
+    def prometheus_text(self):
+        lines = [
+            "# HELP opf_stage_seconds Wall time per pipeline stage.",
+            "# TYPE opf_stage_seconds histogram",
+        ]
+        with self._lock:
+            for name, s in self._stages.items():
+                for bound, count in zip(LATENCY_BUCKETS, s["buckets"]):
+                    lines.append(f'opf_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {count}')
+                lines.append(f'opf_stage_seconds_bucket{{stage="{name}",le="+Inf"}} {s["count"]}')
+                lines.append(f'opf_stage_seconds_sum{{stage="{name}"}} {s["sum"]}')
+                lines.append(f'opf_stage_seconds_count{{stage="{name}"}} {s["count"]}')
+                lines.append(f'opf_stage_errors_total{{stage="{name}"}} {s["errors"]}')
+            for name, value in self._counters.items():
+                lines.append(f"# TYPE opf_{name} counter")
+                lines.append(f"opf_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = StageMetrics()
+
+_server = None
+_server_lock = threading.Lock()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port=METRICS_PORT, host="127.0.0.1"):
+    """Serves `/metrics` in a daemon thread once per process (no-op for port 0)."""
+    global _server
+    with _server_lock:
+        if _server is not None or not port:
+            return _server
+        try:
+            _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        except OSError as e:
+            print(f"[Telemetry] Metrics endpoint not started: {e}")
+            return None
+        threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+        return _server
@@ -0,0 +1,190 @@
+"""Static checks of generated code against the data schema, before any exec.
+
+Finds accesses such as `data['ac_line'].edge_attr[:, 9]` or
+`store['bus'].y[..., 3]` in the AST and checks them against the widths parsed
+from the schema in `config/prompts.py` (see `config/schema.py`): unknown node
+or edge types, attributes an entity does not have (`.y` on edges, features on
+link edges) and constant column indices past the feature width. Issues are
+reported with line numbers so they can go straight into a fix prompt.
+"""
+import ast
+
+from config.schema import NODE_SCHEMA, EDGE_SCHEMA
+
+DATA_ATTRS = {"x", "y", "edge_index", "edge_attr", "edge_label"}
+EDGE_HINTS = {
+    "y": "edges have no `.y`; use `.edge_label` for solution values (power flows)",
+    "x": "edges have no `.x`; use `.edge_attr` for edge features",
+}
+RELATIONS = {}
+for _edge_type in EDGE_SCHEMA:
+    RELATIONS.setdefault(_edge_type[1], []).append(_edge_type)
+
+
+class Issue:
+    def __init__(self, line, message):
+        self.line = line
+        self.message = message
+
+    def __str__(self):
+        return f"Line {self.line}: {self.message}"
+
+    def __repr__(self):
+        return f"Issue({self.line}, {self.message!r})"
+
+
+def _constant_key(node):
+    # 'bus' or ('bus', 'ac_line', 'bus') / 'bus', 'ac_line', 'bus' as a subscript key
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    if isinstance(node, ast.Tuple) and all(isinstance(e, ast.Constant) and isinstance(e.value, str) for e in node.elts):
+        return tuple(e.value for e in node.elts)
+    return None
+
+
+def _resolve(key):
+    """Returns `(kind, canonical_key, error)` for a node/edge key."""
+    if isinstance(key, tuple):
+        if key in EDGE_SCHEMA:
+            return "edge", key, None
+        known = ", ".join(str(k) for k in EDGE_SCHEMA)
+        return None, None, f"unknown edge type {key}; valid edge types: {known}"
+    if key in NODE_SCHEMA:
+        return "node", key, None
+    if len(RELATIONS.get(key, [])) == 1:
+        return "edge", RELATIONS[key][0], None
+    if key in RELATIONS:
+        options = ", ".join(str(k) for k in RELATIONS[key])
+        return None, None, f"relation '{key}' is ambiguous; use the full edge type, one of: {options}"
+    return None, None, (f"unknown node type '{key}'; node types are {', '.join(NODE_SCHEMA)} "
+                        f"and edge relations are {', '.join(RELATIONS)}")
+
+
+class _Checker(ast.NodeVisitor):
+    def __init__(self):
+        self.issues = []
+        # Names bound to an entity tensor, e.g. `ea = data['ac_line'].edge_attr`
+        self.aliases = {}
+
+    def _access(self, node):
+        """`(kind, key, attr, ndim)` if `node` is `<base>[<key>].<attr>`."""
+        if isinstance(node, ast.Name) and node.id in self.aliases:
+            return self.aliases[node.id]
+        if not (isinstance(node, ast.Attribute) and node.attr in DATA_ATTRS and isinstance(node.value, ast.Subscript)):
+            return None
+        key = _constant_key(node.value.slice)
+        if key is None:
+            return None
+        base = node.value.value
+        # `store` tensors carry a leading sample dimension
+        ndim = 3 if isinstance(base, ast.Name) and base.id == "store" else 2
+        kind, canonical, error = _resolve(key)
+        if error:
+            self.issues.append(Issue(node.lineno, error))
+            return None
+        attrs = (NODE_SCHEMA if kind == "node" else EDGE_SCHEMA)[canonical]
+        if node.attr not in attrs:
+            if kind == "edge" and node.attr in EDGE_HINTS:
+                message = f"{canonical}: {EDGE_HINTS[node.attr]}"
+            elif kind == "edge" and set(attrs) == {"edge_index"}:
+                message = f"{canonical} is a link edge with only `edge_index` (no `.{node.attr}`)"
+            else:
+                message = f"'{canonical}' has no `.{node.attr}`; available: {', '.join(attrs)}"
+            self.issues.append(Issue(node.lineno, message))
+            return None
+        return kind, canonical, node.attr, ndim
+
+    def visit_Assign(self, node):
+        self.generic_visit(node)
+        if len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            access = self._access(node.value) if isinstance(node.value, ast.Attribute) else None
+            if access:
+                self.aliases[node.targets[0].id] = access
+            else:
+                self.aliases.pop(node.targets[0].id, None)
+
+    def visit_Attribute(self, node):
+        self._access(node)
+        self.generic_visit(node)
+
+    def visit_Subscript(self, node):
+        access = self._access(node.value)
+        if access:
+            self._check_column(node, *access)
+            # The access itself was checked; only look inside the index
+            self.visit(node.slice)
+            if not isinstance(node.value, ast.Name):
+                self.generic_visit(node.value.value)
+            return
+        self.generic_visit(node)
+
+    def _check_column(self, node, kind, key, attr, ndim):
+        width = (NODE_SCHEMA if kind == "node" else EDGE_SCHEMA)[key][attr]
+        index = node.slice
+        if width is None or not isinstance(index, ast.Tuple) or not index.elts:
+            return
+        first, last = index.elts[0], index.elts[-1]
+        ellipsis = isinstance(first, ast.Constant) and first.value is Ellipsis
+        if len(index.elts) != ndim and not ellipsis:
+            return
+        column = _constant_int(last)
+        if column is not None and not -width <= column < width:
+            name = f"{key}" if kind == "node" else f"{key[1]}"
+            self.issues.append(Issue(
+                node.lineno,
+                f"column {column} is out of range for {name} `.{attr}`, which has {width} columns "
+                f"(valid indices 0-{width - 1})",
+            ))
+
+
+def _constant_int(node):
+    if isinstance(node, ast.Constant) and isinstance(node.value, int) and not isinstance(node.value, bool):
+        return node.value
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        value = _constant_int(node.operand)
+        return -value if value is not None else None
+    return None
+
+
+def validate_code(code):
+    """Returns a list of `Issue`s; empty when nothing is known to be wrong."""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        return [Issue(e.lineno or 0, f"syntax error: {e.msg}")]
+    checker = _Checker()
+    checker.visit(tree)
+    # One issue per line and message, in source order
+    unique = {(i.line, i.message): i for i in checker.issues}
+    return sorted(unique.values(), key=lambda i: i.line)
+
+
+def _is_store_access(node):
+    return (isinstance(node, ast.Attribute) and node.attr in DATA_ATTRS and isinstance(node.value, ast.Subscript)
+            and isinstance(node.value.value, ast.Name) and node.value.value.id == "store")
+
+
+def selects_samples(code):
+    """True if the code picks samples by literal position (`dataset[10]`, `store['bus'].x[10]`),
+    where a dry run on a one-sample subset would fail for the wrong reason."""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return False
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Subscript):
+            continue
+        if isinstance(node.value, ast.Name) and node.value.id == "dataset":
+            index = node.slice
+        elif _is_store_access(node.value):
+            index = node.slice.elts[0] if isinstance(node.slice, ast.Tuple) and node.slice.elts else node.slice
+        else:
+            continue
+        # `dataset[i]` in a loop works on any subset; a literal position past 0 may not
+        if any(isinstance(n, ast.Constant) and type(n.value) is int and n.value > 0 for n in ast.walk(index)):
+            return True
+    return False
+
+
+def format_issues(issues):
+    return "Static schema check failed before execution:\n" + "\n".join(f"- {issue}" for issue in issues)
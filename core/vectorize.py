@@ -0,0 +1,211 @@
+"""Runs per-sample loops of generated code over the stacked feature-store tensors.
+
+Generated code mostly looks like
+
+    vals = []
+    for data in dataset:
+        vm = data['bus'].y[:, 1]
+        vals.append((vm < data['bus'].x[:, 2]).sum())
+
+`compile_snippet` rewrites such loops so the body becomes a function of the
+tensors it reads, mapped over the sample dimension of `store` with
+`torch.func.vmap`: a handful of large tensor ops instead of one `dataset[i]`
+separation plus Python overhead per sample. The original loop is kept as a
+fallback and runs whenever the vectorized body fails (data-dependent control
+flow, `.item()`, `int(...)`, ...) or disagrees with the loop on the first
+samples. Only loops whose body is plain assignments and `<list>.append(...)`
+are rewritten; the rest of the code keeps its line numbers, so errors point
+at the lines the model wrote.
+"""
+import os
+import ast
+import copy
+
+import torch
+from torch.func import vmap
+
+VECTORIZE = os.environ.get("OPF_VECTORIZE", "1") != "0"
+# Samples re-run eagerly to check the vectorized body against the loop
+CHECK_SAMPLES = int(os.environ.get("OPF_VECTORIZE_CHECK", "2"))
+# Samples per vmap call; bounds the memory of intermediate tensors
+CHUNK_SIZE = int(os.environ.get("OPF_VECTORIZE_CHUNK", "4096"))
+MAP_FUNCTION = "_opf_map_dataset"
+UNBATCHED_ATTRS = {"edge_index", "num_nodes"}
+
+
+def _constant_key(node):
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    if isinstance(node, ast.Tuple) and all(isinstance(e, ast.Constant) and isinstance(e.value, str) for e in node.elts):
+        return tuple(e.value for e in node.elts)
+    return None
+
+
+def _names(nodes, ctx):
+    return {n.id for node in nodes for n in ast.walk(node) if isinstance(n, ast.Name) and isinstance(n.ctx, ctx)}
+
+
+def _append_target(stmt):
+    # `<name>.append(<expr>)` as a statement
+    if not (isinstance(stmt, ast.Expr) and isinstance(stmt.value, ast.Call)):
+        return None
+    call = stmt.value
+    if (isinstance(call.func, ast.Attribute) and call.func.attr == "append" and isinstance(call.func.value, ast.Name)
+            and len(call.args) == 1 and not call.keywords):
+        return call.func.value.id
+    return None
+
+
+class _Accesses(ast.NodeTransformer):
+    """Replaces `data[<key>].<attr>` with argument names."""
+
+    def __init__(self, var):
+        self.var = var
+        self.args = {}
+
+    def visit_Attribute(self, node):
+        value = node.value
+        if isinstance(value, ast.Subscript) and isinstance(value.value, ast.Name) and value.value.id == self.var:
+            key = _constant_key(value.slice)
+            if key is not None:
+                name = self.args.setdefault((key, node.attr), f"_opf_arg_{len(self.args)}")
+                return ast.copy_location(ast.Name(id=name, ctx=ast.Load()), node)
+        return self.generic_visit(node)
+
+
+def _rewrite_loop(loop, before, after, n):
+    """Statements replacing `loop`, or None if it is not a plain map over `dataset`."""
+    if not (isinstance(loop.iter, ast.Name) and loop.iter.id == "dataset" and isinstance(loop.target, ast.Name)
+            and not loop.orelse):
+        return None
+    var = loop.target.id
+    lists, body, assigned = {}, [], set()
+    for stmt in loop.body:
+        # Values carried from one iteration to the next can't be mapped
+        if _names([stmt], ast.Load) & (_names(loop.body, ast.Store) - assigned):
+            return None
+        # In-place ops would write into the shared store tensors (`+=` is excluded below)
+        if any(isinstance(n, ast.Attribute) and n.attr.endswith("_") and not n.attr.startswith("_")
+               for n in ast.walk(stmt)):
+            return None
+        target = _append_target(stmt)
+        if target is not None:
+            if target in lists:
+                return None
+            lists[target] = f"_opf_out_{len(lists)}"
+            output = ast.Assign(targets=[ast.Name(id=lists[target], ctx=ast.Store())], value=stmt.value.args[0])
+            body.append(ast.fix_missing_locations(ast.copy_location(output, stmt)))
+            continue
+        # Writes go to plain local names only, not into `result` or other outer objects
+        if not isinstance(stmt, ast.Assign):
+            return None
+        if not all(isinstance(n, (ast.Name, ast.Tuple, ast.Store)) for t in stmt.targets for n in ast.walk(t)):
+            return None
+        assigned |= _names([stmt], ast.Store)
+        body.append(stmt)
+    if not lists or var in assigned or set(lists) & (assigned | _names(body, ast.Load)):
+        return None
+    # Locals of the body become function locals; the loop leaves them behind
+    if (assigned | {var}) & _names(after, ast.Load):
+        return None
+    initialized = {t.id for s in before if isinstance(s, ast.Assign) and isinstance(s.value, ast.List) and not s.value.elts
+                   for t in s.targets if isinstance(t, ast.Name)}
+    if not set(lists) <= initialized:
+        return None
+
+    accesses = _Accesses(var)
+    body = [accesses.visit(copy.deepcopy(stmt)) for stmt in body]
+    if var in _names(body, ast.Load) or not accesses.args:
+        return None
+    function_name, out_name = f"_opf_vec_body_{n}", f"_opf_vec_out_{n}"
+    outs = ", ".join(lists.values())
+    function = _parse_at(f"def {function_name}({', '.join(accesses.args.values())}):\n    return ({outs},)", loop)
+    function.body = body + function.body
+    call = _parse_at(f"{out_name} = {MAP_FUNCTION}({function_name}, dataset, store, {list(accesses.args)!r})", loop)
+    extend = [_parse_at(f"{name}.extend({out_name}[{i}])", loop) for i, name in enumerate(lists)]
+    branch = _parse_at(f"if {out_name} is not None:\n    pass", loop)
+    branch.body, branch.orelse = extend, [loop]
+    return [function, call, branch]
+
+
+def _parse_at(source, node):
+    # One generated statement, placed on the line of `node`
+    stmt = ast.parse(source).body[0]
+    ast.increment_lineno(stmt, node.lineno - 1)
+    return stmt
+
+
+def vectorize_tree(tree):
+    """Rewrites top-level loops of `tree` in place; returns the number rewritten."""
+    body, rewritten = [], 0
+    for i, stmt in enumerate(tree.body):
+        new = _rewrite_loop(stmt, tree.body[:i], tree.body[i + 1:], rewritten) if isinstance(stmt, ast.For) else None
+        if new is None:
+            body.append(stmt)
+        else:
+            body.extend(new)
+            rewritten += 1
+    if rewritten:
+        body.insert(0, _parse_at(f"from core.vectorize import map_dataset as {MAP_FUNCTION}", tree.body[0]))
+    tree.body = body
+    return rewritten
+
+
+def vectorize_code(code):
+    """Source of the rewritten code, or None if no loop qualifies (for inspection and benchmarks)."""
+    tree = ast.parse(code)
+    return ast.unparse(tree) if vectorize_tree(tree) else None
+
+
+def compile_snippet(code, vectorize=VECTORIZE):
+    """Code object for `exec`, with per-sample loops vectorized when possible."""
+    if vectorize:
+        try:
+            tree = ast.parse(code)
+            if vectorize_tree(tree):
+                return compile(tree, "<string>", "exec")
+        except SyntaxError:
+            pass
+    return compile(code, "<string>", "exec")
+
+
+def _inputs(source, accesses, batched):
+    inputs = []
+    for key, attr in accesses:
+        entity = source[key]
+        if attr == "num_nodes":
+            # Store tensors are [num_samples, num_nodes, F]
+            inputs.append(getattr(entity, entity.keys()[0]).size(1) if batched else entity.num_nodes)
+        else:
+            inputs.append(getattr(entity, attr))
+    return inputs
+
+
+def _same(a, b):
+    if not isinstance(a, torch.Tensor) or not isinstance(b, torch.Tensor):
+        return False
+    if a.shape != b.shape or a.dtype != b.dtype:
+        return False
+    if a.is_floating_point():
+        return torch.allclose(a, b, rtol=1e-5, atol=1e-6, equal_nan=True)
+    return torch.equal(a, b)
+
+
+def map_dataset(fn, dataset, store, accesses, check=CHECK_SAMPLES):
+    """Per-output lists of per-sample values of `fn`, mapped over `store`; None to use the loop.
+
+    `accesses` lists the `(key, attr)` each argument of `fn` reads from a sample.
+    """
+    if store is None or len(store) != len(dataset) or len(dataset) == 0:
+        return None
+    try:
+        inputs = _inputs(store, accesses, batched=True)
+        in_dims = tuple(None if attr in UNBATCHED_ATTRS else 0 for _, attr in accesses)
+        outputs = vmap(fn, in_dims=in_dims, chunk_size=CHUNK_SIZE)(*inputs)
+        for i in range(min(check, len(dataset))):
+            expected = fn(*_inputs(dataset[i], accesses, batched=False))
+            if not all(_same(e, out[i]) for e, out in zip(expected, outputs)):
+                return None
+    except Exception:
+        return None
+    return [list(out.unbind(0)) for out in outputs]
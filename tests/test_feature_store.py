@@ -0,0 +1,59 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torch_geometric")
+
+from torch_geometric.data import HeteroData, InMemoryDataset
+
+from core.feature_store import load_feature_store, _store_dir
+
+
+class SyntheticDataset(InMemoryDataset):
+    def __init__(self, root, num_samples):
+        super().__init__(root)
+        generator = torch.Generator().manual_seed(0)
+        samples = []
+        for _ in range(num_samples):
+            data = HeteroData()
+            data["bus"].x = torch.rand(4, 4, generator=generator)
+            data["bus"].y = torch.rand(4, 2, generator=generator)
+            edge = data["bus", "ac_line", "bus"]
+            edge.edge_index = torch.tensor([[0, 1, 2], [1, 2, 3]])
+            edge.edge_attr = torch.rand(3, 9, generator=generator)
+            edge.edge_label = torch.rand(3, 4, generator=generator)
+            samples.append(data)
+        self._data, self.slices = self.collate(samples)
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    return SyntheticDataset(str(tmp_path), 16)
+
+
+def assert_rows_match(store, dataset):
+    for i in range(len(dataset)):
+        assert torch.equal(store["bus"].x[i], dataset[i]["bus"].x)
+        assert torch.equal(store["ac_line"].edge_label[i], dataset[i]["bus", "ac_line", "bus"].edge_label)
+
+
+def test_slices_of_equal_length_get_their_own_store(dataset):
+    first, second = dataset[[3, 5, 7]], dataset[[10, 11, 12]]
+    assert _store_dir(first) != _store_dir(second)
+
+    assert_rows_match(load_feature_store(first), first)
+    assert_rows_match(load_feature_store(second), second)
+    # Reopened from disk, each slice still maps its own rows
+    assert_rows_match(load_feature_store(first), first)
+
+
+def test_store_built_for_other_samples_is_rebuilt(dataset):
+    first, second = dataset[[3, 5, 7]], dataset[[10, 11, 12]]
+    path = _store_dir(first)
+    load_feature_store(first, path=path)
+    assert_rows_match(load_feature_store(second, path=path), second)
+
+
+def test_whole_dataset(dataset):
+    store = load_feature_store(dataset)
+    assert len(store) == len(dataset)
+    assert_rows_match(store, dataset)
@@ -0,0 +1,98 @@
+import types
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("matplotlib")
+pytest.importorskip("streamlit")
+pytest.importorskip("torch_geometric")
+
+from core.executor import execute_code
+from core.result_cache import ResultCache, execute_memoized, split_map_reduce
+from core.serialize import pack_result
+
+# Figures drawn after the loop: split, the reduce stage plots from the captured values
+PLOT_AFTER_LOOP = """
+import matplotlib.pyplot as plt
+vms = []
+for data in dataset:
+    vms.append(data['bus'].y[:, 1])
+vms = torch.stack(vms)
+fig, ax = plt.subplots()
+ax.hist(vms.flatten().numpy(), bins={bins})
+result["max_vm"] = vms.max()
+result["figure"] = fig
+"""
+
+# Figures drawn inside the loop: never split
+PLOT_IN_LOOP = """
+import matplotlib.pyplot as plt
+fig, ax = plt.subplots()
+for data in dataset:
+    ax.plot(data['bus'].y[:, 1].numpy())
+ax.set_title("{title}")
+result["figure"] = fig
+"""
+
+
+@pytest.fixture
+def dataset():
+    generator = torch.Generator().manual_seed(0)
+    return [{"bus": types.SimpleNamespace(y=torch.rand(14, 2, generator=generator))} for _ in range(8)]
+
+
+def run_cached(code, dataset, cache):
+    stats = {}
+    result = execute_memoized(
+        lambda c, scope: execute_code(c, dataset, scope=scope), code, "case14", len(dataset), cache=cache, stats=stats,
+    )
+    return result, stats["result_cache"]
+
+
+def run_uncached(code, dataset):
+    return pack_result(execute_code(code, dataset))
+
+
+def assert_same(cached, uncached):
+    assert cached.keys() == uncached.keys()
+    for key, value in uncached.items():
+        if isinstance(value, torch.Tensor):
+            assert torch.equal(cached[key], value)
+        else:
+            assert cached[key] == value
+
+
+def test_plot_after_loop_matches_uncached(dataset, tmp_path):
+    cache = ResultCache(str(tmp_path))
+    code = PLOT_AFTER_LOOP.format(bins=10)
+    assert split_map_reduce(code)[2] == ["vms"]
+
+    result, status = run_cached(code, dataset, cache)
+    assert status == "miss"
+    assert isinstance(result["figure"], bytes)
+    assert_same(result, run_uncached(code, dataset))
+
+    result, status = run_cached(code, dataset, cache)
+    assert status == "hit"
+    assert_same(result, run_uncached(code, dataset))
+
+    # Only the plotting changed: the reduce stage reruns on the captured `vms`
+    fixed = PLOT_AFTER_LOOP.format(bins=20)
+    result, status = run_cached(fixed, dataset, cache)
+    assert status == "map_hit"
+    assert_same(result, run_uncached(fixed, dataset))
+
+
+def test_plot_in_loop_is_not_split(dataset, tmp_path):
+    cache = ResultCache(str(tmp_path))
+    code = PLOT_IN_LOOP.format(title="Voltage magnitudes")
+    assert split_map_reduce(code) is None
+
+    result, status = run_cached(code, dataset, cache)
+    assert status == "miss"
+    assert_same(result, run_uncached(code, dataset))
+
+    retitled = PLOT_IN_LOOP.format(title="Vm")
+    result, status = run_cached(retitled, dataset, cache)
+    assert status == "miss"
+    assert_same(result, run_uncached(retitled, dataset))